@@ -0,0 +1,90 @@
+"""
+Benchmark of fuzzy contact matching: the trigram index used by
+resolve_unknown_name against sorting the whole directory by edit distance.
+
+    python bench_fuzzy_match.py [sizes...]
+"""
+
+import random
+import string
+import sys
+import time
+
+import Levenshtein
+
+from fuzzy_match import TrigramIndex
+
+FIRST_NAMES = [
+    "Nathan", "Marin", "Alice", "Bob", "Chloé", "David", "Emma", "François", "Gabriel", "Hugo",
+    "Inès", "Jules", "Karim", "Léa", "Manon", "Nicolas", "Océane", "Pierre", "Quentin", "Raphaël",
+    "Sarah", "Thomas", "Ulysse", "Victor", "William", "Yasmine", "Zoé", "Anna", "Louis", "Camille"
+]
+QUERIES = 200
+
+
+def random_name(rng):
+    last = "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(4, 9))).capitalize()
+    return f"{rng.choice(FIRST_NAMES)} {last}"
+
+
+def typo(rng, name):
+    """The name with one character dropped, doubled or swapped, as heard or typed"""
+    i = rng.randrange(1, len(name) - 1)
+    return rng.choice([
+        name[:i] + name[i + 1:],
+        name[:i] + name[i] + name[i:],
+        name[:i - 1] + name[i] + name[i - 1] + name[i + 1:]
+    ])
+
+
+def linear_top(directory, query, limit=5):
+    # What resolve_unknown_name used to do
+    return sorted(directory, key=lambda name: Levenshtein.distance(query.lower(), name.lower()))[:limit]
+
+
+def run(size, rng):
+    names = list({random_name(rng) for _ in range(size)})
+    queries = [typo(rng, rng.choice(names)) for _ in range(QUERIES)]
+
+    start = time.perf_counter()
+    index = TrigramIndex()
+    for key, name in enumerate(names):
+        index.add(key, name)
+    build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for key in range(len(names), len(names) + 100):
+        index.add(key, random_name(rng))
+    for key in range(len(names), len(names) + 100):
+        index.remove(key)
+    update = (time.perf_counter() - start) / 200
+
+    start = time.perf_counter()
+    results = [index.search(query) for query in queries]
+    indexed = (time.perf_counter() - start) / QUERIES
+
+    linear_queries = queries[:max(5, QUERIES * 1000 // size)]
+    start = time.perf_counter()
+    expected = [linear_top(names, query) for query in linear_queries]
+    linear = (time.perf_counter() - start) / len(linear_queries)
+
+    # Same best match as the exhaustive sort (ties count as equal)
+    agree = sum(
+        Levenshtein.distance(query.lower(), got[0].lower()) == Levenshtein.distance(query.lower(), want[0].lower())
+        for query, got, want in zip(linear_queries, results, expected)
+    )
+    print(f"{len(names):>8} {build * 1000:>10.0f} {update * 1e6:>10.1f} {indexed * 1000:>10.2f} "
+          f"{linear * 1000:>10.2f} {linear / indexed:>8.0f}x {agree / len(linear_queries):>8.0%}")
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1000, 5000, 10000, 50000]
+    rng = random.Random(42)
+    print(f"{'contacts':>8} {'build ms':>10} {'update us':>10} {'index ms':>10} {'linear ms':>10} "
+          f"{'speedup':>9} {'top-1':>8}")
+    for size in sizes:
+        run(size, rng)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,13 @@ Configuration settings for the Mail Assistant application
 """
 
 import os
+import sys
+
+# Data files live next to the application, wherever it is started from
+if getattr(sys, "frozen", False):
+    APP_DIR = os.path.dirname(os.path.abspath(sys.executable))
+else:
+    APP_DIR = os.path.dirname(os.path.abspath(__file__))
 
 # File paths
 USER_DATA_FILE = "user_data.json"
@@ -33,6 +40,9 @@ MAIN_HOTKEY = 'ctrl+space'
 
 # Clipboard mode settings
 DEFAULT_CLIPBOARD_MODE = False  # False = manual UI, True = auto clipboard
+# How clipboard mode outputs the draft: None = paste it once complete,
+# "type" = type it as it is generated, "paste" = paste it sentence by sentence
+CLIPBOARD_STREAM_MODE = None
 
 # System tray icon settings
 TRAY_ICON_SIZE = (64, 64)
@@ -40,7 +50,7 @@ TRAY_ICON_FALLBACK_SIZE = (32, 32)
 
 def get_absolute_path(filename):
     """Get absolute path for a file in the application directory"""
-    return os.path.abspath(filename)
+    return os.path.join(APP_DIR, filename)
 
 def file_exists(filename):
     """Check if a file exists in the application directory"""
@@ -0,0 +1,234 @@
+"""
+Contact file formats for the Mail Assistant application.
+CSV and vCard files are read and written one contact at a time, so address
+books of any size go through the directory importer without being loaded
+into memory at once.
+"""
+
+import csv
+import os
+import quopri
+
+# CSV headers (lowercased, without spaces, dashes or underscores) -> directory field
+CSV_COLUMNS = {
+    "name": "name", "fullname": "name", "displayname": "name", "nom": "name",
+    "firstname": "first_name", "givenname": "first_name", "prenom": "first_name", "prénom": "first_name",
+    "lastname": "last_name", "familyname": "last_name", "surname": "last_name", "nomdefamille": "last_name",
+    "position": "position", "title": "position", "jobtitle": "position", "role": "position", "poste": "position",
+    "description": "description", "notes": "description", "note": "description",
+    "email": "email", "mail": "email", "emailaddress": "email", "email1": "email", "primaryemail": "email",
+    "aliases": "aliases", "alias": "aliases", "nickname": "aliases", "nicknames": "aliases",
+}
+CSV_FIELDS = ["name", "position", "description", "email", "aliases"]
+# Separator of several aliases in one CSV cell
+ALIAS_SEPARATOR = ";"
+VCARD_LINE_LENGTH = 75
+
+
+def detect_format(path):
+    """"csv" or "vcard" from the file extension"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".csv":
+        return "csv"
+    if extension in (".vcf", ".vcard"):
+        return "vcard"
+    raise ValueError(f"Unknown contact file format: {path} (expected .csv, .vcf or .vcard)")
+
+
+def make_person(name, position="", description="", email="", aliases=()):
+    """A directory entry from imported values, or None without a name"""
+    name = " ".join((name or "").split())
+    if not name:
+        return None
+    person = {"name": name, "position": (position or "").strip(), "description": (description or "").strip()}
+    if email and email.strip():
+        person["email"] = email.strip()
+    aliases = [alias.strip() for alias in aliases if alias and alias.strip()]
+    if aliases:
+        person["aliases"] = aliases
+    return person
+
+
+def read_csv(f):
+    """Yield the people of a CSV file with a header row; rows without a name yield None"""
+    reader = csv.reader(f)
+    header = next(reader, None)
+    if header is None:
+        return
+    fields = [
+        CSV_COLUMNS.get(column.strip().lower().replace(" ", "").replace("-", "").replace("_", ""))
+        for column in header
+    ]
+    for row in reader:
+        values = {}
+        for field, value in zip(fields, row):
+            if field and value and field not in values:
+                values[field] = value
+        name = values.get("name") or " ".join(
+            part for part in (values.get("first_name"), values.get("last_name")) if part
+        )
+        aliases = values.get("aliases", "").split(ALIAS_SEPARATOR)
+        yield make_person(name, values.get("position"), values.get("description"), values.get("email"), aliases)
+
+
+def write_csv(f, people):
+    writer = csv.writer(f)
+    writer.writerow(CSV_FIELDS)
+    for person in people:
+        writer.writerow([
+            person.get("name", ""), person.get("position", ""), person.get("description", ""),
+            person.get("email", ""), ALIAS_SEPARATOR.join(person.get("aliases", []))
+        ])
+
+
+def _unescape(value):
+    out = []
+    chars = iter(value)
+    for char in chars:
+        if char == "\\":
+            char = next(chars, "")
+            out.append("\n" if char in "nN" else char)
+        else:
+            out.append(char)
+    return "".join(out)
+
+
+def _split(value, separator):
+    """Split a vCard value on unescaped separators, then unescape the parts"""
+    parts, current, escaped = [], [], False
+    for char in value:
+        if escaped:
+            current.append("\\" + char)
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char == separator:
+            parts.append("".join(current))
+            current = []
+        else:
+            current.append(char)
+    parts.append("".join(current))
+    return [_unescape(part) for part in parts]
+
+
+def _quoted_printable(prop):
+    return "QUOTED-PRINTABLE" in prop.upper()
+
+
+def _unfold(f):
+    """Logical vCard lines: a line starting with a space or tab continues the previous one,
+    as does the line after a quoted-printable value ending with a soft line break ("=")"""
+    line = None
+    soft_break = False
+    for raw in f:
+        raw = raw.rstrip("\r\n")
+        if soft_break:
+            line = line[:-1] + raw
+            soft_break = raw.endswith("=")
+            continue
+        if raw[:1] in (" ", "\t") and line is not None:
+            line += raw[1:]
+            continue
+        if line is not None:
+            yield line
+        line = raw
+        soft_break = line.endswith("=") and ":" in line and _quoted_printable(line.split(":", 1)[0])
+    if line is not None:
+        yield line
+
+
+def _decode(value, parameters):
+    """Undo the vCard 2.1 ENCODING=QUOTED-PRINTABLE and CHARSET= parameters.
+
+    Files are read with errors="surrogateescape", so bytes that are not
+    UTF-8 reach this point unchanged and are decoded with the card's charset.
+    """
+    charset = "utf-8"
+    encoded = False
+    for parameter in parameters:
+        key, _, parameter_value = parameter.partition("=")
+        key = key.strip().upper()
+        if key == "CHARSET":
+            charset = parameter_value.strip() or charset
+        elif _quoted_printable(parameter):
+            # ENCODING=QUOTED-PRINTABLE, or the bare 2.1 form
+            encoded = True
+    data = value.encode("utf-8", "surrogateescape")
+    if encoded:
+        data = quopri.decodestring(data)
+    try:
+        text = data.decode(charset, "replace")
+    except LookupError:
+        text = data.decode("utf-8", "replace")
+    return text.replace("\r\n", "\n")
+
+
+def _vcard_person(card):
+    name = card.get("FN", [""])[0]
+    if not name and card.get("N"):
+        # N is Family;Given;Additional;Prefix;Suffix
+        parts = _split(card["N"][0], ";") + [""]
+        name = f"{parts[1]} {parts[0]}"
+    else:
+        name = _unescape(name)
+    position = _unescape(card.get("TITLE", card.get("ROLE", [""]))[0])
+    organization = _split(card["ORG"][0], ";")[0] if card.get("ORG") else ""
+    if organization:
+        position = f"{position}, {organization}" if position else organization
+    description = _unescape(card.get("NOTE", [""])[0])
+    email = _unescape(card.get("EMAIL", [""])[0])
+    aliases = [alias for value in card.get("NICKNAME", []) for alias in _split(value, ",")]
+    return make_person(name, position, description, email, aliases)
+
+
+def read_vcard(f):
+    """Yield the people of a vCard (2.1 to 4.0) file; cards without a name yield None
+
+    Open the file with errors="surrogateescape" so that 2.1 values in
+    another CHARSET than UTF-8 can be decoded.
+    """
+    card = None
+    for line in _unfold(f):
+        if ":" not in line:
+            continue
+        prop, value = line.split(":", 1)
+        # Drop the group prefix (item1.EMAIL); of the parameters (EMAIL;TYPE=work)
+        # only the 2.1 encoding and charset matter
+        name, *parameters = prop.split(";")
+        name = name.rsplit(".", 1)[-1].upper()
+        if name == "BEGIN" and value.strip().upper() == "VCARD":
+            card = {}
+        elif name == "END" and value.strip().upper() == "VCARD":
+            if card is not None:
+                yield _vcard_person(card)
+            card = None
+        elif card is not None:
+            card.setdefault(name, []).append(_decode(value, parameters))
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace(",", "\\,").replace(";", "\\;")
+
+
+def _fold(line):
+    # Lines longer than 75 characters continue on lines starting with a space
+    chunks = [line[i:i + VCARD_LINE_LENGTH] for i in range(0, len(line), VCARD_LINE_LENGTH)] or [""]
+    return "\r\n ".join(chunks) + "\r\n"
+
+
+def write_vcard(f, people):
+    for person in people:
+        lines = ["BEGIN:VCARD", "VERSION:3.0", f"FN:{_escape(person.get('name', ''))}"]
+        # Best effort split for the required N property
+        first, _, last = person.get("name", "").rpartition(" ")
+        lines.append(f"N:{_escape(last)};{_escape(first)};;;")
+        if person.get("position"):
+            lines.append(f"TITLE:{_escape(person['position'])}")
+        if person.get("description"):
+            lines.append(f"NOTE:{_escape(person['description'])}")
+        if person.get("email"):
+            lines.append(f"EMAIL;TYPE=INTERNET:{_escape(person['email'])}")
+        if person.get("aliases"):
+            lines.append("NICKNAME:" + ",".join(_escape(alias) for alias in person["aliases"]))
+        lines.append("END:VCARD")
+        f.write("".join(_fold(line) for line in lines))
@@ -0,0 +1,122 @@
+"""
+Contact retrieval for the Mail Assistant application.
+A BM25 index over the directory (names, aliases, emails, positions and
+descriptions) finds the contacts a received email is about, and
+render_contacts turns them into a compact recipient block that fits a
+token budget, instead of pasting the whole directory into the prompt.
+"""
+
+import heapq
+import math
+from collections import Counter
+from operator import itemgetter
+
+from name_extraction import WORD_PATTERN, normalize
+
+# Words too common in mails to tell contacts apart (English and French)
+STOPWORDS = {
+    "the", "and", "for", "you", "your", "with", "this", "that", "from", "have", "are", "was", "will",
+    "can", "our", "not", "but", "all", "any", "about", "would", "could", "please", "thanks", "thank",
+    "regards", "best", "dear", "hello", "hi", "le", "la", "les", "des", "du", "de", "et", "en", "un",
+    "une", "pour", "que", "qui", "dans", "sur", "avec", "vous", "nous", "est", "pas", "merci",
+    "bonjour", "cordialement"
+}
+
+
+def terms(text):
+    """Normalized words of text that can identify a contact"""
+    return [
+        term for term in (normalize(word) for word in WORD_PATTERN.findall(text or ""))
+        if len(term) > 1 and term not in STOPWORDS
+    ]
+
+
+def contact_text(person):
+    """The searchable text of a directory entry; the name counts twice"""
+    email = (person.get("email") or "").replace("@", " ").replace(".", " ")
+    return " ".join([
+        person.get("name", ""), person.get("name", ""), " ".join(person.get("aliases", [])),
+        email, person.get("position", ""), person.get("description", "")
+    ])
+
+
+class BM25Index:
+    """Okapi BM25 over short documents, updated one entry at a time"""
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self._postings = {}  # term -> {key: term frequency}
+        self._lengths = {}  # key -> number of terms
+        self._terms = {}  # key -> distinct terms, for removal
+        self._values = {}
+        self._total_length = 0
+
+    def __len__(self):
+        return len(self._lengths)
+
+    def add(self, key, text, value=None):
+        if key in self._lengths:
+            self.remove(key)
+        counts = Counter(terms(text))
+        for term, count in counts.items():
+            self._postings.setdefault(term, {})[key] = count
+        self._lengths[key] = sum(counts.values())
+        self._terms[key] = list(counts)
+        self._values[key] = text if value is None else value
+        self._total_length += self._lengths[key]
+
+    def remove(self, key):
+        if key not in self._lengths:
+            return
+        for term in self._terms.pop(key):
+            postings = self._postings[term]
+            del postings[key]
+            if not postings:
+                del self._postings[term]
+        self._total_length -= self._lengths.pop(key)
+        del self._values[key]
+
+    def search(self, query, limit=5, min_score=0.0):
+        """Up to limit (score, value) pairs, best first"""
+        if not self._lengths:
+            return []
+        count = len(self._lengths)
+        average_length = self._total_length / count or 1
+        scores = Counter()
+        for term in set(terms(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for key, frequency in postings.items():
+                length_norm = 1 - self.b + self.b * self._lengths[key] / average_length
+                scores[key] += idf * frequency * (self.k1 + 1) / (frequency + self.k1 * length_norm)
+        best = heapq.nlargest(limit, scores.items(), key=itemgetter(1))
+        return [(score, self._values[key]) for key, score in best if score >= min_score]
+
+
+def estimate_tokens(text):
+    # About four characters per token for English and French with LLM tokenizers
+    return (len(text) + 3) // 4
+
+
+def render_contacts(people, max_tokens, max_description=160):
+    """One line per person, in order, until max_tokens is used up"""
+    lines = []
+    used = 0
+    for person in people:
+        line = f"- {person['name']}"
+        if person.get("position"):
+            line += f" – {person['position']}"
+        description = (person.get("description") or "").strip()
+        if description:
+            if len(description) > max_description:
+                description = description[:max_description].rsplit(" ", 1)[0] + "…"
+            line += f": {description}"
+        cost = estimate_tokens(line) + 1
+        if used + cost > max_tokens:
+            break
+        lines.append(line)
+        used += cost
+    return "\n".join(lines)
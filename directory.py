@@ -1,29 +1,494 @@
+"""
+Contact directory of the Mail Assistant application.
+People are kept in memory with case-insensitive indexes on name, alias and
+email, so lookups, adds and deletes do not scan or re-parse the directory.
+directory.json is the default backend; large shared directories can use
+SQLite instead ("directory" block of config.json).
+"""
+
 import json
-import os
-DIRECTORY_FILE = "directory.json"
+import sqlite3
+import threading
+import time
 
-def load_directory():
-    if not os.path.exists(DIRECTORY_FILE):
-        return []
-    with open(DIRECTORY_FILE, "r") as f:
-        return json.load(f)
+import settings
+from config_settings import get_absolute_path
+from contact_formats import detect_format, read_csv, read_vcard, write_csv, write_vcard
+from contact_retrieval import BM25Index, contact_text
+from fuzzy_match import TrigramIndex
+from keys import person_key
+
+
+def person_keys(person):
+    """Alias and email keys a person can also be found by"""
+    aliases = [person_key(alias) for alias in person.get("aliases", []) if alias]
+    email = person_key(person.get("email"))
+    return aliases, email
+
+
+def merge_person(existing, incoming):
+    """existing updated with the non-empty values of incoming; a different name becomes an alias"""
+    merged = dict(existing)
+    for field in ("position", "description", "email"):
+        if incoming.get(field):
+            merged[field] = incoming[field]
+    aliases = list(existing.get("aliases", []))
+    known = {person_key(existing["name"])} | {person_key(alias) for alias in aliases}
+    for alias in [incoming["name"]] + incoming.get("aliases", []):
+        if person_key(alias) not in known:
+            known.add(person_key(alias))
+            aliases.append(alias)
+    if aliases:
+        merged["aliases"] = aliases
+    return merged
+
+
+class JsonDirectoryStore:
+    """directory.json, cached by the settings service and indexed in memory.
+
+    The indexes are rebuilt only when the file changes on disk. Adds and
+    deletes update them in place, then append a record to the journal of
+    the file instead of rewriting it.
+    """
+
+    def __init__(self, json_file=None):
+        self.file = json_file or settings.directory
+        self._people = {}  # name key -> person, in directory order
+        self._by_alias = {}
+        self._by_email = {}
+        self._file_version = None
+        self._version = 0
+        self._listeners = []
+        self._lock = threading.RLock()
+
+    @property
+    def version(self):
+        """Changes whenever the directory does"""
+        with self._lock:
+            self._sync()
+            return self._version
+
+    def all(self):
+        with self._lock:
+            self._sync()
+            return list(self._people.values())
+
+    def find(self, value):
+        """The person with this name, alias or email, or None"""
+        key = person_key(value)
+        with self._lock:
+            self._sync()
+            return self._people.get(key) or self._by_alias.get(key) or self._by_email.get(key)
+
+    def add(self, person):
+        """Add a person, replacing the one with the same name"""
+        key = person_key(person["name"])
+        with self._lock:
+            self._sync()
+            if key in self._people:
+                self._unindex(self._people[key])
+            self._people[key] = person
+            self._index(person)
+            self._commit([{"put": person}])
+            self._notify("add", person)
+
+    def add_many(self, people):
+        """Add or replace several people with a single write"""
+        with self._lock:
+            self._sync()
+            for person in people:
+                key = person_key(person["name"])
+                if key in self._people:
+                    self._unindex(self._people[key])
+                self._people[key] = person
+                self._index(person)
+            # No per-person notification: search indexes rebuild on the version jump
+            self._commit([{"put": person} for person in people])
+
+    def delete(self, name):
+        """Remove a person by name; returns whether they were in the directory"""
+        with self._lock:
+            self._sync()
+            person = self._people.pop(person_key(name), None)
+            if person is None:
+                return False
+            self._unindex(person)
+            self._commit([{"delete": person_key(name)}])
+            self._notify("delete", person)
+            return True
+
+    def replace_all(self, people):
+        with self._lock:
+            self.file.save(list(people))
+            self._sync()
+
+    def on_change(self, listener):
+        """Call listener(kind, person, version) after each add or delete made through the store"""
+        self._listeners.append(listener)
+
+    def _notify(self, kind, person):
+        for listener in self._listeners:
+            listener(kind, person, self._version)
+
+    def _sync(self):
+        people = self.file.load()
+        if self.file.version == self._file_version:
+            return
+        self._people, self._by_alias, self._by_email = {}, {}, {}
+        for person in people:
+            self._people[person_key(person["name"])] = person
+            self._index(person)
+        self._file_version = self.file.version
+        self._version += 1
+
+    def _index(self, person):
+        aliases, email = person_keys(person)
+        for alias in aliases:
+            self._by_alias[alias] = person
+        if email:
+            self._by_email[email] = person
+
+    def _unindex(self, person):
+        aliases, email = person_keys(person)
+        for alias in aliases:
+            if self._by_alias.get(alias) is person:
+                del self._by_alias[alias]
+        if email and self._by_email.get(email) is person:
+            del self._by_email[email]
+
+    def _commit(self, records):
+        file_version = self.file.version
+        self.file.update(records)
+        # Our own records need no re-index, unless changes from another process came in with them
+        self._file_version = self.file.version if self.file.version == file_version + 1 else None
+        self._version += 1
+
+
+class SqliteDirectoryStore:
+    """The directory in an SQLite database, for directories too large to rewrite on every change.
+
+    Lookups go through primary-key and indexed columns; the full list is
+    cached until the database changes, from this process or another one.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS people (
+            key TEXT PRIMARY KEY,
+            email TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS people_email ON people (email);
+        CREATE TABLE IF NOT EXISTS aliases (
+            alias TEXT PRIMARY KEY,
+            person TEXT NOT NULL REFERENCES people (key) ON DELETE CASCADE
+        );
+        CREATE INDEX IF NOT EXISTS aliases_person ON aliases (person);
+    """
+
+    def __init__(self, path, import_from=None):
+        self.path = path
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA foreign_keys = ON")
+        self._connection.executescript(self.SCHEMA)
+        self._lock = threading.RLock()
+        self._all = None
+        self._data_version = None
+        self._version = 0
+        self._listeners = []
+        if import_from is not None and not self._connection.execute("SELECT 1 FROM people LIMIT 1").fetchone():
+            people = import_from.load()
+            if people:
+                print(f"Importing {len(people)} contacts into {path}")
+                self.replace_all(people)
+
+    @property
+    def version(self):
+        with self._lock:
+            self._sync()
+            return self._version
+
+    def all(self):
+        with self._lock:
+            self._sync()
+            if self._all is None:
+                rows = self._connection.execute("SELECT data FROM people ORDER BY rowid")
+                self._all = [json.loads(data) for data, in rows]
+            return list(self._all)
+
+    def find(self, value):
+        key = person_key(value)
+        with self._lock:
+            # One indexed query; a name match wins over an alias, an alias over an email
+            row = self._connection.execute(
+                "SELECT data FROM people WHERE key = ?1 OR email = ?1 "
+                "OR key IN (SELECT person FROM aliases WHERE alias = ?1) "
+                "ORDER BY key = ?1 DESC, email = ?1 LIMIT 1", (key,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def add(self, person):
+        with self._lock:
+            with self._connection:
+                self._insert(person)
+                self._changed()
+            self._notify("add", person)
+
+    def add_many(self, people):
+        with self._lock:
+            with self._connection:
+                for person in people:
+                    self._insert(person)
+                self._changed()
 
-print(load_directory())
+    def delete(self, name):
+        key = person_key(name)
+        with self._lock:
+            row = self._connection.execute("SELECT data FROM people WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return False
+            with self._connection:
+                self._connection.execute("DELETE FROM people WHERE key = ?", (key,))
+                self._changed()
+            self._notify("delete", json.loads(row[0]))
+            return True
+
+    def replace_all(self, people):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM people")
+            for person in people:
+                self._insert(person)
+            self._changed()
+
+    def on_change(self, listener):
+        """Call listener(kind, person, version) after each add or delete made through the store"""
+        self._listeners.append(listener)
+
+    def _notify(self, kind, person):
+        # Our own commit shows up in data_version of other connections only
+        for listener in self._listeners:
+            listener(kind, person, self._version)
+
+    def _insert(self, person):
+        key = person_key(person["name"])
+        aliases, email = person_keys(person)
+        # An upsert keeps the row, and so the position, of an updated person
+        self._connection.execute(
+            "INSERT INTO people (key, email, data) VALUES (?, ?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET email = excluded.email, data = excluded.data",
+            (key, email or None, json.dumps(person, ensure_ascii=False))
+        )
+        self._connection.execute("DELETE FROM aliases WHERE person = ?", (key,))
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO aliases (alias, person) VALUES (?, ?)", [(alias, key) for alias in aliases]
+        )
+
+    def _sync(self):
+        # data_version changes when another connection commits
+        data_version = self._connection.execute("PRAGMA data_version").fetchone()[0]
+        if data_version != self._data_version:
+            self._data_version = data_version
+            self._changed()
+
+    def _changed(self):
+        self._all = None
+        self._version += 1
+
+
+class LiveDirectoryIndex:
+    """A search index over a store's people, kept in step with its adds and deletes.
+
+    Changes that bypass the store (an edited directory.json, another
+    process writing the database) show up as a version jump and trigger
+    a full rebuild on the next search.
+    """
+
+    def __init__(self, store, new_index, add):
+        # new_index() makes an empty index, add(index, key, person) indexes one person
+        self.store = store
+        self.new_index = new_index
+        self.add = add
+        self._index = None
+        self._version = None
+        self._lock = threading.Lock()
+        store.on_change(self._apply)
+
+    def search(self, *args, **kwargs):
+        # Read the store before locking: its listeners run under its own lock
+        version = self.store.version
+        with self._lock:
+            if self._index is None or version != self._version:
+                people = self.store.all()
+                self._index = self.new_index()
+                for person in people:
+                    self.add(self._index, person_key(person["name"]), person)
+                self._version = version
+            return self._index.search(*args, **kwargs)
+
+    def _apply(self, kind, person, version):
+        with self._lock:
+            if self._index is None or version != self._version + 1:
+                self._index = None  # out of step, rebuilt on next search
+                return
+            key = person_key(person["name"])
+            if kind == "add":
+                self.add(self._index, key, person)
+            else:
+                self._index.remove(key)
+            self._version = version
+
+
+_store = None
+_store_config = None
+_fuzzy_index = None
+_contact_index = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """The directory store selected by config.json, reopened if that choice changes"""
+    global _store, _store_config, _fuzzy_index, _contact_index
+    directory_config = settings.config.get("directory", {})
+    with _store_lock:
+        if _store is None or directory_config != _store_config:
+            if directory_config.get("backend", "json") == "sqlite":
+                path = get_absolute_path(directory_config.get("sqlite_file", "directory.db"))
+                # A new database starts with the contacts of directory.json
+                _store = SqliteDirectoryStore(path, import_from=settings.directory)
+            else:
+                _store = JsonDirectoryStore()
+            _store_config = directory_config
+            _fuzzy_index = LiveDirectoryIndex(
+                _store, TrigramIndex, lambda index, key, person: index.add(key, person["name"], person)
+            )
+            _contact_index = LiveDirectoryIndex(
+                _store, BM25Index, lambda index, key, person: index.add(key, contact_text(person), person)
+            )
+        return _store
+
+
+def load_directory():
+    return get_store().all()
 
 def save_directory(directory):
-    with open(DIRECTORY_FILE, "w") as f:
-        json.dump(directory, f, indent=2)
+    get_store().replace_all(directory)
+
+def find_person(value):
+    # Lookup by name, alias or email, ignoring case
+    return get_store().find(value)
 
-def add_person(name, position, description):
-    directory = load_directory()
-    directory.append({
+def similar_people(name, limit=5):
+    # Closest names in the directory, for suggestions when a name is unknown
+    get_store()
+    return _fuzzy_index.search(name, limit)
+
+def relevant_people(text, limit=5, min_score=0.0):
+    # Contacts whose directory entry best matches text, as (score, person) pairs
+    get_store()
+    return _contact_index.search(text, limit, min_score)
+
+def add_person(name, position, description, email=None, aliases=None):
+    """Add a person, replacing the one with the same name (ignoring case) instead of adding a duplicate"""
+    person = {
         "name": name,
         "position": position,
         "description": description
-    })
-    save_directory(directory)
+    }
+    if email:
+        person["email"] = email
+    if aliases:
+        person["aliases"] = aliases
+    get_store().add(person)
 
 def delete_person(name):
-    directory = load_directory()
-    updated = [p for p in directory if p["name"].lower() != name.lower()]
-    save_directory(updated)
\ No newline at end of file
+    get_store().delete(name)
+
+
+def import_contacts(path, file_format=None, batch_size=20000):
+    """Add the contacts of a CSV or vCard file to the directory.
+
+    The file is read one contact at a time and written in batches of
+    batch_size, each with a single write: one append to the journal of
+    directory.json, folded into the file in the background, or one SQLite
+    transaction. A contact
+    whose name, alias or email is already known (in the directory or earlier
+    in the file) is merged into that entry instead of being added twice.
+    Returns the counts of added, updated, unchanged, merged and skipped contacts.
+    """
+    file_format = file_format or detect_format(path)
+    reader = read_csv if file_format == "csv" else read_vcard
+    store = get_store()
+    stats = {"read": 0, "added": 0, "updated": 0, "unchanged": 0, "merged": 0, "skipped": 0}
+    batch = {}  # name key -> person to write
+    batch_keys = {}  # alias and email keys -> name key in batch
+    seen = set()  # name and email keys met earlier in the file
+    start = time.perf_counter()
+
+    def flush():
+        store.add_many(list(batch.values()))
+        batch.clear()
+        batch_keys.clear()
+
+    # newline="" lets the csv module handle line breaks inside quoted fields;
+    # vCard values in another charset are decoded by read_vcard
+    with open(path, "r", encoding="utf-8-sig", newline="" if file_format == "csv" else None,
+              errors=None if file_format == "csv" else "surrogateescape") as f:
+        for person in reader(f):
+            stats["read"] += 1
+            if person is None:
+                stats["skipped"] += 1
+                continue
+            key = person_key(person["name"])
+            email = person_key(person.get("email"))
+            duplicate = key in seen or (email and email in seen)
+            seen.add(key)
+            if email:
+                seen.add(email)
+
+            target = key if key in batch else batch_keys.get(key) or (batch_keys.get(email) if email else None)
+            if target:
+                existing = batch[target]
+            else:
+                existing = store.find(person["name"]) or (store.find(email) if email else None)
+            merged = person if existing is None else merge_person(existing, person)
+            if duplicate:
+                stats["merged"] += 1
+            elif existing is None:
+                stats["added"] += 1
+            elif merged == existing:
+                stats["unchanged"] += 1
+            else:
+                stats["updated"] += 1
+            if merged == existing:
+                continue
+
+            merged_key = person_key(merged["name"])
+            batch[merged_key] = merged
+            aliases, merged_email = person_keys(merged)
+            for alias in aliases + [merged_email]:
+                if alias:
+                    batch_keys[alias] = merged_key
+            if len(batch) >= batch_size:
+                flush()
+    if batch:
+        flush()
+
+    elapsed = time.perf_counter() - start
+    print(f"Imported {stats['read']} contacts from {path} in {elapsed:.2f}s "
+          f"({stats['read'] / max(elapsed, 1e-9):.0f} contacts/s): {stats['added']} added, "
+          f"{stats['updated']} updated, {stats['unchanged']} unchanged, {stats['merged']} duplicates merged, "
+          f"{stats['skipped']} skipped without a name")
+    return stats
+
+
+def export_contacts(path, file_format=None):
+    """Write the whole directory to a CSV or vCard file; returns the number of contacts"""
+    file_format = file_format or detect_format(path)
+    writer = write_csv if file_format == "csv" else write_vcard
+    start = time.perf_counter()
+    people = load_directory()
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer(f, people)
+    elapsed = time.perf_counter() - start
+    print(f"Exported {len(people)} contacts to {path} in {elapsed:.2f}s "
+          f"({len(people) / max(elapsed, 1e-9):.0f} contacts/s)")
+    return len(people)
@@ -1,6 +1,7 @@
 import tkinter as tk
-from tkinter import messagebox
-from directory import load_directory, add_person, delete_person
+from tkinter import filedialog, messagebox
+from directory import load_directory, add_person, delete_person, import_contacts, export_contacts
+from pipeline import pipeline, TkBridge
 from config_settings import DIRECTORY_WINDOW_SIZE, ADD_PERSON_WINDOW_SIZE
 
 def open_directory_window():
@@ -41,6 +42,44 @@ def open_directory_window():
 
     tk.Button(win, text="Add Person", command=add_new).pack(pady=10)
 
+    contact_files = [("Contacts", "*.csv *.vcf *.vcard"), ("CSV", "*.csv"), ("vCard", "*.vcf *.vcard")]
+    # Imports of large address books run off the Tk thread
+    bridge = TkBridge(win, pipeline)
+
+    def import_file():
+        path = filedialog.askopenfilename(parent=win, title="Import contacts", filetypes=contact_files)
+        if not path:
+            return
+
+        async def run(token):
+            return await pipeline.run_blocking(import_contacts, path, token=token)
+
+        def on_done(stats):
+            messagebox.showinfo(
+                "Import Complete",
+                f"{stats['added']} added, {stats['updated']} updated, {stats['unchanged']} unchanged, "
+                f"{stats['merged']} duplicates merged, {stats['skipped']} skipped."
+            )
+            refresh()
+
+        bridge.submit(run, on_done=on_done, on_error=lambda e: messagebox.showerror("Import Failed", str(e)))
+
+    def export_file():
+        path = filedialog.asksaveasfilename(
+            parent=win, title="Export contacts", defaultextension=".csv", filetypes=contact_files
+        )
+        if not path:
+            return
+        try:
+            count = export_contacts(path)
+        except (OSError, ValueError) as e:
+            messagebox.showerror("Export Failed", str(e))
+            return
+        messagebox.showinfo("Export Complete", f"{count} contacts exported.")
+
+    tk.Button(win, text="Import Contacts...", command=import_file).pack(pady=2)
+    tk.Button(win, text="Export Contacts...", command=export_file).pack(pady=2)
+
 def add_person_form(parent):
     """Create form to add a new person to the directory"""
     form = tk.Toplevel(parent)
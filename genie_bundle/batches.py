@@ -0,0 +1,256 @@
+"""
+Offline batch completions for the Genie server.
+A batch is a JSONL file of chat requests processed one item at a time by a
+background task. Results are appended to an output JSONL file as they
+complete and progress is saved after every item, so a batch picks up where
+it left off when the server restarts.
+"""
+
+import asyncio
+import json
+import os
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+# Batches that still have work to do
+ACTIVE_STATUSES = ("validating", "in_progress", "cancelling")
+
+
+class BatchNotFoundError(KeyError):
+    """Raised when a batch id is unknown"""
+
+
+class BatchManager:
+    """Stores batches on disk and runs them in the background, oldest first.
+
+    Every batch lives in its own directory holding input.jsonl, output.jsonl
+    and state.json. The output file is the source of truth for which items
+    are done.
+    """
+
+    def __init__(self, directory: str,
+                 complete: Callable[[Dict[str, Any]], Awaitable[Tuple[int, Dict[str, Any]]]],
+                 max_errors_reported: int = 50):
+        self.directory = directory
+        self.complete = complete
+        self.max_errors_reported = max_errors_reported
+        self._batches = {}
+        self._pending = None
+        self._runner = None
+        self._loop = None
+        os.makedirs(directory, exist_ok=True)
+
+    def start(self):
+        """Reload saved batches and resume the unfinished ones"""
+        self._loop = asyncio.get_running_loop()
+        self._pending = asyncio.Queue()
+        for batch_id in sorted(os.listdir(self.directory)):
+            state_path = self._path(batch_id, "state.json")
+            if not os.path.exists(state_path):
+                continue
+            with open(state_path, "r", encoding="utf-8") as f:
+                batch = json.load(f)
+            self._batches[batch_id] = batch
+            if batch["status"] in ACTIVE_STATUSES:
+                print(f"Resuming batch {batch_id}")
+                self._pending.put_nowait(batch_id)
+        self._runner = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """Stop the runner; an interrupted batch resumes on next start"""
+        if self._runner:
+            self._runner.cancel()
+            try:
+                await self._runner
+            except asyncio.CancelledError:
+                pass
+
+    def create(self, input_file, metadata: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Store an uploaded JSONL file as a new batch and queue it.
+
+        Safe to call from a worker thread while the event loop runs.
+        """
+        batch_id = f"batch_{uuid.uuid4().hex[:16]}"
+        os.makedirs(self._path(batch_id))
+
+        # Copy line by line so large uploads never sit in memory at once
+        total = 0
+        with open(self._path(batch_id, "input.jsonl"), "wb") as f:
+            for line in input_file:
+                if line.strip():
+                    total += 1
+                    f.write(line.rstrip(b"\r\n") + b"\n")
+
+        batch = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": "/v1/chat/completions",
+            "status": "validating",
+            "created_at": int(time.time()),
+            "in_progress_at": None,
+            "completed_at": None,
+            "cancelled_at": None,
+            "request_counts": {"total": total, "completed": 0, "failed": 0},
+            "errors": [],
+            "metadata": metadata or {}
+        }
+        self._batches[batch_id] = batch
+        self._save(batch)
+        self._loop.call_soon_threadsafe(self._pending.put_nowait, batch_id)
+        return batch
+
+    def get(self, batch_id: str) -> Dict[str, Any]:
+        if batch_id not in self._batches:
+            raise BatchNotFoundError(batch_id)
+        return self._batches[batch_id]
+
+    def list(self) -> List[Dict[str, Any]]:
+        return sorted(self._batches.values(), key=lambda batch: batch["created_at"], reverse=True)
+
+    def cancel(self, batch_id: str) -> Dict[str, Any]:
+        """Stop a batch after its current item"""
+        batch = self.get(batch_id)
+        if batch["status"] in ACTIVE_STATUSES:
+            batch["status"] = "cancelling"
+            self._save(batch)
+        return batch
+
+    def output_path(self, batch_id: str) -> str:
+        self.get(batch_id)
+        return self._path(batch_id, "output.jsonl")
+
+    async def _run(self):
+        while True:
+            batch_id = await self._pending.get()
+            try:
+                await self._process(self._batches[batch_id])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                batch = self._batches[batch_id]
+                batch["status"] = "failed"
+                batch["errors"].append({"line": None, "message": f"Batch aborted: {e}"})
+                self._save(batch)
+
+    async def _process(self, batch: Dict[str, Any]):
+        batch_id = batch["id"]
+        if batch["status"] == "cancelling":
+            self._finish(batch, "cancelled")
+            return
+
+        duplicates = self._validate(batch)
+        done, failed_lines = self._load_output(batch)
+        batch["status"] = "in_progress"
+        batch["in_progress_at"] = batch["in_progress_at"] or int(time.time())
+        self._save(batch)
+
+        with open(self._path(batch_id, "input.jsonl"), "r", encoding="utf-8") as input_file, \
+                open(self._path(batch_id, "output.jsonl"), "a", encoding="utf-8") as output_file:
+            for line_number, line in enumerate(input_file, start=1):
+                if batch["status"] == "cancelling":
+                    self._finish(batch, "cancelled")
+                    return
+
+                custom_id, body, error = self._parse_line(line, line_number)
+                if line_number in duplicates:
+                    if line_number in failed_lines:
+                        continue
+                    body, error = None, f"Duplicate custom_id {custom_id!r}"
+                elif custom_id in done:
+                    continue
+
+                if error is None:
+                    status_code, response_body = await self.complete(body)
+                    if status_code != 200:
+                        error = response_body.get("error", {}).get("message", str(response_body))
+                else:
+                    status_code, response_body = 400, None
+
+                result = {
+                    "id": f"batch_req_{uuid.uuid4().hex[:16]}",
+                    "custom_id": custom_id,
+                    "response": {"status_code": status_code, "body": response_body} if error is None else None,
+                    "error": {"message": error, "line": line_number} if error is not None else None
+                }
+                output_file.write(json.dumps(result, ensure_ascii=False) + "\n")
+                output_file.flush()
+                done.add(custom_id)
+
+                if error is None:
+                    batch["request_counts"]["completed"] += 1
+                else:
+                    batch["request_counts"]["failed"] += 1
+                    if len(batch["errors"]) < self.max_errors_reported:
+                        batch["errors"].append({"line": line_number, "custom_id": custom_id, "message": error})
+                self._save(batch)
+
+        self._finish(batch, "completed")
+
+    def _validate(self, batch: Dict[str, Any]) -> set:
+        """Line numbers whose custom_id repeats an earlier line's; they fail with a 400"""
+        seen = set()
+        duplicates = set()
+        with open(self._path(batch["id"], "input.jsonl"), "r", encoding="utf-8") as input_file:
+            for line_number, line in enumerate(input_file, start=1):
+                custom_id = self._parse_line(line, line_number)[0]
+                if custom_id in seen:
+                    duplicates.add(line_number)
+                seen.add(custom_id)
+        return duplicates
+
+    def _parse_line(self, line: str, line_number: int):
+        """custom_id, request body and parse error for one input line"""
+        custom_id = f"request-{line_number}"
+        try:
+            item = json.loads(line)
+        except ValueError as e:
+            return custom_id, None, f"Invalid JSON: {e}"
+        if not isinstance(item, dict):
+            return custom_id, None, "Each line must be a JSON object"
+        custom_id = str(item.get("custom_id", custom_id))
+        # Accept OpenAI batch lines as well as bare chat completion requests
+        body = item.get("body", item)
+        if not isinstance(body, dict) or "messages" not in body:
+            return custom_id, None, "Request body must contain messages"
+        return custom_id, body, None
+
+    def _load_output(self, batch: Dict[str, Any]) -> Tuple[set, set]:
+        """custom_ids and failed line numbers already in the output; recounts progress and drops a torn last line"""
+        output_path = self._path(batch["id"], "output.jsonl")
+        if not os.path.exists(output_path):
+            return set(), set()
+        with open(output_path, "rb") as f:
+            data = f.read()
+        complete = data[:data.rfind(b"\n") + 1]
+        if len(complete) != len(data):
+            with open(output_path, "wb") as f:
+                f.write(complete)
+
+        done = set()
+        failed_lines = set()
+        counts = {"completed": 0, "failed": 0}
+        for line in complete.decode("utf-8").splitlines():
+            result = json.loads(line)
+            done.add(result["custom_id"])
+            if result["error"]:
+                failed_lines.add(result["error"].get("line"))
+            counts["failed" if result["error"] else "completed"] += 1
+        batch["request_counts"].update(counts)
+        return done, failed_lines
+
+    def _finish(self, batch: Dict[str, Any], status: str):
+        batch["status"] = status
+        batch[f"{status}_at"] = int(time.time())
+        self._save(batch)
+
+    def _save(self, batch: Dict[str, Any]):
+        """Write state.json atomically"""
+        state_path = self._path(batch["id"], "state.json")
+        tmp_path = state_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(batch, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, state_path)
+
+    def _path(self, batch_id: str, *parts: str) -> str:
+        return os.path.join(self.directory, batch_id, *parts)
@@ -6,7 +6,7 @@ This script demonstrates how to use the API with both raw requests and OpenAI li
 
 import json
 import requests
-from typing import List, Dict
+from typing import List, Dict, Iterator
 
 class GenieOpenAIClient:
     """Simple client for the Genie OpenAI-compatible API"""
@@ -36,6 +36,31 @@ class GenieOpenAIClient:
         response.raise_for_status()
         return response.json()
     
+    def chat_completion_stream(self, messages: List[Dict], **kwargs) -> Iterator[str]:
+        """Create a streamed chat completion and yield content deltas"""
+        data = {
+            "model": kwargs.get("model", "genie-llama-3.2-3b"),
+            "messages": messages,
+            "temperature": kwargs.get("temperature", 0.8),
+            "max_tokens": kwargs.get("max_tokens", 1024),
+            "stream": True
+        }
+        
+        with requests.post(f"{self.base_url}/v1/chat/completions", json=data, stream=True) as response:
+            response.raise_for_status()
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data: "):
+                    continue
+                payload = line[len("data: "):]
+                if payload == "[DONE]":
+                    break
+                chunk = json.loads(payload)
+                if "error" in chunk:
+                    raise RuntimeError(chunk["error"]["message"])
+                content = chunk["choices"][0]["delta"].get("content")
+                if content:
+                    yield content
+    
     def health_check(self) -> Dict:
         """Check server health"""
         response = requests.get(f"{self.base_url}/health")
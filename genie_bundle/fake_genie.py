@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Scripted stand-in for genie-t2t-run.exe.
+Mimics the output format of the real binary so the server can be exercised
+on machines without an NPU. Point the worker command at it instead of
+genie_worker.py, e.g.
+"command": ["{python}", "fake_genie.py", "-c", "{config}", "--worker"]
+"""
+
+import argparse
+import json
+import sys
+import time
+
+
+def answer(prompt: str, token_delay: float):
+    """Write one [BEGIN]: ... [END] block, token by token"""
+    reply = "This is a scripted Genie reply to a %d character prompt." % len(prompt)
+    sys.stdout.write("[PROMPT]: %s\n" % prompt.replace("\n", " "))
+    sys.stdout.write("[BEGIN]:")
+    sys.stdout.flush()
+    for word in reply.split(" "):
+        sys.stdout.write(" " + word)
+        sys.stdout.flush()
+        time.sleep(token_delay)
+    sys.stdout.write("[END]\n")
+    sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Genie executable")
+    parser.add_argument("-c", "--config", help="Genie config (ignored)")
+    parser.add_argument("-p", "--prompt", help="Single prompt to answer")
+    parser.add_argument("--worker", action="store_true", help="Serve prompts from stdin")
+    parser.add_argument("--load-time", type=float, default=0.5, help="Simulated model load time")
+    parser.add_argument("--token-delay", type=float, default=0.02, help="Delay between tokens")
+    parser.add_argument("--crash-after", type=int, default=0, help="Exit after N prompts (0 = never)")
+    args = parser.parse_args()
+
+    time.sleep(args.load_time)
+
+    if not args.worker:
+        answer(args.prompt or "", args.token_delay)
+        return
+
+    print("[READY]", flush=True)
+    served = 0
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        answer(json.loads(line), args.token_delay)
+        served += 1
+        if args.crash_after and served >= args.crash_after:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
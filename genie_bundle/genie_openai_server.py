@@ -9,16 +9,27 @@ import json
 import os
 
 import threading
+import time
 import uuid
 from datetime import datetime
-from typing import List
+from typing import Any, Callable
 import tempfile
 import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, HTTPException, File, Form, Request, UploadFile
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse, PlainTextResponse, FileResponse, JSONResponse
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
 import uvicorn
 
+from scheduler import GenerationQueue, QueueFullError
+from response_cache import ResponseCache, SingleFlight, cache_key
+from metrics import GenieMetrics
+from model_registry import ModelRegistry, UnknownModelError
+from batches import BatchManager, BatchNotFoundError
+
 
 
 
@@ -26,68 +37,379 @@ import uvicorn
 # Initialize FastAPI app
 app = FastAPI(title="Genie OpenAI Compatible API", version="1.0.0")
 
-# Global Genie client
-genie_client = None
+# Genie models declared in server_config.json
+model_registry = None
+
+# Admission queue and the threads that run blocking generations
+generation_queue = None
+generation_executor = None
+
+# Completed responses and identical requests currently being generated
+response_cache = None
+single_flight = SingleFlight()
+
+# Per-stage latency histograms and counters served on /metrics
+metrics = GenieMetrics()
+
+# Background runner for offline JSONL batches
+batch_manager = None
+
+# Seconds between checks for a client that went away mid-generation
+DISCONNECT_POLL_INTERVAL = 0.25
+
+# Startup warm-up of the default model; the server is ready once it is done
+warmup_task = None
+warmup_state = {"status": "pending", "model": None, "seconds": None, "error": None}
+
+def load_server_config():
+    """Load server_config.json from the script directory"""
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    config_path = os.path.join(script_dir, "server_config.json")
+    if not os.path.exists(config_path):
+        return {}
+    with open(config_path, "r") as f:
+        return json.load(f)
+
+server_config = load_server_config()
 
 def initialize_genie():
-    """Initialize the Genie client"""
-    global genie_client
+    """Initialize the Genie model registry"""
+    global model_registry
     
     # Get the directory of this script
     script_dir = os.path.dirname(os.path.abspath(__file__))
     
-    # Paths to Genie executable and config
-    genie_exe = os.path.join(script_dir, "genie-t2t-run.exe")
-    config_file = os.path.join(script_dir, "genie_config.json")
+    # Models are loaded lazily on their first request
+    model_registry = ModelRegistry(script_dir, server_config.get("genie", {}))
+    model_registry.validate()
+
+def initialize_queue():
+    """Create the admission queue and generation threads from server_config.json"""
+    global generation_queue, generation_executor
+    
+    queue_config = server_config.get("queue", {})
+    max_concurrency = queue_config.get("max_concurrency", 1)
+    generation_queue = GenerationQueue(
+        max_concurrency=max_concurrency,
+        max_queue_size=queue_config.get("max_queue_size", 8),
+        retry_after=queue_config.get("retry_after", 10)
+    )
+    generation_executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="genie")
+
+def initialize_cache():
+    """Create the response cache from server_config.json"""
+    global response_cache
+    
+    cache_config = server_config.get("cache", {})
+    if not cache_config.get("enabled", True):
+        return
+    
+    persist_path = cache_config.get("persist_path")
+    if persist_path:
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        persist_path = os.path.join(script_dir, persist_path)
+    
+    response_cache = ResponseCache(
+        max_entries=cache_config.get("max_entries", 256),
+        ttl=cache_config.get("ttl_seconds", 3600),
+        persist_path=persist_path
+    )
+    response_cache.load()
+
+def initialize_batches():
+    """Create the batch manager and resume unfinished batches"""
+    global batch_manager
+    
+    batch_config = server_config.get("batches", {})
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    batch_manager = BatchManager(
+        os.path.join(script_dir, batch_config.get("directory", "batches")),
+        complete=run_batch_item,
+        max_errors_reported=batch_config.get("max_errors_reported", 50)
+    )
+    batch_manager.start()
+
+async def warm_up():
+    """Load the default model into its resident worker so real requests start warm"""
+    warmup_config = server_config.get("warmup", {})
+    if not warmup_config.get("enabled", True):
+        warmup_state["status"] = "disabled"
+        return
+    
+    model = model_registry.default_model
+    if model_registry.client(model).worker is None:
+        # One-shot runs reload the model for every request, nothing can stay warm
+        warmup_state.update(status="not_applicable", model=model)
+        return
     
-    if not os.path.exists(genie_exe):
-        raise FileNotFoundError(f"Genie executable not found: {genie_exe}")
+    warmup_state.update(status="running", model=model)
+    print(f"Warming up Genie model {model}")
+    start = time.perf_counter()
     
-    if not os.path.exists(config_file):
-        raise FileNotFoundError(f"Genie config not found: {config_file}")
+    def load():
+        # Genie cannot cap a generation's length, so the warm-up generates
+        # nothing: loading the worker is the expensive part
+        with model_registry.lease(model):
+            pass
     
-    genie_client = GenieClient(genie_exe, config_file)
+    try:
+        await asyncio.wait_for(
+            asyncio.get_running_loop().run_in_executor(generation_executor, load),
+            timeout=warmup_config.get("timeout", 600)
+        )
+    except asyncio.TimeoutError:
+        warmup_state.update(status="failed", error="Warm-up timed out")
+    except Exception as e:
+        warmup_state.update(status="failed", error=str(e))
+    else:
+        warmup_state["status"] = "ready"
+    warmup_state["seconds"] = round(time.perf_counter() - start, 3)
+    print(f"Genie warm-up {warmup_state['status']} after {warmup_state['seconds']}s")
+
+def is_ready() -> bool:
+    """True once the default model has warmed up, or warm-up is disabled or not applicable"""
+    return warmup_state["status"] in ("ready", "disabled", "not_applicable")
 
 @app.on_event("startup")
 async def startup_event():
     """Initialize Genie on startup"""
+    global warmup_task
     initialize_genie()
+    initialize_queue()
+    initialize_cache()
+    initialize_batches()
+    # In the background so liveness answers while the model loads
+    warmup_task = asyncio.ensure_future(warm_up())
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """Clean up on shutdown"""
-    if genie_client:
-        genie_client.close()
+    if warmup_task:
+        warmup_task.cancel()
+    if model_registry:
+        model_registry.close()
+    if generation_executor:
+        generation_executor.shutdown(wait=False)
+    if response_cache:
+        response_cache.save()
+    if batch_manager:
+        await batch_manager.stop()
+
+def queue_full_exception(error: QueueFullError) -> HTTPException:
+    """429 answer telling the client when to come back"""
+    return HTTPException(
+        status_code=429,
+        detail="Too many pending completions, retry later",
+        headers={"Retry-After": str(error.retry_after)}
+    )
 
 @app.get("/v1/models")
 async def list_models():
     """List available models"""
+    created = int(datetime.now().timestamp())
     return {
         "object": "list",
         "data": [
-            Model(
-                id="genie-llama-3.2-3b",
-                created=int(datetime.now().timestamp()),
-                owned_by="genie"
-            )
+            Model(id=model_id, created=created, owned_by="genie")
+            for model_id in (model_registry.model_ids() if model_registry else [])
         ]
     }
 
-@app.post("/v1/chat/completions")
-async def create_chat_completion(request: ChatCompletionRequest):
-    """Create a chat completion"""
-    if not genie_client:
-        raise HTTPException(status_code=500, detail="Genie client not initialized")
+async def watch_disconnect(http_request: Request, on_disconnect: Callable[[], Any]):
+    """Call on_disconnect once the client has closed the connection"""
+    while not await http_request.is_disconnected():
+        await asyncio.sleep(DISCONNECT_POLL_INTERVAL)
+    on_disconnect()
+
+def stream_chat_completion(request: ChatCompletionRequest, cancel: threading.Event):
+    """Yield OpenAI-style Server-Sent Events as Genie writes tokens"""
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:8]}"
+    created = int(datetime.now().timestamp())
+    
+    def sse(delta, finish_reason=None):
+        chunk = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": request.model,
+            "choices": [
+                {
+                    "index": 0,
+                    "delta": delta,
+                    "finish_reason": finish_reason
+                }
+            ]
+        }
+        return f"data: {json.dumps(chunk)}\n\n"
     
+    yield sse({"role": "assistant"})
+    timings = {}
+    content = []
     try:
-        # Generate response using Genie
-        response_content = genie_client.generate_response(
+        with model_registry.lease(request.model) as genie_client:
+            for token in genie_client.stream_response(
+                request.messages,
+                timings=timings,
+                cancel=cancel,
+                temperature=request.temperature,
+                max_tokens=request.max_tokens,
+                top_p=request.top_p,
+                top_k=request.top_k
+            ):
+                content.append(token)
+                yield sse({"content": token})
+    except GenieCancelledError:
+        # Nobody is listening any more
+        metrics.cancelled.inc(request.model)
+        return
+    except Exception as e:
+        record_failure(request.model, e)
+        # Headers are already sent, report the failure in-band
+        error = {"error": {"message": f"Error generating completion: {str(e)}", "type": "server_error"}}
+        yield f"data: {json.dumps(error)}\n\n"
+    else:
+        metrics.record_generation(request.model, timings, genie_client.count_tokens("".join(content)))
+        yield sse({}, finish_reason="stop")
+    yield "data: [DONE]\n\n"
+
+async def queued_stream(request: ChatCompletionRequest, http_request: Request):
+    """Run a streamed completion once a queue slot frees up"""
+    try:
+        async with generation_queue.slot() as wait:
+            metrics.queue_wait.observe(wait, request.model)
+            # The thread pulling tokens cannot be interrupted, so a watcher
+            # stops Genie itself when the client goes away
+            cancel = threading.Event()
+            watcher = asyncio.ensure_future(watch_disconnect(http_request, cancel.set))
+            try:
+                async for event in iterate_in_threadpool(stream_chat_completion(request, cancel)):
+                    yield event
+            finally:
+                watcher.cancel()
+    except QueueFullError:
+        # Lost the race for the last place in line after the headers went out
+        error = {"error": {"message": "Too many pending completions, retry later", "type": "rate_limit_error"}}
+        yield f"data: {json.dumps(error)}\n\n"
+        yield "data: [DONE]\n\n"
+
+def completion_cache_key(request: ChatCompletionRequest, genie_client: GenieClient):
+    """Cache key for deterministic requests, None when the cache must be bypassed"""
+    if not response_cache:
+        return None
+    # The request's sampler settings never reach Genie, only its own config decides
+    if not genie_client.reproducible:
+        response_cache.bypassed += 1
+        return None
+    return cache_key(request.model, [{"role": msg.role, "content": msg.content} for msg in request.messages])
+
+def record_failure(model: str, error: Exception):
+    """Count a failed generation, separating timeouts"""
+    if isinstance(error, GenieTimeoutError):
+        metrics.timeouts.inc(model)
+    metrics.errors.inc(model)
+
+def run_generation(request: ChatCompletionRequest, timings: dict, cancel: threading.Event) -> str:
+    """Blocking generation on the requested model, loading it if needed"""
+    with model_registry.lease(request.model) as genie_client:
+        return genie_client.generate_response(
             request.messages,
+            timings=timings,
+            cancel=cancel,
             temperature=request.temperature,
             max_tokens=request.max_tokens,
             top_p=request.top_p,
             top_k=request.top_k
         )
+
+async def generate_completion(request: ChatCompletionRequest, genie_client: GenieClient) -> str:
+    """Wait for a queue slot, then generate off the event loop"""
+    timings = {}
+    cancel = threading.Event()
+    async with generation_queue.slot() as wait:
+        metrics.queue_wait.observe(wait, request.model)
+        future = asyncio.get_running_loop().run_in_executor(
+            generation_executor,
+            functools.partial(run_generation, request, timings, cancel)
+        )
+        try:
+            content = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # Stop Genie and keep the slot until it has actually let go
+            cancel.set()
+            await asyncio.gather(future, return_exceptions=True)
+            raise
+    metrics.record_generation(request.model, timings, genie_client.count_tokens(content))
+    return content
+
+def prepare_request(request: ChatCompletionRequest):
+    """Resolve the model and fit the prompt; returns the client and prompt tokens"""
+    if not model_registry:
+        raise HTTPException(status_code=500, detail="Genie client not initialized")
+    
+    try:
+        genie_client = model_registry.client(request.model)
+    except UnknownModelError:
+        raise HTTPException(status_code=404, detail=f"The model `{request.model}` does not exist")
+    
+    metrics.requests.inc(request.model)
+    
+    # Trim or reject oversized prompts before spending a Genie run on them
+    try:
+        request.messages, prompt_tokens = genie_client.fit_to_context(
+            request.messages,
+            max_tokens=request.max_tokens,
+            truncate=server_config.get("api", {}).get("context_overflow", "truncate") == "truncate"
+        )
+    except ContextOverflowError as e:
+        raise HTTPException(status_code=400, detail=f"context_length_exceeded: {str(e)}")
+    
+    return genie_client, prompt_tokens
+
+@app.post("/v1/chat/completions")
+async def create_chat_completion(request: ChatCompletionRequest, http_request: Request):
+    """Create a chat completion"""
+    if request.stream:
+        # Refused before it is counted or tokenized
+        if not server_config.get("api", {}).get("enable_streaming", False):
+            raise HTTPException(status_code=501, detail="Streaming is disabled in server_config.json")
+        prepare_request(request)
+        if generation_queue.is_full():
+            raise queue_full_exception(QueueFullError(generation_queue.retry_after))
+        return StreamingResponse(
+            queued_stream(request, http_request),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+    
+    # Abandon the generation, and free the NPU, if the client hangs up
+    completion = asyncio.ensure_future(complete_chat(request))
+    watcher = asyncio.ensure_future(watch_disconnect(http_request, completion.cancel))
+    try:
+        return await completion
+    except asyncio.CancelledError:
+        if not completion.cancelled():
+            raise
+        metrics.cancelled.inc(request.model)
+        raise HTTPException(status_code=499, detail="Client closed request")
+    finally:
+        watcher.cancel()
+
+async def complete_chat(request: ChatCompletionRequest) -> ChatCompletionResponse:
+    """Non-streamed completion, shared by the chat and batch endpoints"""
+    genie_client, prompt_tokens = prepare_request(request)
+    
+    try:
+        key = completion_cache_key(request, genie_client)
+        response_content = response_cache.get(key) if key else None
+        if response_content is None:
+            if key:
+                # Identical requests arriving together share one generation
+                response_content = await single_flight.run(key, lambda: generate_completion(request, genie_client))
+                response_cache.put(key, response_content)
+            else:
+                response_content = await generate_completion(request, genie_client)
+        
+        completion_tokens = genie_client.count_tokens(response_content)
         
         # Create OpenAI-compatible response
         response = ChatCompletionResponse(
@@ -105,25 +427,115 @@ async def create_chat_completion(request: ChatCompletionRequest):
                 }
             ],
             usage={
-                "prompt_tokens": sum(len(msg.content.split()) for msg in request.messages),
-                "completion_tokens": len(response_content.split()),
-                "total_tokens": sum(len(msg.content.split()) for msg in request.messages) + len(response_content.split())
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens
             }
         )
         
-        if request.stream:
-            # TODO: Implement streaming response
-            raise HTTPException(status_code=501, detail="Streaming not yet implemented")
-        
         return response
         
+    except QueueFullError as e:
+        raise queue_full_exception(e)
     except Exception as e:
+        record_failure(request.model, e)
         raise HTTPException(status_code=500, detail=f"Error generating completion: {str(e)}")
 
+async def run_batch_item(body: dict):
+    """Run one batch line through the regular completion path"""
+    try:
+        request = ChatCompletionRequest(**dict(body, stream=False))
+    except Exception as e:
+        return 400, {"error": {"message": f"Invalid request: {str(e)}"}}
+    
+    while True:
+        try:
+            response = await complete_chat(request)
+            return 200, jsonable_encoder(response)
+        except HTTPException as e:
+            if e.status_code == 429:
+                # Interactive traffic fills the queue, wait for our turn
+                await asyncio.sleep(generation_queue.retry_after)
+                continue
+            return e.status_code, {"error": {"message": e.detail}}
+
+@app.post("/v1/batches")
+async def create_batch(file: UploadFile = File(...), metadata: str = Form(None)):
+    """Queue a JSONL file of chat completion requests"""
+    try:
+        metadata = json.loads(metadata) if metadata else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="metadata must be a JSON object")
+    return await run_in_threadpool(batch_manager.create, file.file, metadata)
+
+@app.get("/v1/batches")
+async def list_batches():
+    """List batches, newest first"""
+    return {"object": "list", "data": batch_manager.list()}
+
+@app.get("/v1/batches/{batch_id}")
+async def retrieve_batch(batch_id: str):
+    """Batch status, progress counts and per-item errors"""
+    try:
+        return batch_manager.get(batch_id)
+    except BatchNotFoundError:
+        raise HTTPException(status_code=404, detail=f"Batch {batch_id} not found")
+
+@app.post("/v1/batches/{batch_id}/cancel")
+async def cancel_batch(batch_id: str):
+    """Stop a batch after its current item"""
+    try:
+        return batch_manager.cancel(batch_id)
+    except BatchNotFoundError:
+        raise HTTPException(status_code=404, detail=f"Batch {batch_id} not found")
+
+@app.get("/v1/batches/{batch_id}/output")
+async def batch_output(batch_id: str):
+    """Results written so far, one JSON object per line"""
+    try:
+        output_path = batch_manager.output_path(batch_id)
+    except BatchNotFoundError:
+        raise HTTPException(status_code=404, detail=f"Batch {batch_id} not found")
+    if not os.path.exists(output_path):
+        return PlainTextResponse("", media_type="application/jsonl")
+    return FileResponse(output_path, media_type="application/jsonl")
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    return {"status": "healthy", "model": "genie-llama-3.2-3b"}
+    if is_ready():
+        status = "healthy"
+    elif warmup_state["status"] == "failed":
+        status = "unhealthy"
+    else:
+        status = "warming_up"
+    return {
+        "status": status,
+        "ready": is_ready(),
+        "warmup": warmup_state,
+        "model": model_registry.default_model if model_registry else None,
+        "models": model_registry.stats() if model_registry else None,
+        "queue": generation_queue.stats() if generation_queue else None,
+        "cache": dict(response_cache.stats(), coalesced=single_flight.coalesced) if response_cache else None
+    }
+
+@app.get("/health/live")
+async def liveness():
+    """Liveness probe: the server is up and its event loop responds"""
+    return {"status": "alive"}
+
+@app.get("/health/ready")
+async def readiness():
+    """Readiness probe: 503 until the default model has warmed up"""
+    content = {"ready": is_ready(), "warmup": warmup_state}
+    if not content["ready"]:
+        return JSONResponse(status_code=503, content=content)
+    return content
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus metrics"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 @app.get("/")
 async def root():
@@ -134,7 +546,11 @@ async def root():
         "endpoints": {
             "models": "/v1/models",
             "chat_completions": "/v1/chat/completions",
-            "health": "/health"
+            "batches": "/v1/batches",
+            "health": "/health",
+            "liveness": "/health/live",
+            "readiness": "/health/ready",
+            "metrics": "/metrics"
         }
     }
 
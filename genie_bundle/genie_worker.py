@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Resident Genie worker built on the Genie dialog API.
+Loads the model once through Genie.dll (libGenie.so on Linux), the library
+genie-t2t-run.exe itself runs on, and answers prompts without reloading the
+context binaries. Speaks the protocol of models.GenieWorker: [READY] once
+the model is loaded, then one JSON-encoded prompt per line on stdin and one
+[BEGIN]: ... [END] block per answer on stdout.
+"""
+
+import argparse
+import ctypes
+import json
+import os
+import sys
+
+GENIE_STATUS_SUCCESS = 0
+# GenieDialog_SentenceCode_t: the whole prompt is sent in one query
+GENIE_DIALOG_SENTENCE_COMPLETE = 0
+
+# void (*GenieDialog_QueryCallback_t)(const char* response, GenieDialog_SentenceCode_t code, const void* userData)
+QUERY_CALLBACK = ctypes.CFUNCTYPE(None, ctypes.c_char_p, ctypes.c_int, ctypes.c_void_p)
+
+
+class GenieError(RuntimeError):
+    """Raised when a Genie API call returns an error status"""
+
+
+def default_library() -> str:
+    """The Genie library next to this script, where genie-t2t-run.exe finds it too"""
+    name = "Genie.dll" if os.name == "nt" else "libGenie.so"
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), name)
+
+
+class GenieDialog:
+    """A Genie dialog holding the model in memory between queries"""
+
+    def __init__(self, config_path: str, library: str):
+        library_dir = os.path.dirname(os.path.abspath(library))
+        if hasattr(os, "add_dll_directory"):
+            # Genie.dll loads the QNN backend libraries from its own directory
+            os.add_dll_directory(library_dir)
+        self._lib = ctypes.CDLL(library)
+        self._declare()
+        with open(config_path, "r", encoding="utf-8") as f:
+            config = f.read()
+        self._config = ctypes.c_void_p()
+        self._dialog = ctypes.c_void_p()
+        self._check(self._lib.GenieDialogConfig_createFromJson(config.encode("utf-8"), ctypes.byref(self._config)),
+                    "GenieDialogConfig_createFromJson")
+        self._check(self._lib.GenieDialog_create(self._config, ctypes.byref(self._dialog)), "GenieDialog_create")
+
+    def _declare(self):
+        lib = self._lib
+        handle, handle_out = ctypes.c_void_p, ctypes.POINTER(ctypes.c_void_p)
+        signatures = {
+            "GenieDialogConfig_createFromJson": [ctypes.c_char_p, handle_out],
+            "GenieDialogConfig_free": [handle],
+            "GenieDialog_create": [handle, handle_out],
+            "GenieDialog_query": [handle, ctypes.c_char_p, ctypes.c_int, QUERY_CALLBACK, ctypes.c_void_p],
+            "GenieDialog_reset": [handle],
+            "GenieDialog_free": [handle],
+        }
+        for name, argtypes in signatures.items():
+            function = getattr(lib, name)
+            function.argtypes = argtypes
+            function.restype = ctypes.c_int32  # Genie_Status_t
+
+    @staticmethod
+    def _check(status: int, call: str):
+        # Negative statuses are errors, positive ones warnings
+        if status < GENIE_STATUS_SUCCESS:
+            raise GenieError(f"{call} failed with status {status}")
+
+    def query(self, prompt: str, on_text):
+        """Answer prompt as a new conversation, calling on_text(bytes) for every piece"""
+        # Every prompt carries the whole conversation, so nothing is kept from the last one
+        self._check(self._lib.GenieDialog_reset(self._dialog), "GenieDialog_reset")
+
+        def callback(response, code, user_data):
+            if response:
+                on_text(response)
+
+        # Referenced until the query returns, or ctypes frees the trampoline
+        c_callback = QUERY_CALLBACK(callback)
+        self._check(
+            self._lib.GenieDialog_query(self._dialog, prompt.encode("utf-8"), GENIE_DIALOG_SENTENCE_COMPLETE,
+                                        c_callback, None),
+            "GenieDialog_query"
+        )
+
+    def close(self):
+        if self._dialog:
+            self._lib.GenieDialog_free(self._dialog)
+            self._dialog = ctypes.c_void_p()
+        if self._config:
+            self._lib.GenieDialogConfig_free(self._config)
+            self._config = ctypes.c_void_p()
+
+
+def serve(dialog, lines, out):
+    """Answer the JSON-encoded prompts of lines on the binary stream out"""
+    def write(data: bytes):
+        out.write(data)
+        out.flush()
+
+    write(b"[READY]\n")
+    for line in lines:
+        if not line.strip():
+            continue
+        write(b"[BEGIN]: ")
+        # Pieces are raw UTF-8 bytes; the server decodes them incrementally
+        dialog.query(json.loads(line), write)
+        write(b"[END]\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Resident Genie worker")
+    parser.add_argument("-c", "--config", required=True, help="Genie config")
+    parser.add_argument("--library", default=default_library(), help="Genie.dll or libGenie.so")
+    args = parser.parse_args()
+
+    try:
+        dialog = GenieDialog(args.config, args.library)
+    except (OSError, GenieError) as e:
+        print(f"[ERROR] Could not load the model: {e}", file=sys.stderr, flush=True)
+        sys.exit(1)
+    try:
+        serve(dialog, sys.stdin.buffer, sys.stdout.buffer)
+    except GenieError as e:
+        # The server restarts the worker when it exits
+        print(f"[ERROR] {e}", file=sys.stderr, flush=True)
+        sys.exit(1)
+    finally:
+        dialog.close()
+
+
+if __name__ == "__main__":
+    main()
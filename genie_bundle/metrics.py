@@ -0,0 +1,159 @@
+"""
+Minimal Prometheus-style metrics for the Genie server.
+Counters and histograms keep plain per-label totals so recording a value
+costs a dict lookup, a bisect and a few additions; the text exposition
+format is only built when /metrics is scraped.
+"""
+
+import threading
+from bisect import bisect_left
+from typing import Dict, List, Sequence, Tuple
+
+# Seconds, from a cache hit up to the 10 minute Genie timeout
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+RATE_BUCKETS = (1.0, 2.0, 5.0, 10.0, 15.0, 20.0, 30.0, 50.0, 100.0)
+
+
+def _format_labels(names: Sequence[str], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic total per label set"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    """Bucketed distribution per label set"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # labels -> [per-bucket counts (+Inf last), sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((labels, (list(s[0]), s[1], s[2])) for labels, s in self._series.items())
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else _format_value(bound)
+                bucket_labels = _format_labels(self.labelnames, labels, 'le="%s"' % le)
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """Collection of metrics rendered together for /metrics"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Prometheus text exposition format (version 0.0.4)"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class GenieMetrics:
+    """The metrics exposed by the Genie server, all labelled by model"""
+
+    def __init__(self):
+        self.registry = MetricsRegistry()
+        labels = ("model",)
+        self.requests = self.registry.counter(
+            "genie_requests_total", "Chat completion requests received", labels)
+        self.errors = self.registry.counter(
+            "genie_errors_total", "Chat completions that failed", labels)
+        self.timeouts = self.registry.counter(
+            "genie_timeouts_total", "Chat completions that hit the Genie timeout", labels)
+        self.cancelled = self.registry.counter(
+            "genie_cancelled_total", "Chat completions stopped because the client disconnected", labels)
+        self.queue_wait = self.registry.histogram(
+            "genie_queue_wait_seconds", "Time spent waiting for a generation slot", labels)
+        self.time_to_first_token = self.registry.histogram(
+            "genie_time_to_first_token_seconds", "Time from generation start to the first answer token", labels)
+        self.generation = self.registry.histogram(
+            "genie_generation_seconds", "Total Genie generation time", labels)
+        self.tokens_per_second = self.registry.histogram(
+            "genie_tokens_per_second", "Completion tokens generated per second", labels, RATE_BUCKETS)
+        self.spawn = self.registry.histogram(
+            "genie_subprocess_spawn_seconds", "Time to launch the Genie process", labels)
+        self.parse = self.registry.histogram(
+            "genie_output_parse_seconds", "Time to extract the answer from Genie output", labels)
+
+    def record_generation(self, model: str, timings: Dict[str, float], completion_tokens: int):
+        """Record the per-stage timings filled in by GenieClient"""
+        if "spawn" in timings:
+            self.spawn.observe(timings["spawn"], model)
+        if "first_token" in timings:
+            self.time_to_first_token.observe(timings["first_token"], model)
+        if "parse" in timings:
+            self.parse.observe(timings["parse"], model)
+        if "total" in timings:
+            self.generation.observe(timings["total"], model)
+            if timings["total"] > 0 and completion_tokens:
+                self.tokens_per_second.observe(completion_tokens / timings["total"], model)
+
+    def render(self) -> str:
+        return self.registry.render()
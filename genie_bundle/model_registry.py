@@ -0,0 +1,179 @@
+"""
+Registry of the Genie models declared in server_config.json.
+Each model gets its own GenieClient; resident workers are loaded on first
+use and the least recently used idle ones are unloaded to stay within the
+configured instance and memory budgets.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, List
+
+from models import GenieClient
+
+
+class UnknownModelError(KeyError):
+    """Raised when a request names a model that is not declared"""
+
+
+class ModelRegistry:
+    """Lazily created Genie clients with LRU eviction of resident models"""
+
+    def __init__(self, base_dir: str, genie_config: Dict[str, Any]):
+        self.base_dir = base_dir
+        self.executable = os.path.join(base_dir, genie_config.get("executable", "genie-t2t-run.exe"))
+        self.default_model = genie_config.get("default_model", "genie-llama-3.2-3b")
+        self.max_resident_models = genie_config.get("max_resident_models", 1)
+        self.memory_budget_mb = genie_config.get("memory_budget_mb")
+        self.worker_defaults = genie_config.get("worker") or {}
+
+        # A config without a models table serves its single Genie config
+        self.specs = genie_config.get("models") or {
+            self.default_model: {"config": genie_config.get("config", "genie_config.json")}
+        }
+
+        self._clients = {}
+        self._resident = OrderedDict()  # model id -> None, least recently used first
+        self._in_use = {}
+        self._unloading = {}  # model id -> event set once its worker is closed
+        self._lock = threading.Lock()
+        self.load_count = 0
+        self.eviction_count = 0
+
+    def validate(self):
+        """Check that the executable and every model config exist, and that enabled workers have a command"""
+        if not os.path.exists(self.executable):
+            raise FileNotFoundError(f"Genie executable not found: {self.executable}")
+        for model_id in self.specs:
+            config_file = self._config_path(model_id)
+            if not os.path.exists(config_file):
+                raise FileNotFoundError(f"Genie config for {model_id} not found: {config_file}")
+            worker_options = self._worker_options(model_id)
+            if worker_options.get("enabled") and not worker_options.get("command"):
+                raise ValueError(
+                    f"genie.worker.command is required for {model_id} when the worker is enabled: "
+                    "genie-t2t-run.exe has no worker mode, use genie_worker.py or another wrapper "
+                    "that speaks the worker protocol"
+                )
+
+    def model_ids(self) -> List[str]:
+        return list(self.specs)
+
+    def client(self, model_id: str) -> GenieClient:
+        """The client for a model, created on first use without loading it"""
+        with self._lock:
+            return self._client_locked(model_id)
+
+    @contextmanager
+    def lease(self, model_id: str):
+        """Load a model for the duration of a generation.
+
+        Idle resident models are unloaded, least recently used first, until
+        the new one fits the budget. Models in use are never evicted, and a
+        model being unloaded is only leased again once its worker is closed.
+        """
+        while True:
+            with self._lock:
+                unloading = self._unloading.get(model_id)
+                if unloading is None:
+                    client = self._client_locked(model_id)
+                    self._in_use[model_id] = self._in_use.get(model_id, 0) + 1
+                    victims = []
+                    if client.worker is not None:
+                        self._resident.pop(model_id, None)
+                        victims = self._pick_victims(model_id)
+                        self._resident[model_id] = None
+                    for victim in victims:
+                        self._unloading[victim] = threading.Event()
+                    break
+            unloading.wait()
+        try:
+            try:
+                for victim in victims:
+                    print(f"Unloading Genie model {victim} to make room for {model_id}")
+                    self._clients[victim].close()
+            finally:
+                with self._lock:
+                    for victim in victims:
+                        self._unloading.pop(victim).set()
+            if client.worker is not None and not client.loaded:
+                self.load_count += 1
+                client.load()
+            yield client
+        finally:
+            with self._lock:
+                self._in_use[model_id] -= 1
+
+    def resident(self) -> List[str]:
+        """Models whose worker is currently holding them in memory"""
+        with self._lock:
+            return [model_id for model_id in self._resident if self._clients[model_id].loaded]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "models": self.model_ids(),
+            "resident": self.resident(),
+            "max_resident_models": self.max_resident_models,
+            "memory_budget_mb": self.memory_budget_mb,
+            "loads": self.load_count,
+            "evictions": self.eviction_count,
+            # Seconds the last load of each resident model took
+            "load_seconds": {
+                model_id: round(client.load_seconds, 3)
+                for model_id, client in list(self._clients.items())
+                if client.load_seconds is not None
+            }
+        }
+
+    def close(self):
+        """Stop every resident worker"""
+        with self._lock:
+            clients = list(self._clients.values())
+            self._resident.clear()
+        for client in clients:
+            client.close()
+
+    def _config_path(self, model_id: str) -> str:
+        return os.path.join(self.base_dir, self.specs[model_id]["config"])
+
+    def _client_locked(self, model_id: str) -> GenieClient:
+        if model_id not in self.specs:
+            raise UnknownModelError(model_id)
+        client = self._clients.get(model_id)
+        if client is None:
+            client = GenieClient(
+                self.executable, self._config_path(model_id), worker_options=self._worker_options(model_id)
+            )
+            self._clients[model_id] = client
+        return client
+
+    def _worker_options(self, model_id: str) -> Dict[str, Any]:
+        return dict(self.worker_defaults, **(self.specs[model_id].get("worker") or {}))
+
+    def _memory_mb(self, model_id: str) -> float:
+        spec = self.specs[model_id]
+        if "memory_mb" in spec:
+            return spec["memory_mb"]
+        return self._clients[model_id].model_bytes / (1024 * 1024)
+
+    def _pick_victims(self, model_id: str) -> List[str]:
+        """Idle resident models to unload so model_id fits, oldest first"""
+        resident = [m for m in self._resident if self._clients[m].loaded]
+        memory = sum(self._memory_mb(m) for m in resident) + self._memory_mb(model_id)
+        count = len(resident) + 1
+        victims = []
+        for candidate in resident:
+            over_count = count > self.max_resident_models
+            over_memory = self.memory_budget_mb is not None and memory > self.memory_budget_mb
+            if not (over_count or over_memory):
+                break
+            if self._in_use.get(candidate):
+                continue
+            victims.append(candidate)
+            self._resident.pop(candidate)
+            count -= 1
+            memory -= self._memory_mb(candidate)
+            self.eviction_count += 1
+        return victims
@@ -1,8 +1,15 @@
 from pydantic import BaseModel
 import subprocess
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Iterator
 import time
 import os
+import sys
+import json
+import queue
+import codecs
+import threading
+
+from tokens import TokenCounter, ContextOverflowError, fit_messages
 
 # Pydantic models for OpenAI API compatibility
 class ChatMessage(BaseModel):
@@ -18,6 +25,7 @@ class ChatCompletionRequest(BaseModel):
     top_k: Optional[int] = 40
     stream: Optional[bool] = False
     stop: Optional[List[str]] = None
+    seed: Optional[int] = None
 
 class ChatCompletionResponse(BaseModel):
     id: str
@@ -33,83 +41,523 @@ class Model(BaseModel):
     created: int
     owned_by: str = "genie"
 
+class GenieTimeoutError(RuntimeError):
+    """Raised when Genie does not answer within its time budget"""
+
+class GenieCancelledError(RuntimeError):
+    """Raised when a generation is cancelled before Genie finishes"""
+
+# How often a blocked generation checks whether it was cancelled
+CANCEL_POLL_INTERVAL = 0.1
+
+def _kill_when_cancelled(process: subprocess.Popen, cancel: threading.Event):
+    """Kill process as soon as cancel is set, or return once it exits"""
+    while process.poll() is None:
+        if cancel.wait(CANCEL_POLL_INTERVAL):
+            process.kill()
+            return
+
+def parse_genie_output(output: str) -> str:
+    """Extract the model answer from complete Genie output"""
+    output = output.replace("\r\n", "\n")
+    # Look for content between [BEGIN]: and [END]
+    begin_marker = "[BEGIN]:"
+    end_marker = "[END]"
+    
+    begin_idx = output.find(begin_marker)
+    if begin_idx != -1:
+        begin_idx += len(begin_marker)
+        end_idx = output.find(end_marker, begin_idx)
+        if end_idx != -1:
+            response = output[begin_idx:end_idx].strip()
+            return response
+    
+    # Fallback: return everything after the prompt line
+    lines = output.split('\n')
+    response_lines = []
+    found_prompt = False
+    
+    for line in lines:
+        if "[PROMPT]:" in line:
+            found_prompt = True
+            continue
+        if found_prompt and line.strip() and not line.startswith("["):
+            response_lines.append(line.strip())
+    
+    if response_lines:
+        return '\n'.join(response_lines)
+    
+    # Final fallback
+    return output.strip()
+
+class GenieOutputParser:
+    """Incrementally extract the answer from Genie stdout as it is written"""
+
+    BEGIN_MARKER = "[BEGIN]:"
+    END_MARKER = "[END]"
+
+    def __init__(self):
+        self.raw = ""
+        self.started = False
+        self.finished = False
+        self._pending = ""
+        self._emitted = False
+
+    def feed(self, text: str) -> str:
+        """Consume a chunk of output and return the answer text it completes"""
+        self.raw += text
+        if self.finished:
+            return ""
+        self._pending += text
+
+        if not self.started:
+            begin_idx = self._pending.find(self.BEGIN_MARKER)
+            if begin_idx == -1:
+                return ""
+            self.started = True
+            self._pending = self._pending[begin_idx + len(self.BEGIN_MARKER):]
+
+        if not self._emitted:
+            self._pending = self._pending.lstrip()
+
+        end_idx = self._pending.find(self.END_MARKER)
+        if end_idx != -1:
+            self.finished = True
+            delta, self._pending = self._pending[:end_idx].rstrip(), ""
+        else:
+            # Hold back anything that could be the start of the end marker
+            cut = max(len(self._pending) - (len(self.END_MARKER) - 1), 0)
+            delta, self._pending = self._pending[:cut], self._pending[cut:]
+
+        if delta:
+            self._emitted = True
+        return delta
+
+    def finish(self) -> str:
+        """Return whatever is left once the output is closed"""
+        if self.finished:
+            return ""
+        self.finished = True
+        if not self.started:
+            return parse_genie_output(self.raw)
+        delta, self._pending = self._pending.rstrip(), ""
+        return delta
+
+class GenieWorker:
+    """Long-lived Genie process that keeps the model loaded between prompts.
+
+    Protocol: the worker prints ``[READY]`` once the context binaries are
+    loaded, then reads one JSON-encoded prompt per line on stdin and answers
+    each one with the usual ``[BEGIN]: ... [END]`` block on stdout.
+    """
+
+    READY_MARKER = "[READY]"
+    END_MARKER = "[END]"
+
+    def __init__(self, command: List[str], cwd: str, startup_timeout: float = 120.0,
+                 request_timeout: float = 600.0, health_check_interval: float = 5.0):
+        self.command = command
+        self.cwd = cwd
+        self.startup_timeout = startup_timeout
+        self.request_timeout = request_timeout
+        self.health_check_interval = health_check_interval
+        self.process = None
+        self.restart_count = 0
+        self._output = None
+        self._decoder = None
+        self._lock = threading.Lock()
+        self._closing = threading.Event()
+        self._monitor = None
+
+    def start(self):
+        """Spawn the worker and wait until it reports the model is loaded"""
+        self._closing.clear()
+        self.process = subprocess.Popen(
+            self.command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            cwd=self.cwd
+        )
+        self._output = queue.Queue()
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        threading.Thread(
+            target=self._read_output, args=(self.process, self._output), daemon=True
+        ).start()
+
+        try:
+            self._read_until(self.READY_MARKER, time.monotonic() + self.startup_timeout)
+        except (EOFError, RuntimeError):
+            self._kill()
+            raise RuntimeError("Genie worker did not become ready in time")
+
+        if self._monitor is None or not self._monitor.is_alive():
+            self._monitor = threading.Thread(target=self._monitor_loop, daemon=True)
+            self._monitor.start()
+
+    def is_alive(self) -> bool:
+        """Return True while the worker process is running"""
+        return self.process is not None and self.process.poll() is None
+
+    def ensure_started(self):
+        """Start the worker unless it is already running"""
+        with self._lock:
+            if not self.is_alive():
+                self.start()
+
+    def health_check(self) -> bool:
+        """Restart the worker if it has died; return whether it is usable"""
+        if self._closing.is_set():
+            return False
+        with self._lock:
+            if not self.is_alive():
+                self._restart()
+            return self.is_alive()
+
+    def stream(self, prompt: str, timeout: Optional[float] = None,
+               cancel: Optional[threading.Event] = None) -> Iterator[str]:
+        """Send one prompt to the resident model and yield raw output as it arrives.
+        
+        Setting cancel stops the generation; the worker has no way to
+        interrupt a prompt, so it is killed and reloads in the background.
+        """
+        with self._lock:
+            deadline = time.monotonic() + (timeout or self.request_timeout)
+            finished = False
+            try:
+                # A worker that died between requests gets one fresh retry
+                for attempt in range(2):
+                    if not self.is_alive():
+                        self._restart()
+                    try:
+                        self.process.stdin.write((json.dumps(prompt) + "\n").encode("utf-8"))
+                        self.process.stdin.flush()
+                        chunk = self._next_chunk(deadline, cancel)
+                        break
+                    except (EOFError, OSError) as e:
+                        self._kill()
+                        if attempt == 1:
+                            raise RuntimeError(f"Genie worker exited unexpectedly: {e}")
+
+                tail = ""
+                while True:
+                    window = tail + chunk
+                    end_idx = window.find(self.END_MARKER)
+                    if end_idx != -1:
+                        # Drop the rest of the [END] line so it does not open the next answer
+                        rest = window[end_idx + len(self.END_MARKER):]
+                        while "\n" not in rest:
+                            rest = self._next_output(deadline, cancel)
+                        finished = True
+                        yield chunk
+                        return
+                    yield chunk
+                    tail = window[-len(self.END_MARKER):]
+                    chunk = self._next_output(deadline, cancel)
+            finally:
+                if not finished:
+                    # The model is in an unknown state, start from a fresh process
+                    self._kill()
+
+    def _next_output(self, deadline: float, cancel: Optional[threading.Event] = None) -> str:
+        try:
+            return self._next_chunk(deadline, cancel)
+        except EOFError as e:
+            raise RuntimeError(f"Genie worker exited unexpectedly: {e}")
+
+    def generate(self, prompt: str, timeout: Optional[float] = None) -> str:
+        """Send one prompt to the resident model and return the raw output"""
+        return "".join(self.stream(prompt, timeout))
+
+    def close(self):
+        """Ask the worker to exit and wait for it"""
+        self._closing.set()
+        with self._lock:
+            if self.is_alive():
+                try:
+                    self.process.stdin.close()
+                    self.process.wait(timeout=5)
+                except (OSError, subprocess.TimeoutExpired):
+                    pass
+            self._kill()
+        if self._monitor is not None:
+            self._monitor.join(timeout=self.health_check_interval + 1)
+            self._monitor = None
+
+    def _restart(self):
+        self._kill()
+        self.restart_count += 1
+        self.start()
+
+    def _kill(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+    def _monitor_loop(self):
+        while not self._closing.wait(self.health_check_interval):
+            if not self.is_alive():
+                try:
+                    self.health_check()
+                except Exception as e:
+                    print(f"Genie worker restart failed: {e}")
+
+    @staticmethod
+    def _read_output(process, output: "queue.Queue"):
+        # read1 returns as soon as some bytes are available
+        while True:
+            chunk = process.stdout.read1(4096)
+            if not chunk:
+                output.put(None)
+                return
+            output.put(chunk)
+
+    def _next_chunk(self, deadline: float, cancel: Optional[threading.Event] = None) -> str:
+        """Wait for the next piece of worker output"""
+        while True:
+            if cancel is not None and cancel.is_set():
+                raise GenieCancelledError("Generation cancelled")
+            timeout = deadline - time.monotonic()
+            if cancel is not None:
+                timeout = min(timeout, CANCEL_POLL_INTERVAL)
+            try:
+                chunk = self._output.get(timeout=max(timeout, 0))
+                break
+            except queue.Empty:
+                if time.monotonic() >= deadline:
+                    raise GenieTimeoutError("Genie process timed out")
+        if chunk is None:
+            raise EOFError("worker closed its output")
+        return self._decoder.decode(chunk)
+
+    def _read_until(self, marker: str, deadline: float) -> str:
+        """Collect worker output until marker shows up"""
+        text = ""
+        while marker not in text:
+            text += self._next_chunk(deadline)
+        return text
+
+
 class GenieClient:
     """Client to interact with the Genie executable"""
     
-    def __init__(self, genie_path: str, config_path: str):
+    def __init__(self, genie_path: str, config_path: str, worker_options: Optional[Dict[str, Any]] = None):
         self.genie_path = genie_path
         self.config_path = config_path
+        self.worker = None
+        self.load_seconds = None
+        # Time budget of one generation, for one-shot runs and the worker alike
+        self.request_timeout = (worker_options or {}).get("request_timeout", 600.0)
+        
+        dialog = self._read_dialog_config()
+        sampler = dialog.get("sampler", {})
+        self.sampler_seed = sampler.get("seed")
+        self.sampler_greedy = bool(sampler.get("greedy")) or sampler.get("temp") == 0 or sampler.get("top-k") == 1
+        self.context_size = dialog.get("context", {}).get("size", 4096)
+        tokenizer_path = dialog.get("tokenizer", {}).get("path", "tokenizer.json")
+        config_dir = os.path.dirname(os.path.abspath(self.config_path))
+        self.token_counter = TokenCounter(os.path.join(config_dir, tokenizer_path))
+        
+        # Size of the context binaries, i.e. what a resident worker keeps in memory
+        ctx_bins = dialog.get("engine", {}).get("model", {}).get("binary", {}).get("ctx-bins", [])
+        ctx_paths = [os.path.join(config_dir, name) for name in ctx_bins]
+        self.model_bytes = sum(os.path.getsize(path) for path in ctx_paths if os.path.exists(path))
+        
+        # Keep the model resident in a long-lived process when configured;
+        # the worker starts on load() or on the first request
+        if worker_options and worker_options.get("enabled"):
+            genie_dir = os.path.dirname(os.path.abspath(self.genie_path))
+            command = worker_options.get("command")
+            if not command:
+                # genie-t2t-run.exe has no worker mode of its own
+                raise ValueError(
+                    "genie.worker.command is required when the worker is enabled: it must run a wrapper "
+                    "that prints [READY] and answers JSON-line prompts (see genie_worker.py)"
+                )
+            command = [arg.replace("{config}", self.config_path).replace("{python}", sys.executable)
+                       for arg in command]
+            self.worker = GenieWorker(
+                command,
+                cwd=genie_dir,
+                startup_timeout=worker_options.get("startup_timeout", 120.0),
+                request_timeout=self.request_timeout,
+                health_check_interval=worker_options.get("health_check_interval", 5.0)
+            )
+    
+    @property
+    def loaded(self) -> bool:
+        """True while a resident worker holds the model in memory"""
+        return self.worker is not None and self.worker.is_alive()
+    
+    def load(self):
+        """Start the resident worker, if this client uses one, timing the model load"""
+        if self.worker and not self.worker.is_alive():
+            start = time.perf_counter()
+            self.worker.ensure_started()
+            self.load_seconds = time.perf_counter() - start
+    
+    @property
+    def reproducible(self) -> bool:
+        """True when the same prompt always yields the same completion"""
+        # Genie samples with its own config, whatever the request asks for.
+        # Greedy sampling is always reproducible; one-shot runs reseed the
+        # sampler every time, a resident worker keeps advancing the same state
+        return self.sampler_greedy or (self.worker is None and self.sampler_seed is not None)
     
-    def generate_response(self, messages: List[ChatMessage], **kwargs) -> str:
-        """Generate a response using the Genie model"""
+    def _read_dialog_config(self) -> Dict[str, Any]:
+        """The dialog section of the Genie config"""
+        try:
+            with open(self.config_path, "r") as f:
+                return json.load(f).get("dialog", {})
+        except (OSError, ValueError):
+            return {}
+    
+    def count_tokens(self, text: str) -> int:
+        """Number of model tokens in text"""
+        return self.token_counter.count(text)
+    
+    def fit_to_context(self, messages: List[ChatMessage], max_tokens: Optional[int] = None, truncate: bool = True):
+        """Make messages fit the context window, leaving room for max_tokens.
+        
+        Returns the messages to send and their prompt token count. Oldest
+        turns are dropped when truncate is set; otherwise, or when the
+        system prompt and last message alone are too long,
+        ContextOverflowError is raised.
+        """
+        costs = [self.count_tokens(self._format_message(message)) for message in messages]
+        overhead = self.count_tokens(self._messages_to_llama_prompt([]))
+        budget = self.context_size - (max_tokens or 0)
+        return fit_messages(messages, costs, overhead, budget, truncate=truncate)
+    
+    def generate_response(self, messages: List[ChatMessage], timings: Optional[Dict[str, float]] = None,
+                          cancel: Optional[threading.Event] = None, **kwargs) -> str:
+        """Generate a response using the Genie model.
+        
+        When a timings dict is given it is filled with the seconds spent on
+        each stage: spawn, first_token, parse and total. Setting cancel stops
+        Genie and raises GenieCancelledError.
+        """
         # Convert messages to Llama format prompt
         prompt = self._messages_to_llama_prompt(messages)
+        timings = {} if timings is None else timings
+        parser = GenieOutputParser()
+        start = time.perf_counter()
         
         try:
-            # Get the directory containing the Genie executable
-            genie_dir = os.path.dirname(os.path.abspath(self.genie_path))
-            
-            # Run Genie with command-line arguments, setting the working directory
-            result = subprocess.run(
-                [self.genie_path, "-c", self.config_path, "-p", prompt],
-                capture_output=True,
-                text=True,
-                timeout=600,  # 10 min timeout
-                cwd=genie_dir  # Set working directory to where the executable is located
-            )
-            
-            if result.returncode != 0:
-                raise RuntimeError(f"Genie process failed with return code {result.returncode}: {result.stderr}")
-            
-            # Parse the output to extract the response
-            output = result.stdout
-            
-            # Look for content between [BEGIN]: and [END]
-            begin_marker = "[BEGIN]:"
-            end_marker = "[END]"
-            
-            begin_idx = output.find(begin_marker)
-            if begin_idx != -1:
-                begin_idx += len(begin_marker)
-                end_idx = output.find(end_marker, begin_idx)
-                if end_idx != -1:
-                    response = output[begin_idx:end_idx].strip()
-                    return response
-            
-            # Fallback: return everything after the prompt line
-            lines = output.split('\n')
-            response_lines = []
-            found_prompt = False
-            
-            for line in lines:
-                if "[PROMPT]:" in line:
-                    found_prompt = True
-                    continue
-                if found_prompt and line.strip() and not line.startswith("["):
-                    response_lines.append(line.strip())
-            
-            if response_lines:
-                return '\n'.join(response_lines)
-            
-            # Final fallback
-            return output.strip()
-            
-        except subprocess.TimeoutExpired:
-            raise RuntimeError("Genie process timed out")
+            for chunk in self._raw_output(prompt, timings, cancel):
+                if parser.feed(chunk) and "first_token" not in timings:
+                    timings["first_token"] = time.perf_counter() - start
+        except (GenieTimeoutError, GenieCancelledError):
+            raise
         except Exception as e:
             raise RuntimeError(f"Error generating response: {e}")
+        
+        parse_start = time.perf_counter()
+        response = self._parse_output(parser.raw)
+        timings["parse"] = time.perf_counter() - parse_start
+        timings["total"] = parse_start - start
+        return response
+    
+    def stream_response(self, messages: List[ChatMessage], timings: Optional[Dict[str, float]] = None,
+                        cancel: Optional[threading.Event] = None, **kwargs) -> Iterator[str]:
+        """Yield the Genie answer piece by piece as soon as it is written"""
+        prompt = self._messages_to_llama_prompt(messages)
+        timings = {} if timings is None else timings
+        parser = GenieOutputParser()
+        start = time.perf_counter()
+        chunks = self._raw_output(prompt, timings, cancel)
+        
+        try:
+            for chunk in chunks:
+                delta = parser.feed(chunk)
+                if delta:
+                    if "first_token" not in timings:
+                        timings["first_token"] = time.perf_counter() - start
+                    yield delta
+                if parser.finished:
+                    break
+        finally:
+            chunks.close()
+        
+        delta = parser.finish()
+        if delta:
+            yield delta
+        timings["total"] = time.perf_counter() - start
+    
+    def _raw_output(self, prompt: str, timings: Dict[str, float],
+                    cancel: Optional[threading.Event] = None) -> Iterator[str]:
+        """Raw Genie stdout for a prompt, from the worker or a fresh process"""
+        if cancel is not None and cancel.is_set():
+            # Cancelled while queued, do not start Genie at all
+            raise GenieCancelledError("Generation cancelled")
+        if self.worker:
+            return self.worker.stream(prompt, cancel=cancel)
+        return self._stream_subprocess(prompt, timings, cancel)
+    
+    def _stream_subprocess(self, prompt: str, timings: Dict[str, float],
+                           cancel: Optional[threading.Event] = None) -> Iterator[str]:
+        """Run Genie once for this prompt and yield its stdout as it arrives"""
+        # Get the directory containing the Genie executable
+        genie_dir = os.path.dirname(os.path.abspath(self.genie_path))
+        spawn_start = time.perf_counter()
+        process = subprocess.Popen(
+            [self.genie_path, "-c", self.config_path, "-p", prompt],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=genie_dir  # Set working directory to where the executable is located
+        )
+        timings["spawn"] = time.perf_counter() - spawn_start
+        timer = threading.Timer(self.request_timeout, process.kill)
+        timer.start()
+        if cancel is not None:
+            threading.Thread(target=_kill_when_cancelled, args=(process, cancel), daemon=True).start()
+        # Drain stderr alongside stdout so a chatty process cannot block
+        stderr_chunks = []
+        stderr_reader = threading.Thread(target=lambda: stderr_chunks.append(process.stderr.read()), daemon=True)
+        stderr_reader.start()
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        
+        try:
+            while True:
+                chunk = process.stdout.read1(4096)
+                if not chunk:
+                    break
+                yield decoder.decode(chunk)
+            
+            process.wait()
+            if cancel is not None and cancel.is_set():
+                raise GenieCancelledError("Generation cancelled")
+            if not timer.is_alive():
+                raise GenieTimeoutError("Genie process timed out")
+            if process.returncode != 0:
+                stderr_reader.join(timeout=5)
+                stderr = b"".join(stderr_chunks).decode("utf-8", errors="replace")
+                raise RuntimeError(f"Genie process failed with return code {process.returncode}: {stderr}")
+        finally:
+            timer.cancel()
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            stderr_reader.join(timeout=5)
+            process.stdout.close()
+            process.stderr.close()
+    
+    def _parse_output(self, output: str) -> str:
+        """Extract the model answer from raw Genie output"""
+        return parse_genie_output(output)
+    
+    def _format_message(self, message: ChatMessage) -> str:
+        """Render one message with the Llama chat template"""
+        if message.role in ("system", "user", "assistant"):
+            return f"<|start_header_id|>{message.role}<|end_header_id|>\n\n{message.content}<|eot_id|>"
+        return ""
     
     def _messages_to_llama_prompt(self, messages: List[ChatMessage]) -> str:
         """Convert OpenAI messages format to Llama chat template format"""
         prompt = "<|begin_of_text|>"
         
         for message in messages:
-            if message.role == "system":
-                prompt += f"<|start_header_id|>system<|end_header_id|>\n\n{message.content}<|eot_id|>"
-            elif message.role == "user":
-                prompt += f"<|start_header_id|>user<|end_header_id|>\n\n{message.content}<|eot_id|>"
-            elif message.role == "assistant":
-                prompt += f"<|start_header_id|>assistant<|end_header_id|>\n\n{message.content}<|eot_id|>"
+            prompt += self._format_message(message)
         
         # Add the assistant header to start the response
         prompt += "<|start_header_id|>assistant<|end_header_id|>"
@@ -117,5 +565,6 @@ class GenieClient:
         return prompt
     
     def close(self):
-        """Close method for compatibility - not needed for command-line usage"""
-        pass
\ No newline at end of file
+        """Stop the resident worker, if any; it restarts on the next load()"""
+        if self.worker:
+            self.worker.close()
\ No newline at end of file
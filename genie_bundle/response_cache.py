@@ -0,0 +1,146 @@
+"""
+Response cache and request coalescing for Genie completions.
+Identical deterministic requests are answered from memory, and identical
+requests that arrive together share a single generation.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+
+def cache_key(model: str, messages: List[Dict[str, str]], **sampler) -> str:
+    """Stable key for a request from its normalized messages and sampler settings"""
+    normalized = [
+        {
+            "role": message["role"].strip().lower(),
+            # Line endings and surrounding whitespace do not change the prompt meaning
+            "content": message["content"].replace("\r\n", "\n").strip()
+        }
+        for message in messages
+    ]
+    payload = json.dumps(
+        {"model": model, "messages": normalized, "sampler": sampler},
+        sort_keys=True,
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """LRU cache of completions whose entries expire after a TTL"""
+
+    def __init__(self, max_entries: int = 256, ttl: float = 3600.0, persist_path: Optional[str] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.persist_path = persist_path
+        self._entries = OrderedDict()  # key -> (expires_at, content)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bypassed = 0
+
+    def get(self, key: str) -> Optional[str]:
+        """Return a fresh cached completion, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: str, content: str):
+        """Store a completion, evicting the least recently used ones"""
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, content)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def load(self):
+        """Restore unexpired entries from persist_path, if configured"""
+        if not self.persist_path or not os.path.exists(self.persist_path):
+            return
+        try:
+            with open(self.persist_path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable response cache {self.persist_path}: {e}")
+            return
+        now = time.time()
+        with self._lock:
+            for key, expires_at, content in entries[-self.max_entries:]:
+                if expires_at > now:
+                    self._entries[key] = (expires_at, content)
+
+    def save(self):
+        """Write entries to persist_path atomically, oldest first"""
+        if not self.persist_path:
+            return
+        with self._lock:
+            entries = [[key, expires_at, content] for key, (expires_at, content) in self._entries.items()]
+        tmp_path = self.persist_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entries, f, ensure_ascii=False)
+        os.replace(tmp_path, self.persist_path)
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit and miss counters for the health endpoint"""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "evictions": self.evictions,
+            "bypassed": self.bypassed
+        }
+
+
+class SingleFlight:
+    """Share one in-flight computation between identical concurrent callers"""
+
+    def __init__(self):
+        self._inflight = {}  # key -> [task, number of callers waiting on it]
+        self.coalesced = 0
+
+    async def run(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """Await factory() once per key; later callers wait for the same result.
+
+        The computation is cancelled only once every caller has given up.
+        """
+        entry = self._inflight.get(key)
+        if entry is None:
+            task = asyncio.ensure_future(factory())
+            entry = self._inflight[key] = [task, 0]
+            task.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            self.coalesced += 1
+
+        entry[1] += 1
+        try:
+            # Shielded so one caller giving up does not cancel the others
+            return await asyncio.shield(entry[0])
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and not entry[0].done():
+                entry[0].cancel()
+
+    def _forget(self, key: str, task: "asyncio.Future"):
+        if self._inflight.get(key, [None])[0] is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            # Mark the exception retrieved in case nobody was left waiting
+            task.exception()
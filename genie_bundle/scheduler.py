@@ -0,0 +1,87 @@
+"""
+Admission control for Genie generations.
+Bounds how many generations run at once and how many may wait for a slot,
+so a busy NPU answers new requests quickly instead of stalling them.
+"""
+
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Any
+
+
+class QueueFullError(Exception):
+    """Raised when no more requests may wait for a generation slot"""
+
+    def __init__(self, retry_after: int):
+        super().__init__("Generation queue is full")
+        self.retry_after = retry_after
+
+
+class GenerationQueue:
+    """Bounded FIFO of generations with a fixed number of concurrent slots"""
+
+    def __init__(self, max_concurrency: int = 1, max_queue_size: int = 8, retry_after: int = 10):
+        self.max_concurrency = max_concurrency
+        self.max_queue_size = max_queue_size
+        self.retry_after = retry_after
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self.admitted = 0
+        self.waiting = 0
+        self.active = 0
+        self.rejected = 0
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.last_wait = 0.0
+
+    def is_full(self) -> bool:
+        """True when a new request would be turned away"""
+        return self.admitted >= self.max_concurrency + self.max_queue_size
+
+    @asynccontextmanager
+    async def slot(self):
+        """Wait for a generation slot; yields the time spent in line"""
+        # Checked before the first await so admission needs no lock
+        if self.is_full():
+            self.rejected += 1
+            raise QueueFullError(self.retry_after)
+        self.admitted += 1
+        self.waiting += 1
+
+        start = time.monotonic()
+        try:
+            await self._slots.acquire()
+        except BaseException:
+            self.waiting -= 1
+            self.admitted -= 1
+            raise
+        self.waiting -= 1
+        self.active += 1
+
+        wait = time.monotonic() - start
+        self.last_wait = wait
+        self.max_wait = max(self.max_wait, wait)
+        self.total_wait += wait
+        try:
+            yield wait
+        finally:
+            self.active -= 1
+            self.admitted -= 1
+            self.completed += 1
+            self._slots.release()
+
+    def stats(self) -> Dict[str, Any]:
+        """Queue depth and wait times for the health endpoint"""
+        started = self.completed + self.active
+        return {
+            "active": self.active,
+            "waiting": self.waiting,
+            "max_concurrency": self.max_concurrency,
+            "max_queue_size": self.max_queue_size,
+            "rejected": self.rejected,
+            "completed": self.completed,
+            "last_wait_s": round(self.last_wait, 3),
+            "avg_wait_s": round(self.total_wait / started, 3) if started else 0.0,
+            "max_wait_s": round(self.max_wait, 3)
+        }
@@ -0,0 +1,48 @@
+"""
+Protocol tests for genie_worker.py, with a scripted dialog in place of Genie.dll.
+"""
+
+import io
+import json
+import os
+import sys
+
+BUNDLE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BUNDLE_DIR)
+
+from genie_worker import serve  # noqa: E402
+from models import GenieOutputParser  # noqa: E402
+
+
+class ScriptedDialog:
+    def __init__(self):
+        self.prompts = []
+
+    def query(self, prompt, on_text):
+        self.prompts.append(prompt)
+        # A multi-byte character split across two callbacks, as Genie may do
+        for piece in (b"Bonjour ", b"Andr\xc3", b"\xa9"):
+            on_text(piece)
+
+
+def answers(output):
+    blocks = output.decode("utf-8").split("[END]\n")
+    texts = []
+    for block in blocks[:-1]:
+        parser = GenieOutputParser()
+        texts.append(parser.feed(block + "[END]\n"))
+    return texts
+
+
+def test_serve_answers_each_prompt_in_its_own_block():
+    dialog = ScriptedDialog()
+    prompts = ["first\nprompt", "second"]
+    lines = [json.dumps(prompt).encode("utf-8") + b"\n" for prompt in prompts] + [b"\n"]
+    out = io.BytesIO()
+
+    serve(dialog, lines, out)
+
+    output = out.getvalue()
+    assert output.startswith(b"[READY]\n")
+    assert dialog.prompts == prompts
+    assert answers(output[len(b"[READY]\n"):]) == ["Bonjour André", "Bonjour André"]
@@ -0,0 +1,95 @@
+"""
+Resident worker tests against fake_genie.py, the scripted stand-in for
+genie-t2t-run.exe.
+"""
+
+import os
+import sys
+import threading
+
+import pytest
+
+BUNDLE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BUNDLE_DIR)
+
+from models import GenieCancelledError, GenieClient, GenieWorker, parse_genie_output  # noqa: E402
+
+FAKE_GENIE = os.path.join(BUNDLE_DIR, "fake_genie.py")
+
+
+def make_worker(*args, request_timeout=10.0):
+    command = [sys.executable, FAKE_GENIE, "--worker", "--load-time", "0", "--token-delay", "0.001", *args]
+    return GenieWorker(command, cwd=BUNDLE_DIR, startup_timeout=10.0, request_timeout=request_timeout,
+                       health_check_interval=0.1)
+
+
+@pytest.fixture
+def worker():
+    worker = make_worker()
+    yield worker
+    worker.close()
+
+
+def test_start_waits_for_ready(worker):
+    worker.ensure_started()
+    assert worker.is_alive()
+    assert worker.restart_count == 0
+
+
+def test_generate_returns_one_answer_per_prompt(worker):
+    worker.ensure_started()
+    first = worker.generate("hello")
+    second = worker.generate("hello again")
+    assert parse_genie_output(first) == "This is a scripted Genie reply to a 5 character prompt."
+    # Nothing of the first answer leaks into the second one
+    assert second.lstrip().startswith("[PROMPT]: hello again")
+    assert parse_genie_output(second) == "This is a scripted Genie reply to a 11 character prompt."
+
+
+def test_worker_restarts_after_crash():
+    worker = make_worker("--crash-after", "1")
+    try:
+        worker.ensure_started()
+        assert "scripted Genie reply" in worker.generate("one")
+        worker.process.wait(timeout=5)
+        assert worker.health_check()
+        assert worker.restart_count == 1
+        assert "scripted Genie reply" in worker.generate("two")
+    finally:
+        worker.close()
+
+
+def test_dead_worker_is_restarted_on_next_prompt():
+    worker = make_worker("--crash-after", "1")
+    try:
+        worker.ensure_started()
+        worker.generate("one")
+        worker.process.wait(timeout=5)
+        assert "scripted Genie reply" in worker.generate("two")
+        assert worker.restart_count >= 1
+    finally:
+        worker.close()
+
+
+def test_cancel_kills_the_generation_and_next_prompt_reloads():
+    worker = make_worker("--token-delay", "0.2")
+    try:
+        worker.ensure_started()
+        cancel = threading.Event()
+        chunks = worker.stream("slow", cancel=cancel)
+        next(chunks)
+        cancel.set()
+        with pytest.raises(GenieCancelledError):
+            for _ in chunks:
+                pass
+        assert not worker.is_alive()
+        assert worker.health_check()
+    finally:
+        worker.close()
+
+
+def test_enabled_worker_without_command_fails_fast(tmp_path):
+    config = tmp_path / "genie_config.json"
+    config.write_text("{}")
+    with pytest.raises(ValueError, match="command"):
+        GenieClient(FAKE_GENIE, str(config), worker_options={"enabled": True})
@@ -0,0 +1,81 @@
+"""
+Token counting and context-window budgeting for Genie prompts.
+Uses the tokenizer.json bundled with the model when the `tokenizers`
+package is installed, and a character-based estimate otherwise.
+"""
+
+import os
+from typing import List, Tuple, TypeVar
+
+try:
+    from tokenizers import Tokenizer
+except ImportError:
+    Tokenizer = None
+
+T = TypeVar("T")
+
+# Rough average for Llama 3 on English text, used without a tokenizer
+CHARS_PER_TOKEN = 4
+
+
+class ContextOverflowError(Exception):
+    """Raised when a prompt cannot fit the model context window"""
+
+    def __init__(self, prompt_tokens: int, budget: int):
+        super().__init__(
+            f"Prompt needs {prompt_tokens} tokens but only {budget} fit in the context window"
+        )
+        self.prompt_tokens = prompt_tokens
+        self.budget = budget
+
+
+class TokenCounter:
+    """Counts tokens with the model tokenizer, loaded once"""
+
+    def __init__(self, tokenizer_path: str):
+        self.tokenizer_path = tokenizer_path
+        self._tokenizer = None
+        if Tokenizer is None:
+            print("tokenizers package not installed, token counts are estimates")
+        elif not os.path.exists(tokenizer_path):
+            print(f"Tokenizer not found: {tokenizer_path}, token counts are estimates")
+        else:
+            self._tokenizer = Tokenizer.from_file(tokenizer_path)
+
+    @property
+    def exact(self) -> bool:
+        """True when counts come from the real tokenizer"""
+        return self._tokenizer is not None
+
+    def count(self, text: str) -> int:
+        """Number of tokens in text, special tokens included as written"""
+        if not text:
+            return 0
+        if self._tokenizer is None:
+            return max(1, (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN)
+        return len(self._tokenizer.encode(text, add_special_tokens=False).ids)
+
+
+def fit_messages(messages: List[T], costs: List[int], overhead: int, budget: int,
+                 truncate: bool = True) -> Tuple[List[T], int]:
+    """Drop the oldest conversation turns until the prompt fits the budget.
+
+    Returns the kept messages and their token count. System messages and
+    the last message are always kept; ContextOverflowError is raised if the
+    prompt still does not fit, or does not fit and truncate is off.
+    """
+    total = overhead + sum(costs)
+    keep = [True] * len(messages)
+
+    if truncate:
+        for i, message in enumerate(messages[:-1]):
+            if total <= budget:
+                break
+            if getattr(message, "role", None) == "system":
+                continue
+            keep[i] = False
+            total -= costs[i]
+
+    if total > budget:
+        raise ContextOverflowError(total, budget)
+    return [message for message, kept in zip(messages, keep) if kept], total
@@ -0,0 +1,9 @@
+"""
+Lookup keys for the Mail Assistant application.
+Shared by the directory stores and the settings files that persist them.
+"""
+
+
+def person_key(value):
+    """Case- and spacing-insensitive key of a name, alias or email"""
+    return " ".join((value or "").split()).casefold()
@@ -7,6 +7,7 @@ A desktop application for anwering emails at ultra speed.
 
 import threading
 from system_tray import app
+from moteur import preload_whisper_model
 from user_management import load_user_data, create_registration_window
 from utils import setup_application
 
@@ -15,6 +16,9 @@ def main():
     # Setup application environment
     setup_application()
     
+    # Load the local Whisper model while the user is still reading their mail
+    threading.Thread(target=preload_whisper_model, daemon=True).start()
+    
     # Load user data on startup
     app.user = load_user_data(app)
     
@@ -1,72 +1,178 @@
-import ollama
 import os
 from dotenv import load_dotenv
 import sounddevice as sd
-# from scipy.io.wavfile import write
-import wavio as wv
-from groq import Groq
-import json
 import numpy as np
 import keyboard
 import pyperclip
-from openai import OpenAI
-from typing import Literal
 from config_settings import (
     USER_DATA_FILE, ICON_FILE, APP_NAME, MAIN_WINDOW_SIZE,
     TRAY_ICON_SIZE, TRAY_ICON_FALLBACK_SIZE, OVERLAY_COLOR, MAIN_HOTKEY,
     DEFAULT_CLIPBOARD_MODE
 )
-import faster_whisper
 import string
 import copy
 
-from directory import load_directory
+from directory import get_store, relevant_people, person_key
+from contact_retrieval import render_contacts, estimate_tokens
+from settings import config, user_data
+from name_extraction import DirectoryIndex, extract_names
 from user_management import resolve_unknown_name
+from providers import ProviderRegistry
+from routing import Router
+from structured_output import StructuredOutput, JsonFieldStream, extract_json, StructuredOutputError
+from transcription import (
+    WhisperModelCache, SilenceSegmenter, BackgroundTranscriber,
+    to_whisper_audio, encode_wav
+)
 
 
 load_dotenv()
 
-# Load configuration
-def load_config():
-    with open("config.json", "r") as f:
-        return json.load(f)
+# One long-lived client per configured LLM provider
+providers = ProviderRegistry(config["providers"])
+router = Router(providers, config.get("routing"))
+
+def complete(messages, provider=None, schema=None, **opts):
+    # Answer messages with a provider from config.json (the default one if not
+    # given), falling back to others when it fails; schema asks for JSON
+    if provider is None:
+        provider = config["mail_generation"]["default_provider"]
+    return router.complete(provider, messages, schema=schema, **opts)
+
+# The {"mail": ...} answer contract of generate_mail
+MAIL_SCHEMA = {
+    "type": "object",
+    "properties": {"mail": {"type": "string", "minLength": 1}},
+    "required": ["mail"]
+}
+mail_output = StructuredOutput(
+    MAIL_SCHEMA,
+    max_attempts=config["mail_generation"].get("max_attempts", 3),
+    backoff=config["mail_generation"].get("retry_backoff", 0.5)
+)
+
+def local_whisper_config():
+    # Local Whisper settings from the transcription block of config.json
+    return config["transcription"].get("local", {})
+
+whisper_models = WhisperModelCache(idle_timeout=local_whisper_config().get("idle_unload_seconds", 600))
+
+def apply_config(new_config):
+    # config.json changed on disk: providers are switched without a restart
+    providers.configure(new_config["providers"])
+    router.configure(new_config.get("routing"))
+    mail_output.max_attempts = max(1, new_config["mail_generation"].get("max_attempts", 3))
+    mail_output.backoff = new_config["mail_generation"].get("retry_backoff", 0.5)
+    whisper_models.idle_timeout = new_config["transcription"].get("local", {}).get("idle_unload_seconds", 600)
+
+config.on_change(apply_config)
+
+def whisper_settings():
+    # faster_whisper.WhisperModel arguments, also the key of the model cache
+    local_config = local_whisper_config()
+    return {
+        "model_size_or_path": local_config.get("model", "distil-small.en"),
+        "device": local_config.get("device", "auto"),
+        "compute_type": local_config.get("compute_type", "int8"),
+        "cpu_threads": local_config.get("cpu_threads", 0),
+        "num_workers": local_config.get("num_workers", 1)
+    }
+
+def transcribe_local(audio, initial_prompt=None):
+    # Transcribe 16 kHz mono audio with the resident local Whisper model,
+    # straight from memory
+    with whisper_models.lease(**whisper_settings()) as model:
+        segments, info = model.transcribe(
+            audio,
+            language=config["transcription"]["language"],
+            initial_prompt=initial_prompt or None
+        )
+        text = ""
+        for segment in segments:
+            print("[%.2fs -> %.2fs] %s" % (segment.start, segment.end, segment.text))
+            text += segment.text + " "
+    return text.strip()
 
-config = load_config() 
+def preload_whisper_model():
+    # Called in the background at startup so the first dictation does not
+    # pay for the model load (or download)
+    if not local_whisper_config().get("preload", True):
+        return
+    try:
+        whisper_models.preload(**whisper_settings())
+    except Exception as e:
+        print(f"Could not preload Whisper model: {e}")
 
 def generate_mail(
     email_received: str,
     i_want_to_respond: str,
-    provider: Literal["groq", "ollama", "anythingllm", "genie"] = None
+    provider: str = None,
+    recipients: list = None
 ):
     # Use default provider from config if none specified
     if provider is None:
         provider = config["mail_generation"]["default_provider"]
-    
-    # Load sender info from user_data.json
-    user_data_file = config["user_data_file"]
-    with open(user_data_file, "r") as f:
-        user_data = json.load(f)
-    recipients = None
-    recipients_text = ""
-    if provider != "genie":
-        recipients = get_names_in_prompt(email_received, provider)
-        if recipients:
-            directory = load_directory()
-            recipients_text = "\n\nRecipient Info:\n"
-            # for person in recipients:
-                # if not person.lower() in str(directory).lower():
-                #     resolve_unknown_name(person["name"], directory)
-                # recipients_text += f"- {person['name']} – {person['position']}: {person['description']}\n"
-            recipients_text += str(recipients)
-            
-    sender_name = user_data.get("name", "Your Name")
-    sender_profession = user_data.get("function", "Your Profession")
-    
+    messages = build_mail_messages(email_received, i_want_to_respond, provider, recipients)
+
+    # Ask for JSON natively where the provider supports it; answers are
+    # repaired when possible and retried a bounded number of times
+    result = mail_output.request(provider, messages, lambda attempt: complete(attempt, provider, schema=MAIL_SCHEMA))
+    print(f"Structured output stats: {mail_output.stats()}")
+    return result["mail"]
+
+def stream_mail(
+    email_received: str,
+    i_want_to_respond: str,
+    provider: str = None,
+    recipients: list = None
+):
+    # Same as generate_mail, but yields the mail text as the provider produces it
+    if provider is None:
+        provider = config["mail_generation"]["default_provider"]
+    messages = build_mail_messages(email_received, i_want_to_respond, provider, recipients)
+
+    mail_field = JsonFieldStream("mail")
+    answer = []
+    for delta in router.stream(provider, messages, schema=MAIL_SCHEMA):
+        answer.append(delta)
+        text = mail_field.feed(delta)
+        if text:
+            yield text
+    if mail_field.started:
+        return
+
+    # The answer was not shaped like {"mail": "..."}: repair it, or ask again
+    print(f"Streamed answer from {provider} has no mail field, repairing it")
+    answers = iter(["".join(answer)])
+    result = mail_output.request(
+        provider, messages, lambda attempt: next(answers, None) or complete(attempt, provider, schema=MAIL_SCHEMA)
+    )
+    yield result["mail"]
+
+def load_sender():
+    # Sender info from user_data.json, cached until the profile changes
+    user = user_data.load() or {}
+    return user.get("name", "Your Name"), user.get("function", "Your Profession")
+
+def mail_recipients(email_received, provider=None):
+    # People the reply is addressed to, leaving out the user
+    sender_name, _ = load_sender()
+    return extract_recipients(email_received, provider, exclude=[sender_name])
+
+def build_mail_messages(email_received, i_want_to_respond, provider, recipients=None):
+    # recipients may be found beforehand, e.g. while the answer is being dictated
+    sender_name, sender_profession = load_sender()
+
+    if recipients is None:
+        recipients = mail_recipients(email_received, provider)
+    recipients_text = recipient_context(email_received, recipients, exclude=[sender_name])
+
     print(i_want_to_respond)
-    system_prompt = config["mail_generation"]["system_prompt"].replace("{sender_name}", sender_name).replace("{sender_profession}", sender_profession).replace("{email_received}", email_received).replace("{i_want_to_respond}", i_want_to_respond).replace("{recipients_text}", recipients_text)
-    print(system_prompt)
-    if not recipients:
+    system_prompt = config["mail_generation"]["system_prompt"]
+    if not recipients_text:
         system_prompt = system_prompt.replace("Here is the list of recipients {recipients_text}. ", "")
+    system_prompt = system_prompt.replace("{sender_name}", sender_name).replace("{sender_profession}", sender_profession).replace("{email_received}", email_received).replace("{i_want_to_respond}", i_want_to_respond).replace("{recipients_text}", recipients_text)
+    print(system_prompt)
     messages = [
         {
             "role": "system",
@@ -79,31 +185,67 @@ def generate_mail(
     ]
 
     print(messages)
-
-    if provider == "groq":
-        result = generate_groq(messages)
-    elif provider == "ollama":
-        result = generate_ollama(messages)
-    elif provider == "anythingllm":
-        result = generate_anythingllm(messages)
-    elif provider == "genie":
-        result = generate_genie(messages)
-    else:
-        result = "Unknown provider."
-
-    # Try parsing the JSON result
-    try:
-        parsed = json.loads(result)
-        return parsed.get("mail", result)
-    except json.JSONDecodeError:
-        # retry if the result is not valid JSON
-        print(f"Failed to parse JSON from {provider}. Retrying ...")
-        return generate_mail(
+    return messages
+    
+def recipient_context(email_received, recipients, exclude=()):
+    # The people of the mail, then the directory entries most relevant to it,
+    # rendered within a token budget rather than the whole directory
+    context_config = config.get("recipients", {}).get("context", {})
+    max_tokens = context_config.get("max_tokens", 250)
+    excluded = {person_key(name) for name in exclude}
+    seen = excluded | {person_key(person["name"]) for person in recipients}
+    related = [
+        person for score, person in relevant_people(
             email_received,
-            i_want_to_respond,
-            provider=provider
+            limit=context_config.get("top_k", 3) + len(seen),
+            min_score=context_config.get("min_score", 2.0)
         )
-    
+        if person_key(person["name"]) not in seen
+    ][:context_config.get("top_k", 3)]
+
+    text = ""
+    recipients_block = render_contacts(recipients, max_tokens)
+    if recipients_block:
+        text += "\n\nRecipient Info:\n" + recipients_block + "\n"
+    related_block = render_contacts(related, max_tokens - estimate_tokens(text))
+    if related_block:
+        text += "\nOther people concerned (from the directory):\n" + related_block + "\n"
+    if recipients or related:
+        print(f"Recipients: {[p['name'] for p in recipients]}, related: {[p['name'] for p in related]}")
+    return text
+
+_directory_index = (None, None)
+
+def directory_index():
+    # The name matching index, rebuilt only when the directory changes
+    global _directory_index
+    store = get_store()
+    version, index = _directory_index
+    if index is None or version != (id(store), store.version):
+        index = DirectoryIndex(store.all())
+        _directory_index = ((id(store), store.version), index)
+    return index
+
+def extract_recipients(email_received, provider=None, exclude=()):
+    # People the received mail is about, found locally from its headers,
+    # greeting, signature and the directory. The LLM is only asked when the
+    # local extractor is unsure, and never for Genie where a second round
+    # trip on the NPU costs more than the names are worth.
+    if provider is None:
+        provider = config["mail_generation"]["default_provider"]
+    recipients_config = config.get("recipients", {})
+
+    index = directory_index()
+    people, confidence = extract_names(email_received, index, exclude=exclude)
+    print(f"Local recipients ({confidence:.2f}): {[person['name'] for person in people]}")
+    if confidence >= recipients_config.get("min_confidence", 0.5):
+        return people
+    if not recipients_config.get("llm_fallback", True) or provider == "genie":
+        return people
+
+    names = get_names_in_prompt(email_received, provider)
+    return [index.resolve(name) or {"name": name} for name in names if isinstance(name, str) and name.strip()]
+
 def get_names_in_prompt(prompt, provider=None):
     # Use default provider from config if not explicitly given
     if provider is None:
@@ -128,26 +270,12 @@ def get_names_in_prompt(prompt, provider=None):
     print(messages)
 
     try:
-        if provider == "groq":
-            result = generate_groq(messages)
-
-        elif provider == "ollama":
-            result = generate_ollama(messages)
-
-        elif provider == "anythingllm":
-            result = generate_anythingllm(messages)
-
-        elif provider == "genie":
-            result = generate_genie(messages)
-
-        else:
-            print(f"Unsupported provider: {provider}")
-            return []
+        result = complete(messages, provider)
 
         # Attempt to parse the result as JSON
         try:
             print(f"Result from {provider}: {result}")
-            names = json.loads(result)
+            names, repaired = extract_json(result)
             if isinstance(names, list):
                 print(names)
                 return names
@@ -155,7 +283,7 @@ def get_names_in_prompt(prompt, provider=None):
                 print(names['names'])
                 print(names)
                 return names['names']
-        except json.JSONDecodeError:
+        except StructuredOutputError:
             return [result]
 
     except Exception as e:
@@ -176,6 +304,24 @@ def detect_audio_and_process(provider=None, stop_flag=None):
 
     all_chunks = []
 
+    # With local Whisper, transcribe finished sentences while the key is
+    # still held so only the last one is left once it is released
+    streaming_config = local_whisper_config().get("streaming", {})
+    streaming = provider != "groq" and streaming_config.get("enabled", True)
+    if streaming:
+        segmenter = SilenceSegmenter(
+            chunk_duration,
+            silence_threshold=streaming_config.get("silence_threshold", 0.01),
+            min_silence=streaming_config.get("min_silence_seconds", 0.4),
+            min_segment=streaming_config.get("min_segment_seconds", 3.0),
+            max_segment=streaming_config.get("max_segment_seconds", 25.0)
+        )
+        transcriber = BackgroundTranscriber(
+            lambda segment, previous_text: transcribe_local(
+                to_whisper_audio(segment, freq), initial_prompt=previous_text
+            )
+        )
+
     # Start stream
     stream = sd.InputStream(samplerate=freq, channels=channels)
     stream.start()
@@ -199,6 +345,10 @@ def detect_audio_and_process(provider=None, stop_flag=None):
             try:
                 audio_chunk, _ = stream.read(chunk_size)
                 all_chunks.append(audio_chunk)
+                if streaming:
+                    segment = segmenter.add(audio_chunk)
+                    if segment is not None:
+                        transcriber.submit(segment)
             except Exception as e:
                 print(f"Error reading audio: {e}")
                 break
@@ -206,144 +356,46 @@ def detect_audio_and_process(provider=None, stop_flag=None):
     stream.stop()
     print("* Done recording")
 
+    if streaming:
+        tail = segmenter.flush()
+        if tail is not None:
+            transcriber.submit(tail)
+
     # If no audio was recorded, return None
     if not all_chunks:
         print("No audio recorded")
+        if streaming:
+            transcriber.finish()
         return None
 
     # Concatenation des extraits audio avec numpy
     recording = np.concatenate(all_chunks, axis=0)
 
-    filename = os.path.dirname(__file__) + "/" + audio_config["output_file"]
-    wv.write(filename, recording, freq, sampwidth=audio_config["sample_width"])
+    # Audio is handed over in memory; the WAV file is only for debugging
+    if audio_config.get("debug_wav", False):
+        filename = os.path.dirname(__file__) + "/" + audio_config["output_file"]
+        with open(filename, "wb") as f:
+            f.write(encode_wav(to_whisper_audio(recording, freq)))
     
     # Transcription based on provider
     if provider == "groq":
-        # Use Groq API for transcription
+        # Use Groq API for transcription, uploading 16 kHz mono audio
         transcription_config = config["transcription"]
-        client = Groq()
-        with open(filename, "rb") as file:
-            transcription = client.audio.transcriptions.create(
-                file=(filename, file.read()),
-                model=transcription_config["model"],
-                language=transcription_config["language"],
-                response_format=transcription_config["response_format"],
-            )
+        client = providers.get("groq").client
+        transcription = client.audio.transcriptions.create(
+            file=("recording.wav", encode_wav(to_whisper_audio(recording, freq))),
+            model=transcription_config["model"],
+            language=transcription_config["language"],
+            response_format=transcription_config["response_format"],
+        )
         text = transcription.text
+    elif streaming:
+        # Only the segment recorded after the last pause is still running
+        text = transcriber.finish()
     else:
         # Use local quantized Whisper for other providers
         print("Using local quantized Whisper for transcription...")
-        model = faster_whisper.WhisperModel("distil-small.en", compute_type="int8")
-        segments, info = model.transcribe(filename, language="en")
-        text = ""
-        for segment in segments:
-            print("[%.2fs -> %.2fs] %s" % (segment.start, segment.end, segment.text))
-            text += segment.text + " "
-        text = text.strip()
+        text = transcribe_local(to_whisper_audio(recording, freq))
     
     print("Transcription :", text)
     return text
-
-
-
-def generate_ollama(messages):
-    # Generate mail using Ollama with configured model
-    ollama_config = config["providers"]["ollama"]
-    model_name = ollama_config["model"]
-    try:
-        response = ollama.chat(
-            model=model_name,
-            messages=messages,
-            options=ollama_config["options"]
-        )
-        return response['message']['content']
-    except ollama.ResponseError as e:
-        if "not found" in str(e).lower():
-            print(f"Model '{model_name}' not found. Downloading...")
-            ollama.pull(model_name)
-            # Retry after downloading
-            response = ollama.chat(
-                model=model_name,
-                messages=messages,
-                options=ollama_config["options"]
-            )
-            return response['message']['content']
-        else:
-            raise
-
-def generate_genie(messages):
-    # Optionally, remove non-ASCII characters from the content of each message
-    filtered_messages = [
-        {
-            "role": m["role"],
-            "content": ''.join([c for c in m["content"] if ord(c) < 128])
-        } for m in messages
-    ]
-
-    # Generate mail using Genie OpenAI-compatible API
-    try:
-        genie_config = config["providers"]["genie"]
-        # Initialize OpenAI client with custom base URL for Genie
-        print(genie_config["base_url"], genie_config["api_key"])
-        client = OpenAI(
-            base_url=genie_config["base_url"],
-            api_key=genie_config["api_key"]
-        )
-        
-        # Make chat completion request
-        completion = client.chat.completions.create(
-            model=genie_config["model"],
-            messages=filtered_messages,
-            temperature=genie_config["temperature"],
-            max_tokens=genie_config["max_tokens"],
-            top_p=genie_config["top_p"]
-        )
-        
-        return completion.choices[0].message.content
-    except Exception as e:
-        print(f"Error with Genie API: {e}")
-        raise
-    
-def generate_anythingllm(messages):
-    # Generate mail using AnythingLLM OpenAI-compatible API
-    try:
-        anythingllm_config = config["providers"]["anythingllm"]
-        # Initialize OpenAI client with custom base URL for AnythingLLM
-        client = OpenAI(
-            base_url=anythingllm_config["base_url"],
-            api_key=anythingllm_config["api_key"]
-        )
-        
-        # Make chat completion request
-        completion = client.chat.completions.create(
-            model=anythingllm_config["model"],
-            messages=messages,
-            temperature=anythingllm_config["temperature"],
-            max_tokens=anythingllm_config["max_tokens"],
-            top_p=anythingllm_config["top_p"]
-        )
-        
-        return completion.choices[0].message.content
-        
-    except Exception as e:
-        print(f"Error with AnythingLLM API: {e}, falling back to Ollama")
-        # Fallback to Ollama on any error
-        return generate_ollama(messages)
-
-
-def generate_groq(messages):
-    # Generate mail using the language model
-    groq_config = config["providers"]["groq"]
-    client = Groq()
-    completion = client.chat.completions.create(
-        model=groq_config["model"],
-        messages=messages,
-        temperature=groq_config["temperature"],
-        max_completion_tokens=groq_config["max_completion_tokens"],
-        top_p=groq_config["top_p"],
-        stream=groq_config["stream"],
-        response_format=groq_config["response_format"],
-        stop=groq_config["stop"],
-    )
-
-    return completion.choices[0].message.content
\ No newline at end of file
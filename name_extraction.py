@@ -0,0 +1,182 @@
+"""
+Local recipient extraction for the Mail Assistant application.
+Finds the people an email is about from its headers, salutation, signature,
+capitalized words and email addresses, and matches them against the contact
+directory without an LLM round trip.
+"""
+
+import re
+import unicodedata
+from email.utils import getaddresses
+
+EMAIL_PATTERN = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+")
+WORD_PATTERN = re.compile(r"[^\W\d_][\w'-]*")
+HEADER_PATTERN = re.compile(r"^\s*(from|to|cc|de|à|a)\s*:\s*(.+)$", re.IGNORECASE)
+SALUTATION_PATTERN = re.compile(
+    r"^\s*(?:dear|hi|hello|hey|good (?:morning|afternoon|evening)|bonjour|salut|cher|chère)\s+([^,!:.;\n]+)",
+    re.IGNORECASE
+)
+CLOSING_PATTERN = re.compile(
+    r"^\s*(?:best(?: regards| wishes)?|kind regards|warm regards|regards|thanks(?: again)?|thank you|"
+    r"cheers|sincerely|yours(?: truly| sincerely)?|cordialement|bien à vous|bien cordialement|merci)\s*[,!.]*\s*$",
+    re.IGNORECASE
+)
+# Words that follow a salutation without being a name
+NOT_NAMES = {
+    "all", "everyone", "team", "sir", "madam", "sir or madam", "there", "folks", "guys",
+    "colleagues", "friends", "tous", "à tous", "madame", "monsieur", "mr", "mrs", "ms", "dr"
+}
+
+# Scores of each kind of evidence, 0 to 1
+SCORE_DIRECTORY_FULL_NAME = 1.0
+SCORE_DIRECTORY_EMAIL = 1.0
+SCORE_HEADER = 0.9
+SCORE_SALUTATION_OR_SIGNATURE = 0.8
+SCORE_DIRECTORY_PARTIAL = 0.6
+
+
+def normalize(text):
+    """Lowercase text without accents, for matching"""
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).lower().strip()
+
+
+def name_tokens(name):
+    return [normalize(token) for token in WORD_PATTERN.findall(name)]
+
+
+class DirectoryIndex:
+    """Lookup tables over directory entries by full name or alias, name token and email"""
+
+    def __init__(self, directory):
+        self.by_full_name = {}
+        self.by_token = {}
+        self.by_email = {}
+        for person in directory:
+            tokens = name_tokens(person.get("name", ""))
+            if not tokens:
+                continue
+            self.by_full_name[" ".join(tokens)] = person
+            for alias in person.get("aliases", []):
+                alias_tokens = name_tokens(alias)
+                if alias_tokens:
+                    self.by_full_name.setdefault(" ".join(alias_tokens), person)
+            for token in set(tokens):
+                self.by_token.setdefault(token, []).append(person)
+            if person.get("email"):
+                self.by_email[person["email"].lower()] = person
+
+    def resolve(self, name):
+        """The directory entry for a name, or None when absent or ambiguous"""
+        tokens = name_tokens(name)
+        person = self.by_full_name.get(" ".join(tokens))
+        if person is not None:
+            return person
+        candidates = None
+        for token in tokens:
+            matches = {id(p): p for p in self.by_token.get(token, [])}
+            candidates = matches if candidates is None else {k: v for k, v in candidates.items() if k in matches}
+        if candidates and len(candidates) == 1:
+            return next(iter(candidates.values()))
+        return None
+
+    def resolve_email(self, address):
+        """The directory entry for an email address, also matching first.last@ style addresses"""
+        address = address.lower()
+        if address in self.by_email:
+            return self.by_email[address]
+        local_part = address.split("@")[0]
+        return self.by_full_name.get(" ".join(normalize(t) for t in re.split(r"[._-]+", local_part) if t))
+
+
+def extract_names(text, index, exclude=()):
+    """People mentioned in an email, matched against the directory.
+
+    Returns (people, confidence): people are directory entries, or
+    {"name": ...} for names found in the mail structure but not in the
+    directory, and confidence is the score of the strongest evidence.
+    """
+    # The user's own name shows up in greetings and headers; "Dear Ann" is excluded by "Ann Smith"
+    excluded = [set(name_tokens(name)) for name in exclude if name]
+    found = {}  # normalized name -> [person, score]
+
+    def add(person, score):
+        tokens = name_tokens(person["name"])
+        key = " ".join(tokens)
+        if not key or key in NOT_NAMES or any(set(tokens) <= names for names in excluded):
+            return
+        if key not in found or found[key][1] < score:
+            found[key] = [person, score]
+
+    def add_name(name, score):
+        name = name.strip(" \t\"'<>,;")
+        if not name or "@" in name:
+            return
+        person = index.resolve(name)
+        if person is not None:
+            add(person, SCORE_DIRECTORY_FULL_NAME)
+        else:
+            add({"name": name}, score)
+
+    lines = text.splitlines()
+
+    # Headers: From/To/Cc display names and addresses
+    for line in lines:
+        match = HEADER_PATTERN.match(line)
+        if not match:
+            continue
+        for display_name, address in getaddresses([match.group(2)]):
+            person = index.resolve_email(address) if address and "@" in address else None
+            if person is not None:
+                add(person, SCORE_DIRECTORY_EMAIL)
+            elif display_name:
+                add_name(display_name, SCORE_HEADER)
+
+    # Salutation: the first line that greets someone
+    for line in lines:
+        match = SALUTATION_PATTERN.match(line)
+        if match:
+            for name in re.split(r"\s*(?:&|\band\b|\bet\b)\s*", match.group(1)):
+                words = WORD_PATTERN.findall(name)
+                if 0 < len(words) <= 4 and all(word[0].isupper() for word in words):
+                    add_name(name, SCORE_SALUTATION_OR_SIGNATURE)
+            break
+
+    # Signature: the short capitalized line after a closing formula
+    for i, line in enumerate(lines):
+        if not CLOSING_PATTERN.match(line):
+            continue
+        following = [l.strip() for l in lines[i + 1:] if l.strip()]
+        if following:
+            words = WORD_PATTERN.findall(following[0])
+            if 0 < len(words) <= 4 and all(word[0].isupper() for word in words):
+                add_name(following[0], SCORE_SALUTATION_OR_SIGNATURE)
+
+    # Email addresses anywhere in the body
+    for address in EMAIL_PATTERN.findall(text):
+        person = index.resolve_email(address)
+        if person is not None:
+            add(person, SCORE_DIRECTORY_EMAIL)
+
+    # Capitalized words that belong to directory names
+    words = WORD_PATTERN.findall(text)
+    present = {normalize(word) for word in words}
+    for word in words:
+        if not word[0].isupper():
+            continue
+        candidates = index.by_token.get(normalize(word), [])
+        for person in candidates:
+            if all(token in present for token in name_tokens(person["name"])):
+                add(person, SCORE_DIRECTORY_FULL_NAME)
+            else:
+                add(person, SCORE_DIRECTORY_PARTIAL / len(candidates))
+
+    # "Jane" from a signature is the "Jane Doe" of the From header
+    token_sets = {key: set(key.split()) for key in found}
+    for key, tokens in token_sets.items():
+        if any(tokens < other for other in token_sets.values()):
+            del found[key]
+
+    people = sorted(found.values(), key=lambda item: -item[1])
+    confidence = people[0][1] if people else 0.0
+    return [person for person, score in people], confidence
@@ -0,0 +1,235 @@
+"""
+Asynchronous mail pipeline for the Mail Assistant application.
+The recording, transcription, recipient lookup and generation stages of
+moteur are awaitable coroutines on an asyncio loop that runs in its own
+thread. Blocking work (audio, Whisper, provider clients) runs on worker
+threads, so neither the loop nor the Tk main thread ever waits on it.
+TkBridge lets Tk code submit jobs and get their progress and results
+through after() callbacks.
+"""
+
+import asyncio
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from moteur import detect_audio_and_process, mail_recipients, stream_mail, generate_mail, complete
+
+
+class PipelineCancelledError(Exception):
+    """Raised inside a job whose cancel token was cancelled"""
+
+
+class CancelToken:
+    """Thread-safe cancellation flag shared by the stages of one job"""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def on_cancel(self, callback):
+        """Call callback when cancelled, right away if already cancelled"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise PipelineCancelledError()
+
+
+class Job:
+    """A submitted pipeline run; cancel() stops it at its next checkpoint"""
+
+    def __init__(self, future, token):
+        self.future = future
+        self.token = token
+
+    def cancel(self):
+        self.token.cancel()
+        self.future.cancel()
+
+    def done(self):
+        return self.future.done()
+
+
+class Pipeline:
+    """moteur's stages as coroutines, run on a background asyncio loop"""
+
+    def __init__(self, max_workers=4):
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pipeline")
+        self.loop.set_default_executor(self.executor)
+        self._thread = threading.Thread(target=self.loop.run_forever, name="pipeline-loop", daemon=True)
+        self._thread.start()
+
+    def submit(self, job, token=None):
+        """Run job(token), a coroutine function, on the pipeline loop from any thread"""
+        token = token or CancelToken()
+        return Job(asyncio.run_coroutine_threadsafe(job(token), self.loop), token)
+
+    async def run_blocking(self, func, *args, token=None):
+        """Await a blocking call on a worker thread"""
+        if token:
+            token.raise_if_cancelled()
+        result = await asyncio.get_running_loop().run_in_executor(self.executor, lambda: func(*args))
+        if token:
+            token.raise_if_cancelled()
+        return result
+
+    async def iterate_blocking(self, make_iterator, token=None):
+        """Async iterator over a blocking iterator consumed on a worker thread"""
+        loop = asyncio.get_running_loop()
+        items = asyncio.Queue()
+        stop = threading.Event()
+        end = object()
+
+        def pump():
+            try:
+                for item in make_iterator():
+                    # Closing the iterator here also closes the provider stream
+                    if stop.is_set() or (token and token.cancelled):
+                        break
+                    loop.call_soon_threadsafe(items.put_nowait, (item, None))
+            except BaseException as e:
+                loop.call_soon_threadsafe(items.put_nowait, (end, e))
+                return
+            loop.call_soon_threadsafe(items.put_nowait, (end, None))
+
+        loop.run_in_executor(self.executor, pump)
+        try:
+            while True:
+                item, error = await items.get()
+                if error is not None:
+                    raise error
+                if item is end:
+                    break
+                if token:
+                    token.raise_if_cancelled()
+                yield item
+        finally:
+            stop.set()
+
+    # Stages
+
+    async def record(self, provider=None, stop_flag=None, token=None):
+        """Record while the key is held (or until stop_flag is set) and return the transcription"""
+        stop_flag = stop_flag or threading.Event()
+        if token:
+            # Cancelling ends the recording instead of waiting for the key
+            token.on_cancel(stop_flag.set)
+        return await self.run_blocking(detect_audio_and_process, provider, stop_flag, token=token)
+
+    async def recipients(self, email_received, provider=None, token=None):
+        return await self.run_blocking(mail_recipients, email_received, provider, token=token)
+
+    async def generate(self, email_received, i_want_to_respond, provider=None, recipients=None, token=None):
+        return await self.run_blocking(generate_mail, email_received, i_want_to_respond, provider, recipients, token=token)
+
+    async def stream(self, email_received, i_want_to_respond, provider=None, recipients=None, token=None):
+        """Async iterator over the mail text as it is generated"""
+        async for delta in self.iterate_blocking(
+            lambda: stream_mail(email_received, i_want_to_respond, provider, recipients), token=token
+        ):
+            yield delta
+
+    async def complete(self, messages, provider=None, schema=None, token=None):
+        return await self.run_blocking(lambda: complete(messages, provider, schema=schema), token=token)
+
+    async def reply(self, email_received, provider=None, stop_flag=None, on_delta=None, token=None):
+        """Dictate and generate a reply; recipients are looked up while the user speaks"""
+        recipients = asyncio.ensure_future(self.recipients(email_received, provider, token=token))
+        try:
+            i_want_to_respond = await self.record(provider, stop_flag, token=token)
+        except BaseException:
+            recipients.cancel()
+            raise
+        if not i_want_to_respond:
+            recipients.cancel()
+            return None, None
+        mail = ""
+        async for delta in self.stream(email_received, i_want_to_respond, provider, await recipients, token=token):
+            mail += delta
+            if on_delta:
+                on_delta(delta)
+        return i_want_to_respond, mail
+
+
+class TkBridge:
+    """Runs pipeline jobs for a Tk widget and calls back on its thread through after()
+
+    Worker threads never touch Tk: callbacks are queued and the widget drains
+    the queue every poll_interval milliseconds.
+    """
+
+    def __init__(self, widget, pipeline, poll_interval=50):
+        self.widget = widget
+        self.pipeline = pipeline
+        self.poll_interval = poll_interval
+        self._callbacks = queue.Queue()
+        self._jobs = []
+        self.widget.after(self.poll_interval, self._drain)
+
+    def submit(self, job, on_done=None, on_error=None):
+        """Run job(token); on_done(result) or on_error(exception) are called on the Tk thread"""
+        submitted = self.pipeline.submit(job)
+        self._jobs.append(submitted)
+
+        def finished(future):
+            if future.cancelled():
+                return
+            error = future.exception()
+            if error is not None:
+                if on_error and not isinstance(error, PipelineCancelledError):
+                    self.call(on_error, error)
+            elif on_done:
+                self.call(on_done, future.result())
+
+        submitted.future.add_done_callback(finished)
+        return submitted
+
+    def call(self, callback, *args):
+        """Schedule callback(*args) on the Tk thread; safe from any thread"""
+        self._callbacks.put((callback, args))
+
+    def cancel_all(self):
+        for job in self._jobs:
+            job.cancel()
+        self._jobs = []
+
+    def _drain(self):
+        while True:
+            try:
+                callback, args = self._callbacks.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                callback(*args)
+            except Exception as e:
+                print(f"Callback error: {e}")
+        self._jobs = [job for job in self._jobs if not job.done()]
+        try:
+            if self.widget.winfo_exists():
+                self.widget.after(self.poll_interval, self._drain)
+        except Exception:
+            pass  # widget destroyed
+
+
+# Shared by the whole application
+pipeline = Pipeline()
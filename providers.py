@@ -0,0 +1,275 @@
+"""
+LLM provider registry for the Mail Assistant application.
+Every entry of the "providers" block of config.json becomes a provider whose
+client is created once and reused, so its HTTP connections stay open between
+mails. All providers answer through the same complete(messages, **opts) call.
+"""
+
+import os
+import threading
+import time
+
+import ollama
+import requests
+from groq import Groq
+from openai import OpenAI
+
+
+class UnknownProviderError(KeyError):
+    """Raised when a provider is not declared in config.json"""
+
+
+class Provider:
+    """One configured LLM backend"""
+
+    # Config keys that set up the client rather than the request
+    CLIENT_KEYS = ("type", "label", "fallback", "json_mode")
+    # How the provider is told to answer in JSON, unless config sets "json_mode"
+    DEFAULT_JSON_MODE = None
+
+    def __init__(self, name, provider_config):
+        self.name = name
+        self.config = provider_config
+        self.label = provider_config.get("label", name)
+        self.fallback = provider_config.get("fallback")
+        self.json_mode = provider_config.get("json_mode", self.DEFAULT_JSON_MODE)
+        self.request_params = {
+            key: value for key, value in provider_config.items() if key not in self.CLIENT_KEYS
+        }
+
+    def complete(self, messages, **opts):
+        """Return the text of the model answer; opts override config request parameters"""
+        raise NotImplementedError
+
+    def stream(self, messages, on_response=None, **opts):
+        """Yield the model answer as text deltas; providers without streaming yield it whole.
+
+        on_response(response) is called with the HTTP response being read,
+        when the client exposes it: closing it from another thread stops the
+        generation. Closing the generator closes the response as well.
+        """
+        yield self.complete(messages, **opts)
+
+    def json_options(self, schema):
+        """Request options that make the model answer with JSON matching schema"""
+        return {}
+
+
+class OllamaProvider(Provider):
+    """Ollama server, through one ollama.Client"""
+
+    CLIENT_KEYS = Provider.CLIENT_KEYS + ("host",)
+    DEFAULT_JSON_MODE = "schema"
+
+    def __init__(self, name, provider_config):
+        super().__init__(name, provider_config)
+        self.client = ollama.Client(host=provider_config.get("host"))
+
+    def complete(self, messages, **opts):
+        params = dict(self.request_params, **opts)
+        try:
+            response = self.client.chat(messages=messages, **params)
+        except ollama.ResponseError as e:
+            self._pull_missing_model(e, params["model"])
+            # Retry after downloading
+            response = self.client.chat(messages=messages, **params)
+        return response["message"]["content"]
+
+    def stream(self, messages, on_response=None, **opts):
+        # The ollama client does not expose its response; closing this
+        # generator closes it, between two chunks
+        params = dict(self.request_params, **opts)
+        params["stream"] = True
+        try:
+            chunks = iter(self.client.chat(messages=messages, **params))
+            # A missing model is reported when the first chunk is read
+            first = next(chunks, None)
+        except ollama.ResponseError as e:
+            self._pull_missing_model(e, params["model"])
+            chunks = iter(self.client.chat(messages=messages, **params))
+            first = next(chunks, None)
+        try:
+            if first is None:
+                return
+            yield first["message"]["content"]
+            for chunk in chunks:
+                yield chunk["message"]["content"]
+        finally:
+            chunks.close()
+
+    def _pull_missing_model(self, error, model):
+        if "not found" not in str(error).lower():
+            raise error
+        print(f"Model '{model}' not found. Downloading...")
+        self.client.pull(model)
+
+    def json_options(self, schema):
+        # Ollama constrains decoding to the schema itself, or to any JSON
+        if self.json_mode == "schema":
+            return {"format": schema}
+        if self.json_mode == "json":
+            return {"format": "json"}
+        return {}
+
+
+class OpenAICompatibleProvider(Provider):
+    """Any OpenAI-compatible chat completions endpoint (AnythingLLM, LM Studio, vLLM...)"""
+
+    CLIENT_KEYS = Provider.CLIENT_KEYS + ("base_url", "api_key", "api_key_env", "timeout", "max_retries")
+
+    def __init__(self, name, provider_config):
+        super().__init__(name, provider_config)
+        self.client = self._create_client()
+
+    def _api_key(self):
+        if "api_key_env" in self.config:
+            return os.environ.get(self.config["api_key_env"])
+        return self.config.get("api_key")
+
+    def _create_client(self):
+        return OpenAI(
+            base_url=self.config.get("base_url"),
+            api_key=self._api_key(),
+            timeout=self.config.get("timeout", 600),
+            max_retries=self.config.get("max_retries", 2)
+        )
+
+    def complete(self, messages, **opts):
+        completion = self.client.chat.completions.create(
+            messages=messages,
+            **dict(self.request_params, **opts)
+        )
+        return completion.choices[0].message.content
+
+    def stream(self, messages, on_response=None, **opts):
+        params = dict(self.request_params, **opts)
+        params["stream"] = True
+        response = self.client.chat.completions.create(messages=messages, **params)
+        if on_response:
+            on_response(response)
+        try:
+            for chunk in response:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            # Dropping the connection is how the server learns to stop generating
+            response.close()
+
+    def json_options(self, schema):
+        # Servers differ in what they accept, so this is opt-in through config
+        if self.json_mode == "json_object":
+            return {"response_format": {"type": "json_object"}}
+        if self.json_mode == "json_schema":
+            return {"response_format": {"type": "json_schema", "json_schema": {"name": "answer", "schema": schema}}}
+        return {}
+
+
+class GroqProvider(OpenAICompatibleProvider):
+    """Groq cloud API; the key comes from GROQ_API_KEY unless configured"""
+
+    DEFAULT_JSON_MODE = "json_object"
+
+    def _create_client(self):
+        return Groq(
+            api_key=self._api_key(),
+            timeout=self.config.get("timeout", 600),
+            max_retries=self.config.get("max_retries", 2)
+        )
+
+
+class GenieProvider(OpenAICompatibleProvider):
+    """The bundled Genie server, which is waited for until its model has warmed up"""
+
+    CLIENT_KEYS = OpenAICompatibleProvider.CLIENT_KEYS + ("ready_timeout",)
+
+    def __init__(self, name, provider_config):
+        super().__init__(name, provider_config)
+        self._ready = False
+
+    def complete(self, messages, **opts):
+        self.wait_until_ready()
+        return super().complete(self._ascii_messages(messages), **opts)
+
+    def stream(self, messages, on_response=None, **opts):
+        self.wait_until_ready()
+        yield from super().stream(self._ascii_messages(messages), on_response=on_response, **opts)
+
+    @staticmethod
+    def _ascii_messages(messages):
+        # The Genie prompt format only handles ASCII reliably
+        return [
+            {
+                "role": m["role"],
+                "content": "".join([c for c in m["content"] if ord(c) < 128])
+            } for m in messages
+        ]
+
+    def wait_until_ready(self):
+        # Wait for the Genie server to finish loading its model instead of
+        # letting the first request absorb the load time and time out
+        if self._ready:
+            return
+        server_url = self.config["base_url"].rstrip("/")
+        if server_url.endswith("/v1"):
+            server_url = server_url[:-len("/v1")]
+        deadline = time.monotonic() + self.config.get("ready_timeout", 180)
+        while True:
+            try:
+                response = requests.get(f"{server_url}/health/ready", timeout=5)
+                if response.status_code == 200:
+                    self._ready = True
+                    return
+                warmup = response.json().get("warmup", {})
+                if warmup.get("status") == "failed":
+                    raise RuntimeError(f"Genie warm-up failed: {warmup.get('error')}")
+            except requests.RequestException:
+                pass  # server not listening yet
+            if time.monotonic() > deadline:
+                raise TimeoutError("Genie server is not ready")
+            print("Waiting for the Genie server to warm up...")
+            time.sleep(1)
+
+
+# Provider "type" values usable in config.json
+PROVIDER_TYPES = {
+    "ollama": OllamaProvider,
+    "openai": OpenAICompatibleProvider,
+    "groq": GroqProvider,
+    "genie": GenieProvider,
+}
+
+
+class ProviderRegistry:
+    """Providers declared in config.json, each created on first use and then reused"""
+
+    def __init__(self, providers_config):
+        self.providers_config = providers_config
+        self._providers = {}
+        self._lock = threading.Lock()
+
+    def configure(self, providers_config):
+        """Switch to a new providers block; clients of unchanged providers are kept"""
+        with self._lock:
+            for name, provider in list(self._providers.items()):
+                if providers_config.get(name) != provider.config:
+                    del self._providers[name]
+            self.providers_config = providers_config
+
+    def names(self):
+        return list(self.providers_config)
+
+    def labels(self):
+        """(label, name) pairs for provider pickers"""
+        return [(provider_config.get("label", name), name) for name, provider_config in self.providers_config.items()]
+
+    def get(self, name):
+        with self._lock:
+            provider = self._providers.get(name)
+            if provider is None:
+                if name not in self.providers_config:
+                    raise UnknownProviderError(name)
+                provider_config = self.providers_config[name]
+                # Built-in providers are typed by their name, new ones say which API they speak
+                provider_type = provider_config.get("type", name if name in PROVIDER_TYPES else "openai")
+                provider = self._providers[name] = PROVIDER_TYPES[provider_type](name, provider_config)
+            return provider
@@ -0,0 +1,372 @@
+"""
+Provider routing for the Mail Assistant application.
+Requests go to the selected provider and, when it fails, to its fallbacks.
+Rolling latency and error statistics are kept per provider, a circuit
+breaker skips backends that keep failing, and a slow local provider can be
+hedged with a second one. Every routing decision is logged.
+"""
+
+import json
+import queue
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from config_settings import get_absolute_path
+
+
+class NoProviderAvailableError(RuntimeError):
+    """Raised when the circuit of every candidate provider is open"""
+
+
+def percentile(samples, q):
+    """Nearest-rank percentile of samples, None when there are none"""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return round(ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))], 3)
+
+
+class ProviderHealth:
+    """Rolling latency and outcomes of one provider, with its circuit breaker.
+
+    The circuit opens after failure_threshold consecutive failures, or when
+    error_rate of the last requests failed (once there are min_requests of
+    them). After reset_seconds a single probe request is let through: it
+    closes the circuit if it succeeds and opens it again if it fails.
+    """
+
+    def __init__(self, name, window=50, failure_threshold=3, error_rate=0.5,
+                 min_requests=10, reset_seconds=60, on_change=None):
+        self.name = name
+        self.first_token = deque(maxlen=window)  # seconds until the first text, streamed answers only
+        self.total = deque(maxlen=window)  # seconds until the whole answer
+        self.outcomes = deque(maxlen=window)  # True for success
+        self.failure_threshold = failure_threshold
+        self.error_rate_threshold = error_rate
+        self.min_requests = min_requests
+        self.reset_seconds = reset_seconds
+        self.on_change = on_change
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Whether a request may be sent now; claims the probe of a half-open circuit"""
+        with self._lock:
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self._set_state("half_open")
+            if self.state == "half_open":
+                if self._probing:
+                    return False
+                self._probing = True
+            return self.state != "open"
+
+    def record_success(self, first_token, total):
+        """first_token is None for answers received whole, which only tell the total time"""
+        with self._lock:
+            if first_token is not None:
+                self.first_token.append(first_token)
+            self.total.append(total)
+            self.outcomes.append(True)
+            self.consecutive_failures = 0
+            self._probing = False
+            if self.state != "closed":
+                self._set_state("closed")
+
+    def record_failure(self):
+        with self._lock:
+            self.outcomes.append(False)
+            self.consecutive_failures += 1
+            probe_failed = self.state == "half_open"
+            self._probing = False
+            if self.state != "open" and (probe_failed or self._failing()):
+                self.opened_at = time.monotonic()
+                self._set_state("open")
+
+    def record_cancelled(self):
+        """A request abandoned by the router says nothing about the provider"""
+        with self._lock:
+            self._probing = False
+
+    def error_rate(self):
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "state": self.state,
+                "requests": len(self.outcomes),
+                "error_rate": round(self.error_rate(), 3),
+                "first_token_p50": percentile(self.first_token, 0.5),
+                "first_token_p95": percentile(self.first_token, 0.95),
+                "total_p50": percentile(self.total, 0.5),
+                "total_p95": percentile(self.total, 0.95)
+            }
+
+    def _failing(self):
+        if self.consecutive_failures >= self.failure_threshold:
+            return True
+        return len(self.outcomes) >= self.min_requests and self.error_rate() >= self.error_rate_threshold
+
+    def _set_state(self, state):
+        previous, self.state = self.state, state
+        if self.on_change:
+            self.on_change(self.name, previous, state)
+
+
+class _Run:
+    """One provider request running on its own thread"""
+
+    def __init__(self, provider):
+        self.provider = provider
+        self.cancelled = threading.Event()
+        self.finished = False
+        self.response = None  # HTTP response being streamed, when the provider exposes it
+        self._lock = threading.Lock()
+
+    def set_response(self, response):
+        with self._lock:
+            self.response = response
+            cancelled = self.cancelled.is_set()
+        if cancelled:
+            self._close(response)
+
+    def cancel(self):
+        """Stop the request, closing its connection so the provider stops generating"""
+        with self._lock:
+            self.cancelled.set()
+            response = self.response
+        if response is not None:
+            self._close(response)
+
+    def _close(self, response):
+        try:
+            response.close()
+        except Exception as e:
+            print(f"Could not close the response of {self.provider.name}: {e}")
+
+
+class Router:
+    """Routes completions over a ProviderRegistry using the "routing" block of config.json"""
+
+    def __init__(self, registry, routing_config=None):
+        self.registry = registry
+        self.breaker_config = None
+        self._health = {}
+        self._lock = threading.Lock()
+        self._log_lock = threading.Lock()
+        self.configure(routing_config)
+
+    def configure(self, routing_config):
+        """Apply a routing block; statistics are kept unless the window or breaker changed"""
+        routing_config = routing_config or {}
+        window = routing_config.get("window", 50)
+        breaker_config = routing_config.get("circuit_breaker", {})
+        if self.breaker_config is not None and (window, breaker_config) != (self.window, self.breaker_config):
+            with self._lock:
+                self._health = {}
+        self.window = window
+        self.breaker_config = breaker_config
+        # Providers tried after the selected one and its own fallbacks, fastest first
+        self.fallbacks = routing_config.get("fallbacks", [])
+        hedging = routing_config.get("hedging", {})
+        self.hedging_enabled = hedging.get("enabled", False)
+        self.hedge_providers = hedging.get("providers", [])
+        self.hedge_after = hedging.get("after_seconds", 8.0)
+        self.hedge_min_after = hedging.get("min_after_seconds", 2.0)
+        self.hedge_min_samples = hedging.get("min_samples", 5)
+        log_file = routing_config.get("log_file")
+        self.log_file = get_absolute_path(log_file) if log_file else None
+
+    def complete(self, name, messages, schema=None, **opts):
+        """Return the answer text; schema asks each provider for JSON in its own way"""
+        return "".join(self._route(name, messages, False, schema, opts))
+
+    def stream(self, name, messages, schema=None, **opts):
+        """Yield the answer as text deltas"""
+        return self._route(name, messages, True, schema, opts)
+
+    def health(self, name):
+        with self._lock:
+            if name not in self._health:
+                self._health[name] = ProviderHealth(
+                    name, window=self.window, on_change=self._log_circuit, **self.breaker_config
+                )
+            return self._health[name]
+
+    def stats(self):
+        """Latency percentiles, error rate and circuit state of every provider used so far"""
+        with self._lock:
+            healths = list(self._health.values())
+        return {health.name: health.snapshot() for health in healths}
+
+    def candidates(self, name):
+        """The selected provider, its fallback chain, then the configured fallbacks by latency"""
+        chain = []
+        while name and name not in chain:
+            chain.append(name)
+            name = self.registry.get(name).fallback
+        extra = [name for name in self.fallbacks if name not in chain]
+        # Providers never measured keep their configured order, after the measured ones
+        extra.sort(key=lambda n: (self.health(n).snapshot()["total_p50"] is None,
+                                  self.health(n).snapshot()["total_p50"] or 0))
+        return chain + extra
+
+    def _route(self, name, messages, streaming, schema, opts):
+        last_error = None
+        tried = []
+        for candidate in self.candidates(name):
+            if not self.health(candidate).allow():
+                self._log("skip", provider=candidate, reason="circuit open")
+                continue
+            if tried:
+                self._log("fallback", provider=candidate, after=tried[-1], error=str(last_error))
+            tried.append(candidate)
+            started = False
+            try:
+                for delta in self._attempt(self.registry.get(candidate), messages, streaming, schema, opts):
+                    started = True
+                    yield delta
+                return
+            except Exception as e:
+                # Text already shown to the user cannot be taken back
+                if started:
+                    raise
+                last_error = e
+        if last_error is None:
+            raise NoProviderAvailableError(f"Circuit open for every provider of '{name}'")
+        raise last_error
+
+    def _attempt(self, provider, messages, streaming, schema, opts):
+        """Deltas of one provider, hedged with a second local one if it is slow to start"""
+        results = queue.Queue()
+        runs = [self._start(provider, messages, streaming, schema, opts, results)]
+        self._log("attempt", provider=provider.name)
+        hedge_delay = self._hedge_delay(provider.name)
+        winner = None
+        try:
+            while winner is None:
+                try:
+                    run, kind, value = results.get(timeout=hedge_delay)
+                except queue.Empty:
+                    hedge_delay = None
+                    hedge = self._hedge_partner(provider.name)
+                    if hedge is not None:
+                        self._log("hedge", provider=hedge.name, primary=provider.name)
+                        runs.append(self._start(hedge, messages, streaming, schema, opts, results))
+                    continue
+                if kind == "error":
+                    run.finished = True
+                    self._log("failure", provider=run.provider.name, error=str(value))
+                    if all(r.finished for r in runs):
+                        raise value
+                    continue
+                winner = run
+                if len(runs) > 1:
+                    self._log("winner", provider=winner.provider.name, over=[r.provider.name for r in runs if r is not winner])
+                for other in runs:
+                    if other is not winner:
+                        other.cancel()
+
+            # Answers of the losing provider may still be queued; only the winner's count
+            while True:
+                if kind == "delta":
+                    yield value
+                elif kind == "done":
+                    return
+                else:
+                    self._log("failure", provider=winner.provider.name, error=str(value))
+                    raise value
+                run, kind, value = results.get()
+                while run is not winner:
+                    run, kind, value = results.get()
+        finally:
+            for run in runs:
+                run.cancel()
+
+    def _start(self, provider, messages, streaming, schema, opts, results):
+        run = _Run(provider)
+        options = dict(provider.json_options(schema) if schema else {}, **opts)
+        # Hedged providers stream even for complete(): a streamed request is
+        # the one a losing run can be stopped in the middle of
+        streaming = streaming or self._hedged(provider.name)
+        threading.Thread(
+            target=self._pump, args=(run, messages, streaming, options, results), daemon=True
+        ).start()
+        return run
+
+    def _pump(self, run, messages, streaming, options, results):
+        health = self.health(run.provider.name)
+        start = time.monotonic()
+        first_token = None
+        deltas = None
+        try:
+            if streaming:
+                deltas = run.provider.stream(messages, on_response=run.set_response, **options)
+            else:
+                deltas = iter([run.provider.complete(messages, **options)])
+            for delta in deltas:
+                if run.cancelled.is_set():
+                    health.record_cancelled()
+                    return
+                if first_token is None:
+                    first_token = time.monotonic() - start
+                results.put((run, "delta", delta))
+            if run.cancelled.is_set():
+                # A closed response may just end the stream early
+                health.record_cancelled()
+                return
+        except Exception as e:
+            if run.cancelled.is_set():
+                health.record_cancelled()
+            else:
+                health.record_failure()
+            results.put((run, "error", e))
+            return
+        finally:
+            if deltas is not None and hasattr(deltas, "close"):
+                # Closes the provider's response when the run stopped early
+                deltas.close()
+        total = time.monotonic() - start
+        # An answer received whole says nothing about the time to its first token
+        health.record_success(first_token if streaming else None, total)
+        results.put((run, "done", None))
+
+    def _hedged(self, name):
+        return self.hedging_enabled and name in self.hedge_providers
+
+    def _hedge_delay(self, name):
+        """Seconds to wait for the first text before hedging, None when not hedging"""
+        if not self._hedged(name):
+            return None
+        # Once enough is known, hedge the slowest 5% of requests rather than at a fixed time
+        health = self.health(name)
+        if len(health.first_token) >= self.hedge_min_samples:
+            return max(self.hedge_min_after, health.snapshot()["first_token_p95"])
+        return self.hedge_after
+
+    def _hedge_partner(self, name):
+        for candidate in self.hedge_providers:
+            if candidate != name and candidate in self.registry.names() and self.health(candidate).allow():
+                return self.registry.get(candidate)
+        self._log("hedge_skipped", primary=name, reason="no healthy local provider")
+        return None
+
+    def _log_circuit(self, name, previous, state):
+        self._log("circuit", provider=name, previous=previous, state=state)
+
+    def _log(self, decision, **details):
+        print(f"Routing: {decision} {details}")
+        if not self.log_file:
+            return
+        entry = {"time": datetime.now().isoformat(timespec="milliseconds"), "decision": decision}
+        entry.update(details)
+        with self._log_lock:
+            with open(self.log_file, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
@@ -0,0 +1,460 @@
+"""
+Settings service for the Mail Assistant application.
+config.json, user_data.json and directory.json are parsed once, kept in
+memory and reloaded when they change on disk, so edits apply without a
+restart and the hot path never re-reads them. Paths are resolved against
+the application directory.
+
+Changes to user_data.json and directory.json are appended to a journal
+next to the file (user_data.json.journal) instead of rewriting it, and
+folded back into the file in the background. Writes hold a lock shared
+by the threads of this process and by other processes.
+"""
+
+import copy
+import json
+import os
+import threading
+import time
+import zlib
+
+from config_settings import CONFIG_FILE, USER_DATA_FILE, DIRECTORY_FILE, get_absolute_path
+from keys import person_key
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+_UNLOADED = object()
+_encode_item = json.JSONEncoder(ensure_ascii=False).encode
+
+# The journal is folded into the file after this many seconds without changes,
+# or sooner once it is larger than COMPACT_RATIO times the file (and COMPACT_MIN_BYTES)
+COMPACT_DELAY = 2.0
+COMPACT_RATIO = 0.5
+COMPACT_MIN_BYTES = 64 * 1024
+
+
+class SettingsError(ValueError):
+    """Raised when a settings file is missing required values or is not valid JSON"""
+
+
+def _lock_file(f):
+    if os.name == "nt":
+        f.seek(0)
+        while True:
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                pass  # LK_LOCK gives up after 10 seconds, keep waiting
+    else:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+
+def _unlock_file(f):
+    if os.name == "nt":
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class FileLock:
+    """An exclusive lock held across the threads of this process and other processes.
+
+    Reentrant within a thread. Other processes see it through a lock file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        if self._depth == 0:
+            try:
+                self._file = open(self.path, "a+b")
+                _lock_file(self._file)
+            except BaseException:
+                if self._file:
+                    self._file.close()
+                    self._file = None
+                self._thread_lock.release()
+                raise
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self._depth -= 1
+        if self._depth == 0:
+            _unlock_file(self._file)
+            self._file.close()
+            self._file = None
+        self._thread_lock.release()
+
+
+class JsonFile:
+    """A JSON file parsed once and reloaded when its modification time changes.
+
+    The parsed value is shared: change it through save() or update(), not in
+    place. Changes are applied to a copy that then replaces it, so a value
+    returned by load() never changes under its reader. With journal=True,
+    update() appends its records to the journal in one write, and a
+    background thread folds the journal into the file:
+
+        {"set": {key: value}} / {"unset": [key]}   for an object
+        {"put": item} / {"delete": key}            for a list of items with a key()
+
+    The journal starts with the checksum of the file it applies to, so a
+    journal left behind by a crash during compaction, or older than a
+    rewrite of the file, is never replayed twice.
+    """
+
+    def __init__(self, filename, default=None, validate=None, check_interval=0.5, item_per_line=False,
+                 journal=False, key=None):
+        self.path = get_absolute_path(filename)
+        self.journal_path = self.path + ".journal"
+        self.default = default
+        self.validate = validate
+        # Seconds between two checks of the file on disk
+        self.check_interval = check_interval
+        # Write a list with one compact item per line: readable, and encoded
+        # by the C encoder, which json.dump(indent=...) never uses
+        self.item_per_line = item_per_line
+        self.journal = journal
+        self.key = key  # key(item) of the items of a list, for "put" and "delete"
+        self.lock = FileLock(self.path + ".lock")
+        self.version = 0  # increases on every (re)load and change
+        self._data = _UNLOADED
+        self._stamp = None  # (file stamp, journal stamp)
+        self._checksum = None  # of the file the journal applies to
+        self._journal_offset = 0  # bytes of the journal applied to _data
+        self._positions = None  # key -> index in a list, built on demand
+        self._positions_of = None
+        self._checked = 0.0
+        self._listeners = []
+        self._lock = threading.RLock()
+        self._last_change = 0.0
+        self._compactor = None
+        self._wake = threading.Event()
+
+    def load(self):
+        """The parsed file, or a copy of default when it does not exist"""
+        with self._lock:
+            now = time.monotonic()
+            if self._data is not _UNLOADED and now - self._checked < self.check_interval:
+                return self._data
+            self._checked = now
+            if self._data is not _UNLOADED and self._stamps() == self._stamp:
+                return self._data
+
+            reload = self._data is not _UNLOADED
+            try:
+                if self.journal:
+                    with self.lock:
+                        self._sync()
+                else:
+                    self._sync()
+            except (OSError, ValueError) as e:
+                if not reload:
+                    raise SettingsError(f"{self.path}: {e}") from e
+                # Keep the last good settings while the file is being edited
+                print(f"Ignoring invalid {self.path}: {e}")
+                self._stamp = self._stamps()
+                return self._data
+            data = self._data
+            listeners = list(self._listeners) if reload else []
+            # A journal left by an earlier run or another process
+            leftover_journal = self.journal and self._stamp[1] is not None
+        if leftover_journal:
+            self._schedule_compaction()
+        if reload:
+            print(f"Reloaded {self.path}")
+        for listener in listeners:
+            listener(data)
+        return data
+
+    def save(self, data):
+        """Validate and write data atomically, then serve it from memory"""
+        if self.validate:
+            self.validate(data)
+        with self._lock, self.lock:
+            self._write(data)
+            self._data = data
+            self.version += 1
+
+    def update(self, records):
+        """Apply journal records and append them to the journal with one write"""
+        if not self.journal:
+            raise ValueError(f"{self.path} has no journal")
+        if not records:
+            return
+        lines = b"".join(json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n" for record in records)
+        with self._lock, self.lock:
+            # Changes from other processes first, so records apply in journal order
+            self._sync()
+            data = self._copy(self._data)
+            for record in records:
+                data = self._apply(data, record)
+            if self._stamp[1] is None:
+                header = json.dumps({"checksum": self._checksum}).encode("utf-8") + b"\n"
+                with open(self.journal_path, "wb") as f:
+                    f.write(header + lines)
+                    f.flush()
+                    os.fsync(f.fileno())
+                self._journal_offset = len(header) + len(lines)
+            else:
+                with open(self.journal_path, "r+b") as f:
+                    # Overwrites a record torn by a crash, if any
+                    f.seek(self._journal_offset)
+                    f.write(lines)
+                    f.truncate()
+                    f.flush()
+                    os.fsync(f.fileno())
+                self._journal_offset += len(lines)
+            self._data = data
+            self._stamp = self._stamps()
+            self._checked = time.monotonic()
+            self.version += 1
+            self._last_change = time.monotonic()
+        self._schedule_compaction()
+
+    def compact(self):
+        """Fold the journal into the file"""
+        with self._lock, self.lock:
+            self._sync()
+            if self._stamp[1] is not None:
+                # The data does not change, so neither does version
+                self._write(self._data)
+
+    def delete(self):
+        """Remove the file; load() returns default from now on"""
+        with self._lock, self.lock:
+            for path in (self.path, self.journal_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            self._data, self._checksum, self._journal_offset = copy.deepcopy(self.default), None, 0
+            self._stamp = self._stamps()
+            self._checked = time.monotonic()
+            self.version += 1
+
+    def exists(self):
+        return os.path.exists(self.path) or (self.journal and os.path.exists(self.journal_path))
+
+    def on_change(self, listener):
+        """Call listener(data) whenever the file is reloaded after a change on disk"""
+        self._listeners.append(listener)
+
+    def __getitem__(self, key):
+        return self.load()[key]
+
+    def get(self, key, default=None):
+        return self.load().get(key, default)
+
+    def _stamps(self):
+        journal_stamp = self._file_stamp(self.journal_path) if self.journal else None
+        return self._file_stamp(self.path), journal_stamp
+
+    def _file_stamp(self, path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _sync(self):
+        """Bring _data up to date with the file and its journal; call with self.lock held if journaled"""
+        stamp = self._stamps()
+        if self._data is not _UNLOADED and stamp == self._stamp:
+            return
+        file_stamp, journal_stamp = stamp
+        if (self._data is _UNLOADED or file_stamp != self._stamp[0]
+                or journal_stamp is None or journal_stamp[1] < self._journal_offset):
+            data, checksum = self._read()
+            offset = 0
+        else:
+            # Only new journal records, appended by another process
+            data, checksum, offset = self._copy(self._data), self._checksum, self._journal_offset
+        if journal_stamp is not None:
+            data, offset = self._replay(data, offset, checksum)
+        self._data, self._checksum, self._journal_offset = data, checksum, offset
+        self._stamp = self._stamps()
+        self.version += 1
+
+    def _read(self):
+        """The parsed file and its checksum"""
+        try:
+            with open(self.path, "rb") as f:
+                raw = f.read()
+        except FileNotFoundError:
+            return copy.deepcopy(self.default), None
+        data = json.loads(raw.decode("utf-8"))
+        if self.validate:
+            self.validate(data)
+        return data, zlib.crc32(raw)
+
+    def _replay(self, data, offset, checksum):
+        """Apply the journal records after offset; returns the data and the offset reached"""
+        with open(self.journal_path, "rb") as f:
+            f.seek(offset)
+            if offset == 0:
+                header = f.readline()
+                try:
+                    stale = json.loads(header)["checksum"] != checksum
+                except (ValueError, KeyError, TypeError):
+                    stale = True  # torn while being created
+                if stale:
+                    print(f"Discarding {self.journal_path}: it does not apply to the current {self.path}")
+                    f.close()
+                    os.remove(self.journal_path)
+                    return data, 0
+                offset = len(header)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # torn by a crash during an append, overwritten by the next one
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                data = self._apply(data, record)
+                offset += len(line)
+        return data, offset
+
+    def _apply(self, data, record):
+        if "set" in record:
+            data = {} if data is None else data
+            data.update(record["set"])
+        elif "unset" in record:
+            for key in record["unset"]:
+                data.pop(key, None)
+        elif "put" in record:
+            item = record["put"]
+            positions = self._item_positions(data)
+            key = self.key(item)
+            if key in positions:
+                data[positions[key]] = item
+            else:
+                positions[key] = len(data)
+                data.append(item)
+        elif "delete" in record:
+            positions = self._item_positions(data)
+            index = positions.pop(record["delete"], None)
+            if index is not None:
+                del data[index]
+                # Later items moved up; cheaper than calling key() on every item again
+                for key, position in positions.items():
+                    if position > index:
+                        positions[key] = position - 1
+        else:
+            raise ValueError(f"Unknown journal record in {self.journal_path}: {record}")
+        return data
+
+    def _copy(self, data):
+        """A shallow copy of data for records to change; the item positions follow it"""
+        if isinstance(data, list):
+            copied = list(data)
+        elif isinstance(data, dict):
+            copied = dict(data)
+        else:
+            return data
+        if self._positions_of is data:
+            # Left behind, and rebuilt on demand, if the records fail to apply
+            self._positions_of = copied
+        return copied
+
+    def _item_positions(self, data):
+        if self._positions is None or self._positions_of is not data:
+            self._positions = {self.key(item): index for index, item in enumerate(data)}
+            self._positions_of = data
+        return self._positions
+
+    def _write(self, data):
+        """Replace the file atomically with data, then drop the journal it includes"""
+        if self.item_per_line and isinstance(data, list):
+            text = "[\n" + ",\n".join(map(_encode_item, data)) + "\n]\n"
+        else:
+            text = json.dumps(data, indent=2, ensure_ascii=False)
+        raw = text.encode("utf-8")
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(raw)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        # A crash before this line leaves a journal whose checksum no longer matches
+        if self.journal and os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self._checksum, self._journal_offset = zlib.crc32(raw), 0
+        self._stamp = self._stamps()
+        self._checked = time.monotonic()
+
+    def _schedule_compaction(self):
+        with self._lock:
+            if self._compactor is None:
+                self._compactor = threading.Thread(target=self._compact_in_background, daemon=True)
+                self._compactor.start()
+        self._wake.set()
+
+    def _compact_in_background(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            # Let a burst of changes end, unless the journal is already large
+            while True:
+                remaining = self._last_change + COMPACT_DELAY - time.monotonic()
+                file_size = self._stamp[0][1] if self._stamp and self._stamp[0] else 0
+                if remaining <= 0 or self._journal_offset >= max(COMPACT_MIN_BYTES, file_size * COMPACT_RATIO):
+                    break
+                self._wake.wait(remaining)
+                self._wake.clear()
+            try:
+                self.compact()
+            except OSError as e:
+                print(f"Could not compact {self.journal_path}: {e}")
+
+
+def validate_config(config):
+    """Check the values the application relies on, reporting all problems at once"""
+    if not isinstance(config, dict):
+        raise SettingsError("config.json must hold a JSON object")
+    problems = [
+        f"missing '{section}' section"
+        for section in ("providers", "mail_generation", "audio", "transcription", "keybindings")
+        if not isinstance(config.get(section), dict)
+    ]
+    if problems:
+        raise SettingsError("; ".join(problems))
+
+    providers = config["providers"]
+    if not providers:
+        problems.append("no provider in 'providers'")
+    if config["mail_generation"].get("default_provider") not in providers:
+        problems.append("'mail_generation.default_provider' is not one of 'providers'")
+    if not config["mail_generation"].get("system_prompt"):
+        problems.append("'mail_generation.system_prompt' is empty")
+    for name, provider_config in providers.items():
+        fallback = provider_config.get("fallback")
+        if fallback is not None and fallback not in providers:
+            problems.append(f"fallback '{fallback}' of provider '{name}' is not one of 'providers'")
+    for name in config.get("routing", {}).get("fallbacks", []):
+        if name not in providers:
+            problems.append(f"routing fallback '{name}' is not one of 'providers'")
+    for key in ("frequency", "channels", "chunk_duration"):
+        if not isinstance(config["audio"].get(key), (int, float)):
+            problems.append(f"'audio.{key}' must be a number")
+    if not config["keybindings"].get("recording_keys"):
+        problems.append("'keybindings.recording_keys' is empty")
+    if problems:
+        raise SettingsError("; ".join(problems))
+
+
+# Shared by the whole application
+config = JsonFile(CONFIG_FILE, validate=validate_config)
+user_data = JsonFile(USER_DATA_FILE, default=None, journal=True)
+directory = JsonFile(
+    DIRECTORY_FILE, default=[], item_per_line=True, journal=True, key=lambda person: person_key(person["name"])
+)
@@ -0,0 +1,254 @@
+"""
+Structured (JSON) answers from LLM providers for the Mail Assistant application.
+Answers are parsed tolerantly and repaired when possible; only answers that
+still do not match the expected schema are retried, a bounded number of times.
+"""
+
+import json
+import re
+import threading
+import time
+
+FENCE_PATTERN = re.compile(r"```(?:json)?\s*(.*?)```", re.DOTALL | re.IGNORECASE)
+LITERALS = {"True": "true", "False": "false", "None": "null"}
+JSON_TYPES = {"object": dict, "array": list, "string": str, "number": (int, float), "integer": int, "boolean": bool}
+
+
+class StructuredOutputError(ValueError):
+    """Raised when a model answer holds no JSON matching the schema"""
+
+
+def extract_json(text):
+    """Parse the JSON value in a model answer; returns (value, repaired).
+
+    Handles code fences, text around the JSON, single quotes, Python
+    literals, unquoted keys, trailing commas, raw newlines in strings and
+    answers cut off before their closing brackets.
+    """
+    text = (text or "").strip()
+    try:
+        return json.loads(text), False
+    except ValueError:
+        pass
+
+    fenced = FENCE_PATTERN.search(text)
+    candidate = fenced.group(1).strip() if fenced else text
+    start = min((i for i in (candidate.find("{"), candidate.find("[")) if i >= 0), default=-1)
+    if start < 0:
+        raise StructuredOutputError("No JSON found in the model answer")
+    candidate = _balanced(candidate[start:])
+
+    for attempt in (candidate, _repair(candidate)):
+        try:
+            return json.loads(attempt, strict=False), True
+        except ValueError:
+            continue
+    raise StructuredOutputError("Could not repair the JSON in the model answer")
+
+
+def _balanced(text):
+    """text up to the bracket closing its first one, or all of it if never closed"""
+    depth = 0
+    quote = None
+    escaped = False
+    for i, c in enumerate(text):
+        if quote:
+            if escaped:
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c == quote:
+                quote = None
+        elif c in "\"'":
+            quote = c
+        elif c in "{[":
+            depth += 1
+        elif c in "}]":
+            depth -= 1
+            if depth == 0:
+                return text[:i + 1]
+    return text
+
+
+def _repair(text):
+    """Rewrite almost-JSON into JSON"""
+    out = []
+    closers = []
+    quote = None
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if quote:
+            if c == "\\" and i + 1 < len(text):
+                # \' is not a JSON escape
+                out.append("'" if text[i + 1] == "'" else text[i:i + 2])
+                i += 2
+                continue
+            if c == quote:
+                out.append('"')
+                quote = None
+            elif c == '"':
+                out.append('\\"')
+            elif c == "\n":
+                out.append("\\n")
+            else:
+                out.append(c)
+        elif c in "\"'":
+            quote = c
+            out.append('"')
+        elif c in "{[":
+            closers.append("}" if c == "{" else "]")
+            out.append(c)
+        elif c in "}]":
+            _drop_trailing_comma(out)
+            if closers:
+                closers.pop()
+            out.append(c)
+        elif c.isalpha() or c == "_":
+            end = i
+            while end < len(text) and (text[end].isalnum() or text[end] == "_"):
+                end += 1
+            word = text[i:end]
+            rest = text[end:].lstrip()
+            if rest.startswith(":"):
+                out.append(json.dumps(word))  # unquoted key
+            else:
+                out.append(LITERALS.get(word, word))
+            i = end
+            continue
+        else:
+            out.append(c)
+        i += 1
+
+    # Close whatever a truncated answer left open
+    if quote:
+        out.append('"')
+    _drop_trailing_comma(out)
+    out.extend(reversed(closers))
+    return "".join(out)
+
+
+def _drop_trailing_comma(out):
+    j = len(out) - 1
+    while j >= 0 and out[j].isspace():
+        j -= 1
+    if j >= 0 and out[j] == ",":
+        del out[j]
+
+
+def validate(value, schema):
+    """Check value against a small subset of JSON Schema: type, required, properties, items"""
+    expected = JSON_TYPES.get(schema.get("type"))
+    if expected and (not isinstance(value, expected) or (schema.get("type") != "boolean" and isinstance(value, bool))):
+        raise StructuredOutputError(f"Expected a JSON {schema['type']}, got {type(value).__name__}")
+    if isinstance(value, dict):
+        for key in schema.get("required", []):
+            if key not in value:
+                raise StructuredOutputError(f"Missing required key '{key}'")
+        for key, property_schema in schema.get("properties", {}).items():
+            if key in value:
+                validate(value[key], property_schema)
+    if isinstance(value, list) and "items" in schema:
+        for item in value:
+            validate(item, schema["items"])
+    if isinstance(value, str) and schema.get("minLength") and len(value.strip()) < schema["minLength"]:
+        raise StructuredOutputError("Empty string")
+
+
+class JsonFieldStream:
+    """Decodes one string field of a JSON answer while the answer is still streaming"""
+
+    def __init__(self, key):
+        self._start = re.compile(r'"%s"\s*:\s*"' % re.escape(key))
+        self._buffer = ""
+        self.started = False
+        self.finished = False
+
+    def feed(self, chunk):
+        """Add a chunk of the answer; returns the newly decoded text of the field"""
+        if self.finished:
+            return ""
+        self._buffer += chunk
+        if not self.started:
+            match = self._start.search(self._buffer)
+            if not match:
+                return ""
+            self.started = True
+            self._buffer = self._buffer[match.end():]
+
+        out = []
+        i = 0
+        buffer = self._buffer
+        while i < len(buffer):
+            c = buffer[i]
+            if c == '"':
+                self.finished = True
+                break
+            if c != "\\":
+                out.append(c)
+                i += 1
+                continue
+            # Escapes may be split across chunks; wait for the rest of them
+            length = 2
+            if buffer[i + 1:i + 2] == "u":
+                length = 6
+                if buffer[i + 2:i + 4].lower() in ("d8", "d9", "da", "db"):
+                    length = 12  # surrogate pair
+            if i + length > len(buffer):
+                break
+            try:
+                out.append(json.loads('"%s"' % buffer[i:i + length]))
+            except ValueError:
+                out.append(buffer[i + 1:i + length])
+            i += length
+        self._buffer = buffer[i:]
+        return "".join(out)
+
+
+class StructuredOutput:
+    """Asks for JSON matching a schema, repairing answers and retrying a bounded number of times"""
+
+    def __init__(self, schema, max_attempts=3, backoff=0.5):
+        self.schema = schema
+        self.max_attempts = max(1, max_attempts)
+        # Seconds before the first retry, doubled for each next one
+        self.backoff = backoff
+        self.counters = {}  # provider -> {"requests", "repaired", "retries", "failures"}
+        self._lock = threading.Lock()
+
+    def request(self, provider, messages, complete):
+        """Return the validated JSON value; complete(messages) returns the model text"""
+        self._count(provider, "requests")
+        for attempt in range(self.max_attempts):
+            answer = complete(messages)
+            try:
+                value, repaired = extract_json(answer)
+                validate(value, self.schema)
+            except StructuredOutputError as e:
+                if attempt + 1 == self.max_attempts:
+                    self._count(provider, "failures")
+                    raise StructuredOutputError(
+                        f"{provider} gave no valid JSON after {self.max_attempts} attempts: {e}"
+                    )
+                self._count(provider, "retries")
+                print(f"Invalid JSON from {provider} ({e}). Retrying ...")
+                # Show the model its mistake instead of asking the same question again
+                messages = messages + [
+                    {"role": "assistant", "content": answer or ""},
+                    {"role": "user", "content": f"That was not valid JSON ({e}). Answer again with only the JSON object."}
+                ]
+                time.sleep(self.backoff * 2 ** attempt)
+                continue
+            if repaired:
+                self._count(provider, "repaired")
+            return value
+
+    def stats(self):
+        """Per-provider counts of requests, repaired answers, retries and failures"""
+        with self._lock:
+            return {provider: dict(counts) for provider, counts in self.counters.items()}
+
+    def _count(self, provider, name):
+        with self._lock:
+            counts = self.counters.setdefault(provider, {"requests": 0, "repaired": 0, "retries": 0, "failures": 0})
+            counts[name] += 1
@@ -1,5 +1,8 @@
-import json
+import asyncio
 import os
+import queue
+import re
+import time
 import tkinter as tk
 from tkinter import messagebox
 import pyautogui
@@ -8,16 +11,21 @@ from PIL import Image, ImageDraw
 import threading
 import keyboard
 import pyperclip
-from moteur import detect_audio_and_process, generate_mail
+import settings
+from moteur import providers
+from pipeline import pipeline, TkBridge
 from user_management import load_user_data, create_registration_window
 from overlay import launch_overlay_app
 from directory_ui import open_directory_window
 from config_settings import (
-    USER_DATA_FILE, ICON_FILE, APP_NAME, MAIN_WINDOW_SIZE,
+    ICON_FILE, APP_NAME, MAIN_WINDOW_SIZE,
     TRAY_ICON_SIZE, TRAY_ICON_FALLBACK_SIZE, OVERLAY_COLOR, MAIN_HOTKEY,
-    DEFAULT_CLIPBOARD_MODE
+    DEFAULT_CLIPBOARD_MODE, CLIPBOARD_STREAM_MODE
 )
 
+# End of a sentence or line, where "paste" streaming mode pastes what it has
+PASTE_BOUNDARY = re.compile(r"[.!?:;]\s|\n")
+
 class SystemTrayApp:
     def __init__(self):
         self.tray_icon = None
@@ -26,6 +34,8 @@ class SystemTrayApp:
         self.user = None
         self.clipboard_mode = DEFAULT_CLIPBOARD_MODE  # Default mode
         self.selected_provider = None  # Selected LLM provider
+        self.clipboard_job = None  # Reply being dictated or generated in clipboard mode
+        self.bridge = None  # Runs callbacks on the main window's Tk thread
         
     def create_tray_icon(self):
         """Create a system tray icon"""
@@ -80,24 +90,77 @@ class SystemTrayApp:
             # Auto-read from clipboard
             content = self.copy_selected_content()
             if content is None:
-                messagebox.showwarning("Empty Clipboard", "No content found in clipboard!")
-                return
-            text = detect_audio_and_process(provider=self.selected_provider)
-            if text is None:
-                messagebox.showerror("Error", "Failed to process audio content!")
-                return
-            result = generate_mail(email_received=content, provider=self.selected_provider, i_want_to_respond=text)
-            if result is None:
-                messagebox.showerror("Error", "Failed to generate email response!")
                 return
-            pyperclip.copy(result)
-            pyautogui.hotkey("ctrl", "v")
+            if self.clipboard_job and not self.clipboard_job.done():
+                return  # still answering the previous mail
+            # The pipeline records, transcribes and generates on its own
+            # threads, so the hotkey thread is free as soon as this returns
+            self.clipboard_job = pipeline.submit(lambda token: self.reply_from_clipboard(content, token))
 
         else:
             # Open manual input window
-            self.open_manual_input_window()
+            self.call_on_tk(self.open_manual_input_window)
             return
 
+    def call_on_tk(self, callback, *args):
+        """Run callback(*args) on the main window's Tk thread; hotkeys and jobs run on other threads"""
+        if self.bridge:
+            self.bridge.call(callback, *args)
+        else:
+            callback(*args)
+
+    async def reply_from_clipboard(self, content, token):
+        """Dictate a reply to content and paste the generated mail"""
+        deltas = queue.Queue()
+        output = None
+        if CLIPBOARD_STREAM_MODE:
+            output = asyncio.ensure_future(pipeline.run_blocking(self.output_progressively, iter(deltas.get, None)))
+        try:
+            text, result = await pipeline.reply(content, self.selected_provider, on_delta=deltas.put, token=token)
+        except Exception as e:
+            print(f"Failed to generate email response: {e}")
+            text, result = "", None
+        finally:
+            deltas.put(None)
+        if output:
+            await output
+
+        if text is None:
+            self.call_on_tk(messagebox.showerror, "Error", "Failed to process audio content!")
+        elif not result:
+            self.call_on_tk(messagebox.showerror, "Error", "Failed to generate email response!")
+        elif CLIPBOARD_STREAM_MODE:
+            # Leave the whole draft in the clipboard as well
+            pyperclip.copy(result)
+        else:
+            await pipeline.run_blocking(self.paste, result)
+
+    def output_progressively(self, deltas):
+        """Type or paste streamed text into the focused application; returns the full text"""
+        text = ""
+        pending = ""
+        for delta in deltas:
+            text += delta
+            if CLIPBOARD_STREAM_MODE == "type":
+                keyboard.write(delta)
+                continue
+            pending += delta
+            # Paste whole sentences so the clipboard is not replaced for every token
+            boundaries = list(PASTE_BOUNDARY.finditer(pending))
+            if boundaries:
+                cut = boundaries[-1].end()
+                self.paste(pending[:cut])
+                pending = pending[cut:]
+        if pending:
+            self.paste(pending)
+        return text
+
+    def paste(self, text):
+        pyperclip.copy(text)
+        pyautogui.hotkey("ctrl", "v")
+        # Give the target application time to read the clipboard before it changes
+        time.sleep(0.05)
+
             
     def start_overlay(self, icon=None, item=None):
         """Start the overlay application"""
@@ -159,7 +222,8 @@ class SystemTrayApp:
 
         # Button to reset profile
         def reset_profile():
-            os.remove(USER_DATA_FILE)
+            settings.user_data.delete()
+            self.bridge = None
             root.destroy()
             self.user = None
             create_registration_window(self)
@@ -175,6 +239,7 @@ class SystemTrayApp:
         tk.Button(root, text="Edit Profile", command=reset_profile).pack(pady=10)
 
         self.main_window = root
+        self.bridge = TkBridge(root, pipeline)
         root.mainloop()
         
     def launch_overlay_app(self):
@@ -193,14 +258,8 @@ class SystemTrayApp:
         current_provider = self.selected_provider or "ollama"
         provider_var = tk.StringVar(value=current_provider)
 
-        providers = [
-            ("Groq (Online, Best)", "groq"),
-            ("Ollama (CPU/GPU, 3rd party, Local)", "ollama"),
-            ("AnythingLLM (NPU, 3rd party, Local)", "anythingllm"),
-            ("Genie (NPU, Qualcomm, Slow, Local)", "genie")
-        ]
-
-        for display_name, provider_id in providers:
+        # Every provider declared in config.json
+        for display_name, provider_id in providers.labels():
             tk.Radiobutton(
                 provider_window,
                 text=display_name,
@@ -244,10 +303,12 @@ class SystemTrayApp:
     def save_user_preferences(self):
         """Save user preferences including clipboard mode and selected provider"""
         if self.user:
-            self.user['clipboard_mode'] = self.clipboard_mode
-            self.user['selected_provider'] = self.selected_provider
-            with open(USER_DATA_FILE, 'w') as f:
-                json.dump(self.user, f, indent=2)
+            # Appended to the profile journal instead of rewriting user_data.json
+            settings.user_data.update([{"set": {
+                "clipboard_mode": self.clipboard_mode,
+                "selected_provider": self.selected_provider
+            }}])
+            self.user = settings.user_data.load()
 
     def copy_selected_content(self):
         """Copy the content from clipboard and returns it"""
@@ -255,13 +316,13 @@ class SystemTrayApp:
             # pyautogui.hotkey("ctrl", "c")
             clipboard_content = pyperclip.paste()
             if not clipboard_content.strip():
-                messagebox.showwarning("Empty Clipboard", "No content found in clipboard!")
+                self.call_on_tk(messagebox.showwarning, "Empty Clipboard", "No content found in clipboard!")
                 return
             
             return clipboard_content
             
         except Exception as e:
-            messagebox.showerror("Error", f"Failed to process clipboard content: {str(e)}")
+            self.call_on_tk(messagebox.showerror, "Error", f"Failed to process clipboard content: {str(e)}")
             return None
 
     def open_manual_input_window(self):
@@ -288,54 +349,46 @@ class SystemTrayApp:
 
         recorded_text = tk.StringVar(value="")
         stop_flag = threading.Event()
-        recording_thread = None
+        recording_job = None
+        # Pipeline jobs report back to this window on the Tk thread
+        bridge = TkBridge(input_window, pipeline)
 
         status_label = tk.Label(audio_frame, text="⏺️ Idle", font=("Arial", 12))
         status_label.pack(side=tk.LEFT, padx=5)
 
         def start_recording():
-            nonlocal recording_thread, stop_flag
-            
-            if recording_thread and recording_thread.is_alive():
+            nonlocal recording_job
+
+            if recording_job and not recording_job.done():
                 return
-                
+
             # Reset stop flag
             stop_flag.clear()
-            
+
             status_label.config(text="🎙️ Recording...")
             record_button.config(state=tk.DISABLED)
             stop_button.config(state=tk.NORMAL)
-            
-            def record():
-                try:
-                    text = detect_audio_and_process(provider=self.selected_provider, stop_flag=stop_flag)
-                    
-                    # Update UI in main thread
-                    def update_ui():
-                        recorded_text.set(text if text else "")
-                        status_label.config(text="✅ Done" if text else "⚠️ No input")
-                        record_button.config(state=tk.NORMAL)
-                        stop_button.config(state=tk.DISABLED)
-                    
-                    input_window.after(0, update_ui)
-                    
-                except Exception as e:
-                    def update_ui_error():
-                        status_label.config(text="❌ Error")
-                        record_button.config(state=tk.NORMAL)
-                        stop_button.config(state=tk.DISABLED)
-                        print(f"Recording error: {e}")
-                    
-                    input_window.after(0, update_ui_error)
-            
-            # Start recording in a thread
-            recording_thread = threading.Thread(target=record, daemon=True)
-            recording_thread.start()
+
+            def update_ui(text):
+                recorded_text.set(text if text else "")
+                status_label.config(text="✅ Done" if text else "⚠️ No input")
+                record_button.config(state=tk.NORMAL)
+                stop_button.config(state=tk.DISABLED)
+
+            def update_ui_error(e):
+                status_label.config(text="❌ Error")
+                record_button.config(state=tk.NORMAL)
+                stop_button.config(state=tk.DISABLED)
+                print(f"Recording error: {e}")
+
+            recording_job = bridge.submit(
+                lambda token: pipeline.record(self.selected_provider, stop_flag, token=token),
+                on_done=update_ui,
+                on_error=update_ui_error
+            )
 
         def stop_recording():
-            nonlocal stop_flag
-            
-            if recording_thread and recording_thread.is_alive():
+            if recording_job and not recording_job.done():
                 stop_flag.set()
                 status_label.config(text="⏹️ Stopping...")
                 stop_button.config(state=tk.DISABLED)
@@ -356,18 +409,30 @@ class SystemTrayApp:
             if not content:
                 messagebox.showwarning("Empty Input", "Please enter some content!")
                 return
-            
-            try:
-                response = generate_mail(email_received=content, provider=self.selected_provider, i_want_to_respond=recorded_text.get())
-                
-                # Display response
+
+            output_text.config(state=tk.NORMAL)
+            output_text.delete("1.0", tk.END)
+            output_text.config(state=tk.DISABLED)
+            generate_button.config(state=tk.DISABLED)
+            respond_text = recorded_text.get()
+
+            def append_output(delta):
                 output_text.config(state=tk.NORMAL)
-                output_text.delete("1.0", tk.END)
-                output_text.insert("1.0", response)
+                output_text.insert(tk.END, delta)
+                output_text.see(tk.END)
                 output_text.config(state=tk.DISABLED)
-                
-            except Exception as e:
+
+            async def generate(token):
+                # Tokens are shown as they arrive instead of once the whole mail is done
+                async for delta in pipeline.stream(content, respond_text, self.selected_provider, token=token):
+                    bridge.call(append_output, delta)
+
+            def on_error(e):
+                # Called on the Tk thread by the bridge
+                generate_button.config(state=tk.NORMAL)
                 messagebox.showerror("Error", f"Failed to generate response: {str(e)}")
+
+            bridge.submit(generate, on_done=lambda result: generate_button.config(state=tk.NORMAL), on_error=on_error)
         
         def copy_response():
             response = output_text.get("1.0", tk.END).strip()
@@ -379,8 +444,8 @@ class SystemTrayApp:
         
         # Cleanup function for window close
         def on_window_close():
-            if recording_thread and recording_thread.is_alive():
-                stop_flag.set()
+            # Stops the recording and any generation still streaming
+            bridge.cancel_all()
             input_window.destroy()
         
         input_window.protocol("WM_DELETE_WINDOW", on_window_close)
@@ -389,7 +454,8 @@ class SystemTrayApp:
         button_frame = tk.Frame(input_window)
         button_frame.pack(pady=10)
         
-        tk.Button(button_frame, text="Generate Response", command=process_input).pack(side=tk.LEFT, padx=5)
+        generate_button = tk.Button(button_frame, text="Generate Response", command=process_input)
+        generate_button.pack(side=tk.LEFT, padx=5)
         tk.Button(button_frame, text="Copy Response", command=copy_response).pack(side=tk.LEFT, padx=5)
         tk.Button(button_frame, text="Close", command=on_window_close).pack(side=tk.LEFT, padx=5)
 
@@ -0,0 +1,120 @@
+"""
+Journal tests for settings.JsonFile: crash recovery and concurrent writers.
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import threading
+
+import pytest
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+import settings  # noqa: E402
+
+
+def people_file(path):
+    return settings.JsonFile(str(path), default=[], item_per_line=True, journal=True, key=lambda person: person["name"])
+
+
+def names(json_file):
+    return [person["name"] for person in json_file.load()]
+
+
+@pytest.fixture(autouse=True)
+def no_background_compaction(monkeypatch):
+    # Compaction is triggered explicitly, so journals stay on disk during a test
+    monkeypatch.setattr(settings.JsonFile, "_schedule_compaction", lambda self: None)
+
+
+def test_torn_last_record_is_ignored_then_overwritten(tmp_path):
+    path = tmp_path / "directory.json"
+    writer = people_file(path)
+    writer.update([{"put": {"name": "Alice"}}, {"put": {"name": "Bob"}}])
+    # A crash in the middle of appending the next record
+    with open(writer.journal_path, "ab") as f:
+        f.write(b'{"put": {"name": "Car')
+
+    reader = people_file(path)
+    assert names(reader) == ["Alice", "Bob"]
+
+    reader.update([{"delete": "Alice"}])
+    assert names(people_file(path)) == ["Bob"]
+
+
+def test_stale_journal_is_discarded(tmp_path):
+    path = tmp_path / "directory.json"
+    writer = people_file(path)
+    writer.update([{"put": {"name": "Alice"}}])
+    stale = tmp_path / "stale.journal"
+    shutil.copy(writer.journal_path, stale)
+    # The journal was folded into the file, which was rewritten since
+    writer.compact()
+    writer.save([{"name": "Bob"}])
+    # A crash between the rewrite and the removal of the journal
+    shutil.copy(stale, writer.journal_path)
+
+    reader = people_file(path)
+    assert names(reader) == ["Bob"]
+    assert not os.path.exists(reader.journal_path)
+
+
+def test_update_does_not_change_loaded_data(tmp_path):
+    json_file = people_file(tmp_path / "directory.json")
+    json_file.update([{"put": {"name": "Alice"}}])
+    loaded = json_file.load()
+    json_file.update([{"put": {"name": "Bob"}}, {"delete": "Alice"}])
+    assert [person["name"] for person in loaded] == ["Alice"]
+    assert names(json_file) == ["Bob"]
+
+
+def test_threads_racing_on_the_lock(tmp_path):
+    path = tmp_path / "user_data.json"
+    # One JsonFile per thread, each with its own lock file handle, like separate processes
+    files = [settings.JsonFile(str(path), journal=True) for _ in range(4)]
+
+    def write(number, json_file):
+        for i in range(50):
+            json_file.update([{"set": {f"{number}-{i}": i}}])
+
+    threads = [threading.Thread(target=write, args=(number, json_file)) for number, json_file in enumerate(files)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    data = settings.JsonFile(str(path), journal=True).load()
+    assert len(data) == 200
+    files[0].compact()
+    assert settings.JsonFile(str(path), journal=True).load() == data
+
+
+WRITER = """
+import sys
+sys.path.insert(0, sys.argv[1])
+import settings
+json_file = settings.JsonFile(sys.argv[2], default=[], item_per_line=True, journal=True,
+                              key=lambda person: person["name"])
+json_file._schedule_compaction = lambda: None
+for i in range(100):
+    json_file.update([{"put": {"name": f"{sys.argv[3]}-{i}"}}])
+    if i % 25 == 0:
+        json_file.compact()
+"""
+
+
+def test_processes_racing_on_the_lock(tmp_path):
+    path = tmp_path / "directory.json"
+    writers = [
+        subprocess.Popen([sys.executable, "-c", WRITER, APP_DIR, str(path), name])
+        for name in ("first", "second")
+    ]
+    for writer in writers:
+        assert writer.wait(timeout=60) == 0
+
+    written = names(people_file(path))
+    assert len(written) == 200
+    assert set(written) == {f"{name}-{i}" for name in ("first", "second") for i in range(100)}
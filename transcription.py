@@ -0,0 +1,200 @@
+"""
+Local transcription helpers for the Mail Assistant application: a process-wide
+cache of faster-whisper models, in-memory audio preparation and incremental
+transcription of live recordings
+"""
+
+import io
+import queue
+import threading
+import time
+import wave
+from contextlib import contextmanager
+
+import faster_whisper
+import numpy as np
+
+# Whisper models work on 16 kHz mono audio
+WHISPER_SAMPLE_RATE = 16000
+
+
+def to_whisper_audio(recording, sample_rate):
+    """Downmix a (frames, channels) recording to mono float32 at 16 kHz"""
+    audio = np.asarray(recording, dtype=np.float32)
+    if audio.ndim == 2:
+        audio = audio.mean(axis=1)
+    if sample_rate == WHISPER_SAMPLE_RATE or len(audio) == 0:
+        return audio
+    # Band-limited resampling in the frequency domain, one vectorized pass
+    # over the whole buffer; dropping the bins above 8 kHz is the anti-alias filter
+    frames = int(round(len(audio) * WHISPER_SAMPLE_RATE / sample_rate))
+    spectrum = np.fft.rfft(audio)[:frames // 2 + 1]
+    return (np.fft.irfft(spectrum, frames) * (frames / len(audio))).astype(np.float32)
+
+
+def encode_wav(audio, sample_rate=WHISPER_SAMPLE_RATE):
+    """16-bit PCM WAV bytes for a mono float recording, built in memory"""
+    pcm = (np.clip(audio, -1.0, 1.0) * 32767).astype("<i2")
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(pcm.tobytes())
+    return buffer.getvalue()
+
+
+class WhisperModelCache:
+    """Keeps loaded Whisper models resident and unloads the ones left idle too long"""
+
+    def __init__(self, idle_timeout=600):
+        # Seconds a model may stay unused before it is unloaded, None to keep it forever
+        self.idle_timeout = idle_timeout
+        self._models = {}  # settings key -> [model, last used, users]
+        self._lock = threading.Lock()
+        self._reaper = None
+
+    @staticmethod
+    def _key(settings):
+        return tuple(sorted(settings.items()))
+
+    def preload(self, **settings):
+        """Load a model ahead of its first use"""
+        with self.lease(**settings):
+            pass
+
+    @contextmanager
+    def lease(self, **settings):
+        """Yield the model for these WhisperModel settings, loading it on first use"""
+        key = self._key(settings)
+        # Loads are rare, so one lock also makes a dictation that starts
+        # during the background preload wait for it instead of loading twice
+        with self._lock:
+            entry = self._models.get(key)
+            if entry is None:
+                print(f"Loading Whisper model {settings.get('model_size_or_path')}...")
+                start = time.perf_counter()
+                model = faster_whisper.WhisperModel(**settings)
+                print(f"Whisper model loaded in {time.perf_counter() - start:.1f}s")
+                entry = self._models[key] = [model, time.monotonic(), 0]
+                self._start_reaper()
+            entry[2] += 1
+        try:
+            yield entry[0]
+        finally:
+            with self._lock:
+                entry[1] = time.monotonic()
+                entry[2] -= 1
+
+    def unload_idle(self):
+        """Drop models that nobody used for idle_timeout seconds"""
+        idle_timeout = self.idle_timeout
+        if not idle_timeout:
+            return
+        now = time.monotonic()
+        with self._lock:
+            for key, (model, last_used, users) in list(self._models.items()):
+                if users == 0 and now - last_used > idle_timeout:
+                    print(f"Unloading idle Whisper model {dict(key).get('model_size_or_path')}")
+                    del self._models[key]
+
+    def _start_reaper(self):
+        if not self.idle_timeout or (self._reaper and self._reaper.is_alive()):
+            return
+        self._reaper = threading.Thread(target=self._reap_loop, daemon=True)
+        self._reaper.start()
+
+    def _reap_loop(self):
+        # Runs while something is loaded and unloading is on; a later load starts a new one
+        while True:
+            # apply_config may change idle_timeout, or turn it off, at any time
+            idle_timeout = self.idle_timeout
+            if idle_timeout:
+                time.sleep(min(idle_timeout / 4, 30))
+                self.unload_idle()
+            with self._lock:
+                if not self._models or not self.idle_timeout:
+                    self._reaper = None
+                    return
+
+
+class SilenceSegmenter:
+    """Cuts a live recording into segments at pauses in speech"""
+
+    def __init__(self, chunk_duration, silence_threshold=0.01, min_silence=0.4,
+                 min_segment=3.0, max_segment=25.0):
+        self.chunk_duration = chunk_duration
+        # RMS level below which a chunk counts as silence
+        self.silence_threshold = silence_threshold
+        self.min_silence_chunks = max(1, round(min_silence / chunk_duration))
+        self.min_segment_chunks = max(1, round(min_segment / chunk_duration))
+        # Whisper works on 30 second windows, so long speech is cut regardless
+        self.max_segment_chunks = max(1, round(max_segment / chunk_duration))
+        self._chunks = []
+        self._silent_run = 0
+        self._voiced = False
+
+    def add(self, chunk):
+        """Add a recorded chunk; returns a finished segment or None"""
+        silent = np.sqrt(np.mean(np.square(chunk))) < self.silence_threshold
+        self._chunks.append(chunk)
+        self._silent_run = self._silent_run + 1 if silent else 0
+        self._voiced = self._voiced or not silent
+
+        at_pause = len(self._chunks) >= self.min_segment_chunks and self._silent_run >= self.min_silence_chunks
+        if at_pause or len(self._chunks) >= self.max_segment_chunks:
+            return self.flush()
+        return None
+
+    def flush(self):
+        """Return whatever is buffered as a segment, or None if it holds no speech"""
+        chunks, voiced = self._chunks, self._voiced
+        self._chunks = []
+        self._silent_run = 0
+        self._voiced = False
+        if not voiced:
+            # Transcribing silence only makes Whisper invent words
+            return None
+        return np.concatenate(chunks, axis=0)
+
+
+class BackgroundTranscriber:
+    """Transcribes segments in order on a worker thread while recording continues"""
+
+    def __init__(self, transcribe):
+        # transcribe(audio, previous_text) -> text of one segment
+        self.transcribe = transcribe
+        self._segments = queue.Queue()
+        self._texts = []
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, segment):
+        self._segments.put(segment)
+
+    def finish(self):
+        """Wait for the queued segments and return the full transcription"""
+        self._segments.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return " ".join(self._texts)
+
+    def _run(self):
+        while True:
+            segment = self._segments.get()
+            if segment is None:
+                return
+            if self._error is not None:
+                continue
+            try:
+                start = time.perf_counter()
+                # The text so far keeps spelling and names consistent across segments
+                text = self.transcribe(segment, " ".join(self._texts))
+                print(f"Segment transcribed in {time.perf_counter() - start:.1f}s: {text}")
+            except Exception as e:
+                self._error = e
+                continue
+            if text:
+                self._texts.append(text)
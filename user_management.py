@@ -1,18 +1,17 @@
-import json
-import os
 import tkinter as tk
 from tkinter import messagebox
 
 import Levenshtein
-from config_settings import USER_DATA_FILE, REGISTRATION_WINDOW_SIZE
-from directory import add_person
 
-def load_user_data(app):
+import settings
+from config_settings import REGISTRATION_WINDOW_SIZE
+from directory import add_person, similar_people
+
+def load_user_data(app=None):
     """Load user data from file"""
-    if os.path.exists(USER_DATA_FILE):
-        with open(USER_DATA_FILE, "r") as file:
-            return json.load(file)
-    else:
+    if settings.user_data.exists():
+        return settings.user_data.load()
+    elif app is not None:
         create_registration_window(app)
     return None
 
@@ -22,8 +21,7 @@ def save_user_data(name, function):
         "name": name,
         "function": function
     }
-    with open(USER_DATA_FILE, "w") as file:
-        json.dump(data, file)
+    settings.user_data.save(data)
 
 def submit_form(name_entry, function_entry, root, app):
     """Handle form submission for user registration"""
@@ -62,7 +60,7 @@ def create_registration_window(app):
     root.mainloop()
 
 
-def resolve_unknown_name(name, directory):
+def resolve_unknown_name(name, directory=None):
     win = tk.Toplevel()
     win.title(f"Resolve: {name}")
     win.geometry("400x300")
@@ -83,11 +81,14 @@ def resolve_unknown_name(name, directory):
 
     tk.Button(win, text=f"+ Add '{name}' to directory", command=use_new).pack(pady=5)
 
-    # Levenshtein sorting
-    matches = sorted(
-        directory,
-        key=lambda person: Levenshtein.distance(name.lower(), person["name"].lower())
-    )[:5]
+    if directory is None:
+        # Closest names through the trigram index instead of sorting the whole directory
+        matches = similar_people(name, 5)
+    else:
+        matches = sorted(
+            directory,
+            key=lambda person: Levenshtein.distance(name.lower(), person["name"].lower())
+        )[:5]
 
     tk.Label(win, text="Closest matches:", font=("Arial", 10)).pack(pady=5)
     for match in matches:
@@ -5,7 +5,7 @@ Utility functions for the Mail Assistant application
 import os
 import sys
 from PIL import Image, ImageDraw
-from config_settings import ICON_FILE, TRAY_ICON_SIZE, OVERLAY_COLOR
+from config_settings import ICON_FILE, TRAY_ICON_SIZE, OVERLAY_COLOR, APP_DIR, get_absolute_path
 
 def get_resource_path(relative_path):
     """Get absolute path to resource, works for dev and for PyInstaller"""
@@ -13,7 +13,7 @@ def get_resource_path(relative_path):
         # PyInstaller creates a temp folder and stores path in _MEIPASS
         base_path = sys._MEIPASS
     except Exception:
-        base_path = os.path.abspath(".")
+        base_path = APP_DIR
     
     return os.path.join(base_path, relative_path)
 
@@ -25,11 +25,12 @@ def ensure_data_files():
     ]
     
     for file_name in files_to_check:
-        if not os.path.exists(file_name):
+        path = get_absolute_path(file_name)
+        if not os.path.exists(path):
             if file_name == 'directory.json':
                 # Create empty directory file
                 import json
-                with open(file_name, 'w') as f:
+                with open(path, 'w') as f:
                     json.dump([], f)
             elif file_name == 'config.json':
                 # Create default config file
@@ -39,7 +40,7 @@ def ensure_data_files():
                     "auto_start": False,
                     "notifications": True
                 }
-                with open(file_name, 'w') as f:
+                with open(path, 'w') as f:
                     json.dump(default_config, f, indent=2)
 
 def setup_application():